@@ -1,11 +1,17 @@
 from nose.tools import set_trace
 import os
+import json
 import logging
 import flask
 import urlparse
 
 from functools import wraps
-from flask import Flask
+from flask import Flask, make_response
+from sqlalchemy import create_engine
+from sqlalchemy.orm import (
+    scoped_session,
+    sessionmaker,
+)
 from flask.ext.babel import Babel
 from core.util.problem_detail import ProblemDetail
 from core.opds import VerboseAnnotator
@@ -34,20 +40,60 @@ babel = Babel(app)
 
 class Conf:
     db = None
+    engine = None
     log = None
 
+    # The number of database connections kept open for request
+    # sessions, and the number of extra connections that may be
+    # opened when they're all in use.
+    POOL_SIZE = int(os.environ.get('SIMPLIFIED_DB_POOL_SIZE', 10))
+    POOL_MAX_OVERFLOW = int(os.environ.get('SIMPLIFIED_DB_POOL_MAX_OVERFLOW', 10))
+
+    # Pooled connections are replaced after this many seconds, so
+    # they don't outlive the database's idle timeout.
+    POOL_RECYCLE = 3600
+
     @classmethod
     def initialize(cls, _db):
         cls.db = _db
         Configuration.load(cls.db)
         cls.log = logging.getLogger("Metadata web app")
 
+    @classmethod
+    def initialize_pooled(cls):
+        """Give each thread its own database session, drawing its
+        connection from a pool shared by the whole process.
+        """
+        # production_session() makes sure the database schema and
+        # basic data are in place. Its session isn't used afterwards.
+        _db = production_session()
+        Configuration.load(_db)
+        _db.close()
+
+        cls.engine = create_engine(
+            Configuration.database_url(), pool_size=cls.POOL_SIZE,
+            max_overflow=cls.POOL_MAX_OVERFLOW,
+            pool_recycle=cls.POOL_RECYCLE
+        )
+        cls.db = scoped_session(sessionmaker(bind=cls.engine))
+        cls.log = logging.getLogger("Metadata web app")
+
+    @classmethod
+    def pool_status(cls):
+        """Describe the state of the database connection pool."""
+        if not cls.engine:
+            return dict()
+        pool = cls.engine.pool
+        return dict(
+            size=pool.size(), checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(), overflow=pool.overflow(),
+        )
+
 if os.environ.get('TESTING') == "true":
     Conf.testing = True
 else:
     Conf.testing = False
-    _db = production_session()
-    Conf.initialize(_db)
+    Conf.initialize_pooled()
 
 
 def accepts_auth(f):
@@ -72,20 +118,38 @@ def requires_auth(f):
 def shutdown_session(exception):
     if (hasattr(Conf, 'db')
         and Conf.db):
-        if exception:
-            Conf.db.rollback()
-        else:
-            Conf.db.commit()
+        try:
+            if exception:
+                Conf.db.rollback()
+            else:
+                Conf.db.commit()
+        finally:
+            if isinstance(Conf.db, scoped_session):
+                # Hand this request's connection back to the pool.
+                Conf.db.remove()
 
 @app.route('/heartbeat')
 def heartbeat():
     return HeartbeatController().heartbeat()
 
+@app.route('/database-pool')
+@requires_auth
+def database_pool():
+    return make_response(
+        json.dumps(Conf.pool_status()), 200,
+        {"Content-Type": "application/json"}
+    )
+
 @app.route('/canonical-author-name')
 @returns_problem_detail
 def canonical_author_name():
     return CanonicalizationController(Conf.db).canonicalize_author_name()
 
+@app.route('/canonical-author-names', methods=['POST'])
+@returns_problem_detail
+def canonical_author_names():
+    return CanonicalizationController(Conf.db).canonicalize_author_names()
+
 @app.route('/lookup')
 @app.route('/<collection_metadata_identifier>/lookup')
 @accepts_auth
@@ -104,6 +168,14 @@ def add(collection_metadata_identifier):
         collection_details=collection_metadata_identifier
     )
 
+@app.route('/<collection_metadata_identifier>/add/<int:job_id>')
+@requires_auth
+@returns_problem_detail
+def add_job(collection_metadata_identifier, job_id):
+    return CatalogController(Conf.db).registration_job(
+        collection_metadata_identifier, job_id
+    )
+
 @app.route('/<collection_metadata_identifier>/updates')
 @requires_auth
 @returns_problem_detail
@@ -1,14 +1,40 @@
 """Use external services to canonicalize names."""
+import datetime
 import logging
 import os
 import re
+import threading
+import time
+import unicodedata
+import weakref
+from collections import OrderedDict
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 from nose.tools import set_trace
+from sqlalchemy import (
+    Column,
+    DateTime,
+    event,
+    inspect,
+    Integer,
+    Table,
+    Unicode,
+    UniqueConstraint,
+)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import (
+    object_session,
+    Session,
+)
 from oclc import OCLCLinkedData
 from viaf import VIAFClient, MockVIAFClient
 
 from core.model import (
+    Base,
+    Contribution,
     Contributor,
+    Edition,
     Identifier,
 )
 
@@ -27,6 +53,331 @@ from core.util.titles import (
 class CanonicalizationError(Exception):
     pass
 
+class CanonicalizationTimeout(CanonicalizationError):
+    """OCLC Linked Data and VIAF didn't answer before the deadline, or
+    were too busy to ask.
+    """
+
+
+
+# Write-through storage for CanonicalizationCache. See
+# migration/20261018-create-canonicalization-cache.sql.
+canonicalization_cache_table = Table(
+    'canonicalizationcache', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('display_name', Unicode, nullable=False),
+    Column('identifier_urn', Unicode, nullable=False),
+    Column('sort_name', Unicode),
+    Column('created', DateTime, nullable=False, index=True),
+    UniqueConstraint('display_name', 'identifier_urn'),
+)
+
+
+class CanonicalizationCache(object):
+
+    """Remembers the results of canonicalizing author names.
+
+    Results are kept in memory, keyed on (normalized display name,
+    identifier URN). The cache holds at most `max_size` results,
+    evicting the least recently used result first, and a result
+    expires `ttl` seconds after it was stored.
+
+    If `persistent` is True, results are also written to the
+    `canonicalizationcache` table, so they survive restarts and can be
+    shared between processes.
+    """
+
+    DEFAULT_TTL = 3600 * 24 * 7
+    DEFAULT_MAX_SIZE = 50000
+
+    # Stands in for a cache miss, since None is a legitimate result.
+    MISSING = object()
+
+    def __init__(self, ttl=None, max_size=None, persistent=False,
+                 clock=time.time):
+        if ttl is None:
+            ttl = self.DEFAULT_TTL
+        if max_size is None:
+            max_size = self.DEFAULT_MAX_SIZE
+        self.ttl = ttl
+        self.max_size = max_size
+        self.persistent = persistent
+        self.clock = clock
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def key(cls, identifier, display_name):
+        """Turn an identifier and a display name into a cache key.
+
+        Display names are normalized so that trivial differences in
+        Unicode composition or whitespace don't cause misses.
+        """
+        if display_name:
+            if isinstance(display_name, str):
+                display_name = display_name.decode("utf8")
+            display_name = unicodedata.normalize("NFC", display_name)
+            display_name = u" ".join(display_name.split())
+        else:
+            display_name = u""
+        if isinstance(identifier, Identifier):
+            urn = identifier.urn
+        else:
+            urn = identifier or u""
+        return (display_name, urn)
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key, _db=None):
+        """Look up a canonicalization result.
+
+        :return: The cached sort name (possibly None), or
+            CanonicalizationCache.MISSING if there is no unexpired result.
+        """
+        now = self.clock()
+        with self._lock:
+            if key in self._results:
+                stored_at, value = self._results.pop(key)
+                if now - stored_at < self.ttl:
+                    # Move this result to the most-recently-used end.
+                    self._results[key] = (stored_at, value)
+                    return value
+
+        if not (self.persistent and _db):
+            return self.MISSING
+
+        table = canonicalization_cache_table
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=self.ttl
+        )
+        row = _db.execute(
+            table.select().where(table.c.display_name==key[0]).where(
+                table.c.identifier_urn==key[1]).where(
+                    table.c.created > cutoff)
+        ).first()
+        if not row:
+            return self.MISSING
+        self._remember(key, row.sort_name, now)
+        return row.sort_name
+
+    def set(self, key, value, _db=None):
+        """Store a canonicalization result."""
+        self._remember(key, value, self.clock())
+        if not (self.persistent and _db):
+            return
+
+        # Another process may be storing a result for the same key,
+        # so this is done with a single upsert.
+        table = canonicalization_cache_table
+        statement = insert(table).values(
+            display_name=key[0], identifier_urn=key[1],
+            sort_name=value, created=datetime.datetime.utcnow()
+        )
+        _db.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.display_name, table.c.identifier_urn],
+            set_=dict(
+                sort_name=statement.excluded.sort_name,
+                created=statement.excluded.created
+            )
+        ))
+
+    def _remember(self, key, value, now):
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = (now, value)
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._results.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+
+class ContributorNameIndex(object):
+
+    """An index from display names to the sort names of Contributors with
+    that display name, and the titles of the books they worked on.
+
+    This lets AuthorNameCanonicalizer check whether a contributor
+    wrote a given book with a set lookup, instead of loading every
+    Contribution and Edition for every matching Contributor.
+
+    An entry is loaded the first time its display name is needed,
+    using a single query that doesn't load any ORM objects. Display
+    names nobody has aren't kept, so a new Contributor is found as
+    soon as it's in the database. Once loaded, an entry is dropped
+    when a transaction in this process that created or changed a
+    Contributor or Contribution with that display name ends (see the
+    event listeners below), so it's reloaded with the change. Entries
+    also expire after `ttl` seconds so changes made by other processes
+    show up too.
+    """
+
+    DEFAULT_TTL = 3600
+    DEFAULT_MAX_SIZE = 100000
+
+    # How well a known title must match one of a contributor's titles
+    # for that contributor to be chosen.
+    TITLE_MATCH_THRESHOLD = 80
+
+    NON_ALPHANUMERIC = re.compile("\W+", re.UNICODE)
+
+    # Every index in this process, so mapper events can update them.
+    _indexes = weakref.WeakSet()
+
+    def __init__(self, ttl=None, max_size=None, clock=time.time):
+        self.entries = CanonicalizationCache(
+            ttl=ttl or self.DEFAULT_TTL,
+            max_size=max_size or self.DEFAULT_MAX_SIZE,
+            clock=clock
+        )
+        self._lock = threading.Lock()
+        self._indexes.add(self)
+
+    @classmethod
+    def indexes(cls):
+        return list(cls._indexes)
+
+    @classmethod
+    def normalize_name(cls, display_name):
+        """Normalize a display name the way CanonicalizationCache does."""
+        return CanonicalizationCache.key(None, display_name)[0]
+
+    @classmethod
+    def normalize_title(cls, title):
+        if isinstance(title, str):
+            title = title.decode("utf8")
+        return cls.NON_ALPHANUMERIC.sub(u" ", title.lower()).strip()
+
+    def load(self, _db, display_names):
+        """Make sure the index has entries for the given display names.
+
+        :return: A dictionary mapping each display name to an OrderedDict
+            that maps sort names to sets of normalized titles.
+        """
+        entries = dict()
+        missing = dict()
+        for display_name in set(display_names):
+            if not display_name:
+                continue
+            key = self.normalize_name(display_name)
+            entry = self.entries.get(key)
+            if entry is CanonicalizationCache.MISSING:
+                missing.setdefault(key, set()).add(display_name)
+            else:
+                entries[display_name] = entry
+        if not missing:
+            return entries
+
+        found = dict((key, OrderedDict()) for key in missing)
+        names = set()
+        for display_names in missing.values():
+            names.update(display_names)
+        qu = _db.query(
+            Contributor.display_name, Contributor.sort_name, Edition.title
+        ).outerjoin(Contributor.contributions).outerjoin(
+            Contribution.edition
+        ).filter(Contributor.display_name.in_(names)).filter(
+            Contributor.sort_name != None
+        ).order_by(Contributor.id)
+        for display_name, sort_name, title in qu:
+            entry = found[self.normalize_name(display_name)]
+            titles = entry.setdefault(sort_name, set())
+            if title:
+                titles.add(self.normalize_title(title))
+
+        with self._lock:
+            for key, entry in found.items():
+                if entry:
+                    self.entries.set(key, entry)
+                for display_name in missing[key]:
+                    entries[display_name] = entry
+        return entries
+
+    def invalidate(self, display_name):
+        if not display_name:
+            return
+        with self._lock:
+            self.entries.invalidate(self.normalize_name(display_name))
+
+    def sort_name_for(self, _db, display_name, known_titles=None):
+        """Choose a sort name for the contributor with the given display
+        name, preferring one who worked on one of `known_titles`.
+        """
+        candidates = self.load(_db, [display_name]).get(display_name)
+        if not candidates:
+            return None
+
+        if known_titles:
+            known_title = self.normalize_title(known_titles[0])
+            for sort_name, titles in candidates.items():
+                if known_title in titles:
+                    return sort_name
+            for sort_name, titles in candidates.items():
+                for title in titles:
+                    ratio = title_match_ratio(known_title, title)
+                    if ratio > self.TITLE_MATCH_THRESHOLD:
+                        return sort_name
+
+        # None of the titles matched; any sort name will probably do.
+        return next(iter(candidates))
+
+
+# Changes are only visible to other sessions once they're committed,
+# so the mapper events below note which display names were touched
+# during a flush, and the index entries for those names are dropped
+# once the transaction is over. Nothing is added to the index
+# directly, so a rolled-back change never shows up in it.
+_CHANGED_NAMES = 'contributor_name_index_changed_names'
+
+def _note_changed_names(target, *names):
+    session = object_session(target)
+    if session is None:
+        return
+    changed = session.info.setdefault(_CHANGED_NAMES, set())
+    changed.update(name for name in names if name)
+
+@event.listens_for(Contributor, 'after_insert')
+def _index_new_contributor(mapper, connection, target):
+    _note_changed_names(target, target.display_name)
+
+@event.listens_for(Contributor, 'after_update')
+def _reindex_changed_contributor(mapper, connection, target):
+    state = inspect(target)
+    display_name = state.attrs.display_name.history
+    sort_name = state.attrs.sort_name.history
+    if not (display_name.has_changes() or sort_name.has_changes()):
+        return
+    _note_changed_names(
+        target, target.display_name, *(display_name.deleted or [])
+    )
+
+@event.listens_for(Contribution, 'after_insert')
+def _index_new_contribution(mapper, connection, target):
+    # Only look at objects that are already loaded; this runs in the
+    # middle of a flush.
+    contributor = target.__dict__.get('contributor')
+    if contributor:
+        _note_changed_names(target, contributor.display_name)
+
+@event.listens_for(Session, 'after_transaction_end')
+def _reindex_changed_names(session, transaction):
+    if transaction.parent is not None:
+        # Only the outermost transaction decides whether the changes
+        # are kept.
+        return
+    names = session.info.pop(_CHANGED_NAMES, None)
+    if not names:
+        return
+    for index in ContributorNameIndex.indexes():
+        for name in names:
+            index.invalidate(name)
 
 
 class AuthorNameCanonicalizer(object):
@@ -37,10 +388,48 @@ class AuthorNameCanonicalizer(object):
 
     VIAF_ID = re.compile("^http://viaf.org/viaf/([0-9]+)$")
 
-    def __init__(self, _db, oclcld=None, viaf=None):
+    # Stands in for the result of a lookup that raised an exception.
+    NO_ANSWER = object()
+
+    # Stands in for the result of a lookup that ran out of time.
+    TIMED_OUT = object()
+
+    # The number of threads shared by all canonicalizers that have a
+    # deadline.
+    THREAD_POOL_SIZE = 8
+    _thread_pool = None
+    _thread_pool_lock = threading.Lock()
+
+    # The most lookups that may be running or waiting for a thread at
+    # once. Past this, new lookups are refused instead of queued
+    # behind lookups that may never finish in time.
+    MAX_PENDING_LOOKUPS = THREAD_POOL_SIZE * 2
+    _pending_lookups = threading.BoundedSemaphore(MAX_PENDING_LOOKUPS)
+
+    def __init__(self, _db, oclcld=None, viaf=None, cache=None,
+                 contributor_index=None, deadline=None):
+        """Constructor.
+
+        :param deadline: If this is set, OCLC Linked Data and VIAF are
+            asked about a name at the same time, and
+            canonicalize_author_name() will give up after about this
+            many seconds and fall back to default_name().
+        """
         self._db = _db
         self.oclcld = oclcld or OCLCLinkedData(_db)
         self.viaf = viaf or VIAFClient(_db)
+
+        # Clients created here are tied to this database session, so
+        # a worker thread needs its own. Clients passed in are shared
+        # with worker threads.
+        self._session_clients = []
+        if not oclcld:
+            self._session_clients.append(self.oclcld)
+        if not viaf:
+            self._session_clients.append(self.viaf)
+        self.cache = cache
+        self.contributor_index = contributor_index
+        self.deadline = deadline
         self.log = logging.getLogger("Author name canonicalizer")
 
     @classmethod
@@ -82,6 +471,40 @@ class AuthorNameCanonicalizer(object):
                 "Neither useful identifier nor display name was provided."
             )
 
+        if self.cache is not None:
+            key = self.cache.key(identifier, display_name)
+            sort_name = self.cache.get(key, self._db)
+            if sort_name is not self.cache.MISSING:
+                return sort_name
+
+        try:
+            sort_name = self._canonicalize_author_name(
+                identifier, display_name
+            )
+        except CanonicalizationTimeout, e:
+            # There's no answer yet. Fall back to a guess, but don't
+            # cache it, so the next request tries again.
+            self.log.warn(
+                "No answer for %s/%s: %s", display_name, identifier, e
+            )
+            return self.default_name(display_name)
+        if sort_name:
+            # This answer came from the database, OCLC or VIAF, so
+            # it's worth remembering.
+            if self.cache is not None:
+                self.cache.set(key, sort_name, self._db)
+            return sort_name
+
+        # All our techniques have failed. Woe! Let's just try to finagle
+        # this provided display name into a sort name. This guess isn't
+        # cached, so we'll try again next time.
+        return self.default_name(display_name)
+
+    def _canonicalize_author_name(self, identifier, display_name):
+        deadline_at = None
+        if self.deadline:
+            deadline_at = time.time() + self.deadline
+
         # From an author name that potentially names multiple people,
         # extract only the first name.
         shortened_name = self.primary_author_name(display_name)
@@ -89,13 +512,10 @@ class AuthorNameCanonicalizer(object):
         # If we can canonicalize that shortened name, great. If not,
         # try again with the full name.
         for n in shortened_name, display_name:
-            v = self._canonicalize(identifier, n)
+            v = self._canonicalize(identifier, n, deadline_at=deadline_at)
             if v:
                 return v
-
-        # All our techniques have failed. Woe! Let's just try to finagle
-        # this provided display name into a sort name.
-        return self.default_name(display_name)
+        return None
 
 
     def default_name(self, display_name):
@@ -103,80 +523,454 @@ class AuthorNameCanonicalizer(object):
         return display_name_to_sort_name(shortened_name)
 
 
-    def _canonicalize(self, identifier, display_name):
-        # The best outcome would be that we already have a Contributor
-        # with this exact display name and a known sort name.
-        self.log.debug("Attempting to canonicalize %s", display_name)
+    def canonicalize_author_names(self, pairs, concurrency=1):
+        """Canonicalize a number of (identifier, display name) pairs at once.
 
-        # can we infer any titles we know this person wrote?
+        Duplicate pairs are only canonicalized once, the local
+        database is searched for every display name in a single
+        query, and pairs that need to go out to OCLC or VIAF are
+        looked up in up to `concurrency` threads. Each thread uses
+        its own database session.
+
+        Unlike canonicalize_author_name, this checks the database for
+        both the shortened and the full display name before asking
+        any external service.
+
+        If this canonicalizer has a deadline, it applies to the whole
+        batch. Pairs that OCLC and VIAF haven't been asked about by
+        then get a default name, which isn't cached.
+
+        :param pairs: A list of (Identifier, display name) 2-tuples.
+        :return: A dictionary mapping each 2-tuple to a sort name, or
+            to None if there was an error looking it up.
+        """
+        results = dict()
+        todo = dict()
+        for identifier, display_name in pairs:
+            key = CanonicalizationCache.key(identifier, display_name)
+            if key in todo or key in results:
+                continue
+            if not identifier and not display_name:
+                results[key] = None
+                continue
+            if self.cache is not None:
+                sort_name = self.cache.get(key, self._db)
+                if sort_name is not self.cache.MISSING:
+                    results[key] = sort_name
+                    continue
+            todo[key] = (identifier, display_name)
+
+        # Find every potentially relevant Contributor in one query.
+        names = set()
+        for identifier, display_name in todo.values():
+            names.add(display_name)
+            names.add(self.primary_author_name(display_name))
+        names.discard(None)
+        contributors_by_name = dict()
+        if names and self.contributor_index:
+            self.contributor_index.load(self._db, names)
+        elif names:
+            qu = self._db.query(Contributor).filter(
+                Contributor.display_name.in_(names)).filter(
+                    Contributor.sort_name != None)
+            for contributor in qu:
+                contributors_by_name.setdefault(
+                    contributor.display_name, []).append(contributor)
+
+        deadline_at = None
+        if self.deadline:
+            deadline_at = time.time() + self.deadline
+
+        remote = []
+        for key, (identifier, display_name) in todo.items():
+            known_titles = self._known_titles(identifier)
+            shortened_name = self.primary_author_name(display_name)
+            sort_name = None
+            for n in shortened_name, display_name:
+                sort_name = self._sort_name_from_database(
+                    n, known_titles, contributors_by_name.get(n, [])
+                )
+                if sort_name:
+                    break
+            if sort_name:
+                results[key] = sort_name
+            else:
+                remote.append(key)
+
+        if concurrency > 1 and len(remote) > 1:
+            pool = ThreadPool(min(concurrency, len(remote)))
+            try:
+                lookups = []
+                for key in remote:
+                    identifier, display_name = todo[key]
+                    lookups.append(pool.apply_async(
+                        self._canonicalize_in_own_session,
+                        ((identifier and identifier.id, display_name,
+                          deadline_at),)
+                    ))
+            finally:
+                pool.close()
+            sort_names = [
+                self._batch_result(lookup, deadline_at) for lookup in lookups
+            ]
+            if self.TIMED_OUT not in sort_names:
+                pool.join()
+            # Otherwise, lookups still in progress are left to finish
+            # on their own. The ones that haven't started will see the
+            # deadline has passed and skip themselves.
+        else:
+            sort_names = [
+                self._try_canonicalize_remotely(*(todo[key] + (deadline_at,)))
+                for key in remote
+            ]
+        failed = set()
+        timed_out = 0
+        for key, sort_name in zip(remote, sort_names):
+            if sort_name is self.TIMED_OUT:
+                # There's no answer yet. This pair gets a default name.
+                timed_out += 1
+                sort_name = None
+            elif sort_name is self.NO_ANSWER:
+                # Something went wrong. There's no answer for this
+                # pair, not even a default name.
+                failed.add(key)
+                sort_name = None
+            results[key] = sort_name
+
+        if timed_out:
+            self.log.warn(
+                "Ran out of time canonicalizing %d of %d names.",
+                timed_out, len(remote)
+            )
+
+        # Only answers that came from the database, OCLC or VIAF are
+        # cached. The rest get a default name that's tried again next
+        # time.
+        for key, (identifier, display_name) in todo.items():
+            if results[key]:
+                if self.cache is not None:
+                    self.cache.set(key, results[key], self._db)
+            elif key not in failed:
+                results[key] = self.default_name(display_name)
+
+        by_pair = dict()
+        for identifier, display_name in pairs:
+            by_pair[(identifier, display_name)] = results[
+                CanonicalizationCache.key(identifier, display_name)
+            ]
+        return by_pair
+
+    def _batch_result(self, lookup, deadline_at):
+        """Wait for a lookup started by canonicalize_author_names.
+
+        :return: A sort name, None, NO_ANSWER, or TIMED_OUT if the
+            lookup didn't finish before `deadline_at`.
+        """
+        timeout = None
+        if deadline_at:
+            timeout = max(deadline_at - time.time(), 0)
+        try:
+            return lookup.get(timeout)
+        except TimeoutError:
+            return self.TIMED_OUT
+
+    def _canonicalize_in_own_session(self, args):
+        """Run _canonicalize_remotely in a worker thread.
+
+        :return: A sort name, None, NO_ANSWER if there was an error, or
+            TIMED_OUT if the deadline passed.
+        """
+        identifier_id, display_name, deadline_at = args
+        if deadline_at and time.time() >= deadline_at:
+            # Don't bother opening a database session.
+            return self.TIMED_OUT
+        try:
+            return self._run_in_own_session(
+                '_canonicalize_remotely', identifier_id, display_name,
+                deadline_at
+            )
+        except Exception, e:
+            # _run_in_own_session has already logged the error.
+            return self.NO_ANSWER
+
+    def _try_canonicalize_remotely(self, identifier, display_name,
+                                   deadline_at=None):
+        """Run _canonicalize_remotely in this thread, handling errors
+        the same way _canonicalize_in_own_session does.
+        """
+        try:
+            return self._canonicalize_remotely(
+                identifier, display_name, deadline_at
+            )
+        except Exception, e:
+            self.log.error(
+                "Error canonicalizing %s/%s: %s", display_name, identifier,
+                e, exc_info=e
+            )
+            return self.NO_ANSWER
+
+    def _run_in_own_session(self, method_name, identifier_id, *args):
+        """Call a method on a new AuthorNameCanonicalizer that has its
+        own database session.
+
+        SQLAlchemy sessions can't be shared between threads, so this
+        is how work gets done in a worker thread.
+
+        The new canonicalizer shares this one's cache, contributor
+        index, and any OCLC Linked Data or VIAF clients that were
+        passed into the constructor.
+
+        :param identifier_id: The ID of the Identifier to pass in as
+            the method's first argument.
+        :return: Whatever the method returns. If it raises an
+            exception, the exception is logged and raised again.
+        """
+        _db = Session(bind=self._db.get_bind())
+        try:
+            identifier = None
+            if identifier_id:
+                identifier = _db.query(Identifier).get(identifier_id)
+            kwargs = dict(
+                cache=self.cache, contributor_index=self.contributor_index
+            )
+            for name in ('oclcld', 'viaf'):
+                client = getattr(self, name)
+                if not any(client is x for x in self._session_clients):
+                    kwargs[name] = client
+            canonicalizer = self.__class__(_db, **kwargs)
+            result = getattr(canonicalizer, method_name)(identifier, *args)
+            _db.commit()
+            return result
+        except Exception, e:
+            _db.rollback()
+            self.log.error(
+                "Error running %s for %r: %s", method_name, args, e,
+                exc_info=e
+            )
+            raise
+        finally:
+            _db.close()
+
+    @classmethod
+    def thread_pool(cls):
+        with cls._thread_pool_lock:
+            if cls._thread_pool is None:
+                cls._thread_pool = ThreadPool(cls.THREAD_POOL_SIZE)
+            return cls._thread_pool
+
+    def _canonicalize_remotely(self, identifier, display_name,
+                               deadline_at=None):
+        """Canonicalize a name we know the local database can't help with.
+
+        :return: A sort name, None if OCLC and VIAF don't know it, or
+            TIMED_OUT if `deadline_at` passed before they could be
+            asked.
+        """
+        known_titles = self._known_titles(identifier)
+        shortened_name = self.primary_author_name(display_name)
+        for n in shortened_name, display_name:
+            if deadline_at and time.time() >= deadline_at:
+                return self.TIMED_OUT
+            v = self._canonicalize_externally(identifier, n, known_titles)
+            if v:
+                return v
+        return None
+
+    def _known_titles(self, identifier):
+        """Find titles we know were written by the author of `identifier`."""
         known_titles = []
         if identifier:
             editions = identifier.primarily_identifies
             # only choose one version of the title
             if editions and editions[0].title:
                 known_titles.append(editions[0].title)
+        return known_titles
 
-        contributors = self._db.query(Contributor).filter(
-            Contributor.display_name==display_name).filter(
-                Contributor.sort_name != None).all()
-        sort_name = None
-        if contributors:
-            # Yes, awesome. Let's gild this lily -- are there any contributors
-            # who have sort_names and also have written titles similar to the 
-            # identifier's?  If not, no worries, choose any sort_name, and it's 
-            # probably good.
-            for contributor in contributors:
-                # did we just find the sort_name in a previous iteration?
-                if sort_name:
-                    break
-
-                for contribution in contributor.contributions:
-                    if (contribution.edition and contribution.edition.title and 
-                        known_titles and 
-                        (title_match_ratio(known_titles[0], contribution.edition.title) > 80)):
-                        # whew! 
-                        sort_name = contributor.sort_name
-                        break
+    def _canonicalize(self, identifier, display_name, deadline_at=None):
+        # The best outcome would be that we already have a Contributor
+        # with this exact display name and a known sort name.
+        self.log.debug("Attempting to canonicalize %s", display_name)
 
-            else:
-                # we have contributors, but none of their titles matched what we know
-                sort_name = contributors[0].sort_name
+        # can we infer any titles we know this person wrote?
+        known_titles = self._known_titles(identifier)
 
+        sort_name = self._sort_name_from_database(display_name, known_titles)
+        if sort_name:
             self.log.debug(
                 "Found existing contributor for %s: %s",
                 display_name, sort_name
             )
             return sort_name
 
+        if deadline_at:
+            return self._canonicalize_externally_before(
+                identifier, display_name, known_titles, deadline_at
+            )
+        return self._canonicalize_externally(
+            identifier, display_name, known_titles
+        )
+
+    def _sort_name_from_database(self, display_name, known_titles,
+                                 contributors=None):
+        """Find a sort name for a display name we already know about.
+
+        :param contributors: The Contributors with this display name,
+            if they've already been loaded. Ignored if there is a
+            contributor index.
+        """
+        if self.contributor_index:
+            return self.contributor_index.sort_name_for(
+                self._db, display_name, known_titles
+            )
+        if contributors is None:
+            contributors = self._db.query(Contributor).filter(
+                Contributor.display_name==display_name).filter(
+                    Contributor.sort_name != None).all()
+        return self._sort_name_from_contributors(contributors, known_titles)
+
+    def _sort_name_from_contributors(self, contributors, known_titles):
+        """Choose a sort name from Contributors who share a display name."""
+        if not contributors:
+            return None
+
+        # Yes, awesome. Let's gild this lily -- are there any contributors
+        # who have sort_names and also have written titles similar to the 
+        # identifier's?  If not, no worries, choose any sort_name, and it's 
+        # probably good.
+        if known_titles:
+            for contributor in contributors:
+                for contribution in contributor.contributions:
+                    if (contribution.edition and contribution.edition.title and 
+                        (title_match_ratio(known_titles[0], contribution.edition.title) > 80)):
+                        # whew! 
+                        return contributor.sort_name
+
+        # we have contributors, but none of their titles matched what we know
+        return contributors[0].sort_name
+
+    def _canonicalize_externally(self, identifier, display_name, known_titles):
+        """Ask OCLC Linked Data and VIAF for a sort name."""
         # Looking in the database didn't work. Let's ask OCLC
         # Linked Data about this ISBN and see if it gives us an
         # author.
-        uris = None
-        if identifier:
-            sort_name, uris = self.sort_name_from_oclc_linked_data(
-                identifier, display_name)
+        sort_name = self._sort_name_from_oclc(
+            identifier, display_name, known_titles
+        )
         if sort_name:
             return sort_name
 
-        # Nope. If OCLC Linked Data gave us any VIAF IDs, look them up
-        # and see if we can get a sort name out of them.
-        if uris:
-            for uri in uris:
-                m = self.VIAF_ID.search(uri)
-                if m:
-                    viaf_id = m.groups()[0]
-                    contributor_data = self.viaf.lookup_by_viaf(
-                        viaf_id, working_display_name=display_name
-                    )[0]
-                    if contributor_data.sort_name:
-                        return sort_name
-
         # Nope. If we were given a display name, let's ask VIAF about it
         # and see what it says.
-        if display_name:
-            sort_name = self.sort_name_from_viaf(display_name, known_titles)
+        return self._sort_name_from_viaf_search(
+            identifier, display_name, known_titles
+        )
 
-        return sort_name
+    def _canonicalize_externally_before(self, identifier, display_name,
+                                        known_titles, deadline_at):
+        """Ask OCLC Linked Data and VIAF for a sort name at the same time.
+
+        OCLC's answer is preferred over VIAF's, but if OCLC hasn't
+        answered by `deadline_at` we'll take whatever VIAF said.
+
+        :return: A sort name, or None if neither knows the name.
+        :raise CanonicalizationTimeout: If neither answered in time,
+            or the thread pool is too busy to ask them.
+        """
+        if time.time() >= deadline_at:
+            raise CanonicalizationTimeout("Deadline passed before lookup.")
+        identifier_id = identifier and identifier.id
+        pool = self.thread_pool()
+        strategies = []
+        for method_name in (
+            '_sort_name_from_oclc', '_sort_name_from_viaf_search'
+        ):
+            if not self._pending_lookups.acquire(False):
+                # The pool is backed up. Shed this lookup rather than
+                # queue it.
+                continue
+            strategies.append(pool.apply_async(
+                self._run_before,
+                (deadline_at, method_name, identifier_id, display_name,
+                 known_titles)
+            ))
+        if not strategies:
+            raise CanonicalizationTimeout(
+                "Too many lookups in progress to ask OCLC or VIAF."
+            )
+
+        # Wait for the strategies in order of preference.
+        for strategy in strategies:
+            try:
+                sort_name = strategy.get(max(deadline_at - time.time(), 0))
+            except TimeoutError:
+                break
+            except Exception, e:
+                # This strategy failed, and the error has been logged.
+                # Move on to the next one.
+                continue
+            if sort_name:
+                return sort_name
+
+        # We ran out of time. Maybe a less preferred strategy came
+        # through anyway.
+        for strategy in strategies:
+            if strategy.ready() and strategy.successful():
+                sort_name = strategy.get()
+                if sort_name:
+                    return sort_name
+        if all(strategy.ready() for strategy in strategies):
+            # Everyone answered, and nobody knows this name.
+            return None
+        raise CanonicalizationTimeout(
+            "Ran out of time canonicalizing %s/%s" % (display_name, identifier)
+        )
+
+    def _run_before(self, deadline_at, method_name, *args):
+        """Run a lookup in a worker thread, unless it waited in the
+        queue until after the deadline.
+
+        A running lookup can't be cancelled, but one nobody is waiting
+        for anymore can be skipped.
+        """
+        try:
+            if time.time() >= deadline_at:
+                raise CanonicalizationTimeout(
+                    "Skipped %s: deadline passed while queued." % method_name
+                )
+            return self._run_in_own_session(method_name, *args)
+        finally:
+            self._pending_lookups.release()
+
+    def _sort_name_from_oclc(self, identifier, display_name, known_titles):
+        """Look for a sort name in OCLC Linked Data, or in the VIAF
+        records OCLC Linked Data links to.
+        """
+        if not identifier:
+            return None
+        sort_name, uris = self.sort_name_from_oclc_linked_data(
+            identifier, display_name)
+        if sort_name:
+            return sort_name
+
+        # Nope. If OCLC Linked Data gave us any VIAF IDs, look them up
+        # and see if we can get a sort name out of them.
+        for uri in uris or []:
+            m = self.VIAF_ID.search(uri)
+            if m:
+                viaf_id = m.groups()[0]
+                contributor_data = self.viaf.lookup_by_viaf(
+                    viaf_id, working_display_name=display_name
+                )[0]
+                if contributor_data.sort_name:
+                    return contributor_data.sort_name
+        return None
+
+    def _sort_name_from_viaf_search(self, identifier, display_name,
+                                    known_titles):
+        """Search VIAF for the display name."""
+        if not display_name:
+            return None
+        return self.sort_name_from_viaf(display_name, known_titles)
 
 
     def sort_name_from_oclc_linked_data(
@@ -263,8 +1057,8 @@ class AuthorNameCanonicalizer(object):
 
 class MockAuthorNameCanonicalizer(AuthorNameCanonicalizer):
 
-    def __init__(self, _db, oclcld=None, viaf=None):
-        super(MockAuthorNameCanonicalizer, self).__init__(_db)
+    def __init__(self, _db, oclcld=None, viaf=None, **kwargs):
+        super(MockAuthorNameCanonicalizer, self).__init__(_db, **kwargs)
         self._db = _db
         self.viaf = viaf or MockVIAFClient(_db)
         self.oclcld = oclcld or MockOCLCLinkedData(_db)
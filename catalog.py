@@ -0,0 +1,593 @@
+"""Make bulk changes to a Collection's catalog."""
+from nose.tools import set_trace
+from collections import defaultdict
+import datetime
+import logging
+
+from sqlalchemy import (
+    and_,
+    BigInteger,
+    Column,
+    DateTime,
+    DDL,
+    event,
+    ForeignKey,
+    Index,
+    Integer,
+    or_,
+    select,
+    Table,
+    Unicode,
+    UniqueConstraint,
+)
+from sqlalchemy.dialects.postgresql import insert
+
+from core.model import (
+    Base,
+    Collection,
+    CoverageRecord,
+    Identifier,
+    collections_identifiers,
+)
+from core.util.opds_writer import OPDSMessage
+from core.problem_details import INVALID_URN
+
+HTTP_OK = 200
+HTTP_CREATED = 201
+HTTP_NOT_FOUND = 404
+
+
+class CatalogUpdater(object):
+    """Add identifiers to, or remove them from, a Collection's catalog,
+    many at a time.
+    """
+
+    def __init__(self, _db):
+        self._db = _db
+
+    def add(self, collection, urns):
+        """Add the identifiers named by a list of URNs to a catalog.
+
+        :return: A list of OPDSMessages, one per URN.
+        """
+        identifiers_by_urn = self.identifiers_for_urns(urns)
+        catalogued = self.catalogued_identifier_ids(
+            collection, identifiers_by_urn.values()
+        )
+
+        messages = []
+        to_add = set()
+        for urn in urns:
+            identifier = identifiers_by_urn.get(urn)
+            if not identifier:
+                message = OPDSMessage(
+                    urn, INVALID_URN.status_code, INVALID_URN.detail
+                )
+            else:
+                status = HTTP_OK
+                description = "Already in catalog"
+
+                if identifier.id not in catalogued:
+                    catalogued.add(identifier.id)
+                    to_add.add(identifier.id)
+                    status = HTTP_CREATED
+                    description = "Successfully added"
+
+                message = OPDSMessage(urn, status, description)
+
+            messages.append(message)
+
+        self._insert(collection, to_add)
+        return messages
+
+    def catalog_identifiers(self, collection, identifiers):
+        """Add Identifiers to a catalog, skipping any that are already
+        there.
+
+        :return: The IDs of the Identifiers that weren't there.
+        """
+        catalogued = self.catalogued_identifier_ids(collection, identifiers)
+        to_add = set(x.id for x in identifiers) - catalogued
+        self._insert(collection, to_add)
+        return to_add
+
+    def _insert(self, collection, identifier_ids):
+        if not identifier_ids:
+            return
+        # Another request may have catalogued some of these since we
+        # checked. They're skipped, rather than failing the batch.
+        self._db.execute(
+            insert(collections_identifiers).on_conflict_do_nothing(), [
+                dict(collection_id=collection.id, identifier_id=x)
+                for x in identifier_ids
+            ]
+        )
+        self._db.expire(collection, ['catalog'])
+
+    def remove(self, collection, urns):
+        """Remove the identifiers named by a list of URNs from a catalog.
+
+        :return: A list of OPDSMessages, one per URN.
+        """
+        identifiers_by_urn = self.identifiers_for_urns(urns)
+        catalogued = self.catalogued_identifier_ids(
+            collection, identifiers_by_urn.values()
+        )
+
+        messages = []
+        to_remove = set()
+        for urn in urns:
+            identifier = identifiers_by_urn.get(urn)
+            if not identifier:
+                message = OPDSMessage(
+                    urn, INVALID_URN.status_code, INVALID_URN.detail
+                )
+            else:
+                if identifier.id in catalogued:
+                    catalogued.remove(identifier.id)
+                    to_remove.add(identifier.id)
+                    message = OPDSMessage(
+                        urn, HTTP_OK, "Successfully removed"
+                    )
+                else:
+                    message = OPDSMessage(
+                        urn, HTTP_NOT_FOUND, "Not in catalog"
+                    )
+
+            messages.append(message)
+
+        if to_remove:
+            table = collections_identifiers
+            self._db.execute(
+                table.delete().where(
+                    table.c.collection_id==collection.id
+                ).where(
+                    table.c.identifier_id.in_(to_remove)
+                )
+            )
+            self._db.expire(collection, ['catalog'])
+        return messages
+
+    # for_foreign_id changes identifiers of these types (by lowercasing
+    # them) before looking them up or storing them, so new ones go
+    # through it instead of being created in bulk.
+    NORMALIZED_TYPES = (Identifier.OVERDRIVE_ID, Identifier.THREEM_ID)
+
+    def identifiers_for_urns(self, urns):
+        """Find or create an Identifier for each of a list of URNs.
+
+        Existing identifiers are found with one query per identifier
+        type, and new ones are created with one INSERT per type,
+        rather than one query per URN.
+
+        :return: A dictionary mapping each valid URN to its Identifier.
+        """
+        parsed = dict()
+        by_type = defaultdict(set)
+        for urn in set(urns):
+            try:
+                type, identifier = Identifier.type_and_identifier_for_urn(urn)
+            except Exception as e:
+                continue
+            parsed[urn] = (type, identifier)
+            by_type[type].add(identifier)
+
+        found = dict()
+        for type, values in by_type.items():
+            qu = self._db.query(Identifier).filter(
+                Identifier.type==type
+            ).filter(Identifier.identifier.in_(values))
+            for identifier in qu:
+                found[(identifier.type, identifier.identifier)] = identifier
+
+        for type, values in by_type.items():
+            if type in self.NORMALIZED_TYPES:
+                continue
+            missing = values - set(
+                value for (t, value) in found if t == type
+            )
+            found.update(self._create_identifiers(type, missing))
+
+        identifiers_by_urn = dict()
+        for urn, key in parsed.items():
+            identifier = found.get(key)
+            if not identifier:
+                # This is either a new identifier, or one that's
+                # stored in a normalized form. for_foreign_id knows
+                # how to handle both.
+                try:
+                    identifier, ignore = Identifier.for_foreign_id(
+                        self._db, *key
+                    )
+                except Exception as e:
+                    continue
+                found[key] = identifier
+            if identifier:
+                identifiers_by_urn[urn] = identifier
+        return identifiers_by_urn
+
+    def _create_identifiers(self, type, values):
+        """Create Identifiers of one type in a single INSERT.
+
+        Identifiers that someone else creates in the meantime are
+        loaded instead.
+
+        :return: A dictionary mapping (type, identifier) to Identifier.
+        """
+        if not values:
+            return dict()
+        table = Identifier.__table__
+        rows = self._db.execute(
+            insert(table).values(
+                [dict(type=type, identifier=value) for value in values]
+            ).on_conflict_do_nothing(
+                index_elements=[table.c.type, table.c.identifier]
+            ).returning(table.c.id, table.c.identifier)
+        )
+        created = dict((value, id) for id, value in rows)
+        conflicts = set(values) - set(created)
+        clauses = []
+        if created:
+            clauses.append(Identifier.id.in_(created.values()))
+        if conflicts:
+            clauses.append(and_(Identifier.type==type,
+                                Identifier.identifier.in_(conflicts)))
+        qu = self._db.query(Identifier).filter(or_(*clauses))
+        return dict(((x.type, x.identifier), x) for x in qu)
+
+    def catalogued_identifier_ids(self, collection, identifiers):
+        """Find which of the given identifiers are in a collection's
+        catalog, without loading the whole catalog.
+
+        :return: A set of Identifier IDs.
+        """
+        ids = set(x.id for x in identifiers)
+        if not ids:
+            return set()
+        table = collections_identifiers
+        rows = self._db.execute(
+            select([table.c.identifier_id]).where(
+                table.c.collection_id==collection.id
+            ).where(
+                table.c.identifier_id.in_(ids)
+            )
+        )
+        return set(identifier_id for (identifier_id,) in rows)
+
+
+# The time of each Work's latest update: the most recent timestamp of
+# any of its WorkCoverageRecords. A trigger on workcoveragerecords keeps
+# it up to date, so an updates feed can page through a catalog in
+# update order with an index, rather than aggregating the coverage
+# records of every work in the catalog. See
+# migration/20261018-5-create-work-update-times.sql.
+work_update_time_table = Table(
+    'workupdatetimes', Base.metadata,
+    Column('work_id', Integer, ForeignKey('works.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('last_update', DateTime, nullable=False),
+    Index('ix_workupdatetimes_last_update_work_id', 'last_update', 'work_id'),
+)
+
+# The trigger needs workcoveragerecords to exist, so it's created once
+# every table has been.
+event.listen(Base.metadata, 'after_create', DDL("""
+create or replace function record_work_update_time() returns trigger as $$
+declare
+    changed_work_id integer;
+begin
+    if tg_op = 'DELETE' then
+        changed_work_id := old.work_id;
+    else
+        changed_work_id := new.work_id;
+    end if;
+    insert into workupdatetimes (work_id, last_update)
+        select changed_work_id, max(timestamp) from workcoveragerecords
+        where work_id = changed_work_id
+        having max(timestamp) is not null
+        on conflict (work_id) do update
+        set last_update = excluded.last_update;
+    if not found then
+        delete from workupdatetimes where work_id = changed_work_id;
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists record_work_update_time on workcoveragerecords;
+create trigger record_work_update_time
+    after insert or update or delete on workcoveragerecords
+    for each row execute procedure record_work_update_time();
+"""))
+
+# A counter for each collection that goes up whenever its catalog
+# changes, so the updates feed can tell whether a catalog has changed
+# without reading it. It's kept by a trigger, so catalog changes made
+# through the ORM count too. See
+# migration/20261018-7-create-catalog-versions.sql.
+catalog_version_table = Table(
+    'catalogversions', Base.metadata,
+    Column('collection_id', Integer,
+           ForeignKey('collections.id', ondelete='CASCADE'),
+           primary_key=True),
+    Column('version', BigInteger, nullable=False),
+)
+
+event.listen(Base.metadata, 'after_create', DDL("""
+create or replace function record_catalog_change() returns trigger as $$
+begin
+    if tg_op <> 'INSERT' then
+        insert into catalogversions (collection_id, version)
+            values (old.collection_id, 1)
+            on conflict (collection_id) do update
+            set version = catalogversions.version + 1;
+    end if;
+    if tg_op <> 'DELETE' then
+        insert into catalogversions (collection_id, version)
+            values (new.collection_id, 1)
+            on conflict (collection_id) do update
+            set version = catalogversions.version + 1;
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists record_catalog_change on collectionsidentifiers;
+create trigger record_catalog_change
+    after insert or update or delete on collectionsidentifiers
+    for each row execute procedure record_catalog_change();
+"""))
+
+
+# The unique constraint on coveragerecords includes collection_id, and
+# Postgres never treats two NULLs as equal, so it doesn't stop a
+# record without a collection from being created twice. This index
+# does, and gives INSERT ... ON CONFLICT something to check against.
+# See migration/20261018-6-index-unique-coverage-records.sql.
+_coverage_records = CoverageRecord.__table__
+Index(
+    'ix_coveragerecords_identifier_data_source_operation_no_collection',
+    _coverage_records.c.identifier_id, _coverage_records.c.data_source_id,
+    _coverage_records.c.operation, unique=True,
+    postgresql_where=(_coverage_records.c.collection_id==None),
+)
+
+
+# Storage for CatalogRegistrationJobs. See
+# migration/20261018-4-create-catalog-jobs.sql.
+catalog_job_table = Table(
+    'catalogjobs', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('collection_id', Integer, ForeignKey('collections.id'),
+           nullable=False, index=True),
+    Column('integration_client_id', Integer,
+           ForeignKey('integrationclients.id'), nullable=False),
+    Column('total', Integer, nullable=False),
+    Column('processed', Integer, nullable=False),
+    Column('created', DateTime, nullable=False),
+    Column('finished', DateTime, index=True),
+    # Why the job stopped before all its URNs were processed.
+    Column('error', Unicode),
+)
+
+# The URNs to add, one row each, so a chunk can be read without
+# reading the rest.
+catalog_job_urn_table = Table(
+    'catalogjoburns', Base.metadata,
+    Column('job_id', Integer, ForeignKey('catalogjobs.id'),
+           primary_key=True),
+    Column('position', Integer, primary_key=True),
+    Column('urn', Unicode, nullable=False),
+)
+
+catalog_job_result_table = Table(
+    'catalogjobresults', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('job_id', Integer, ForeignKey('catalogjobs.id'), nullable=False),
+    Column('position', Integer, nullable=False),
+    Column('urn', Unicode, nullable=False),
+    Column('status_code', Integer, nullable=False),
+    Column('message', Unicode),
+    UniqueConstraint('job_id', 'position'),
+)
+
+
+class CatalogRegistrationJob(object):
+    """A list of URNs to be added to a catalog in the background, a
+    chunk at a time, because it's too big to handle in one request.
+    """
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self, _db, id, collection_id, integration_client_id,
+                 total, processed, created, finished, error=None):
+        self._db = _db
+        self.id = id
+        self.collection_id = collection_id
+        self.integration_client_id = integration_client_id
+        self.total = total
+        self.processed = processed
+        self.created = created
+        self.finished = finished
+        self.error = error
+
+    @classmethod
+    def create(cls, _db, collection, client, urns):
+        """Create a job to add `urns` to `collection`'s catalog.
+
+        :param urns: An iterable of URNs. It's read once, and stored a
+            chunk at a time, so it can be a stream too big to hold in
+            memory.
+        """
+        now = datetime.datetime.utcnow()
+        result = _db.execute(
+            catalog_job_table.insert().values(
+                collection_id=collection.id,
+                integration_client_id=client.id,
+                total=0, processed=0, created=now, finished=None,
+            ).returning(catalog_job_table.c.id)
+        )
+        [job_id] = result.first()
+
+        total = 0
+        rows = []
+        for urn in urns:
+            urn = urn.strip()
+            if not urn:
+                continue
+            rows.append(dict(job_id=job_id, position=total, urn=urn))
+            total += 1
+            if len(rows) >= cls.CHUNK_SIZE:
+                _db.execute(catalog_job_urn_table.insert(), rows)
+                rows = []
+        if rows:
+            _db.execute(catalog_job_urn_table.insert(), rows)
+
+        finished = None
+        if not total:
+            # There's nothing to do.
+            finished = now
+        _db.execute(
+            catalog_job_table.update().where(
+                catalog_job_table.c.id==job_id
+            ).values(total=total, finished=finished)
+        )
+        return cls(
+            _db, job_id, collection.id, client.id, total, 0, now, finished
+        )
+
+    @classmethod
+    def _from_row(cls, _db, row):
+        return cls(
+            _db, row.id, row.collection_id, row.integration_client_id,
+            row.total, row.processed, row.created, row.finished, row.error
+        )
+
+    @classmethod
+    def for_client(cls, _db, job_id, collection, client):
+        """Find a job, as long as it belongs to the given collection
+        and client.
+        """
+        table = catalog_job_table
+        row = _db.execute(
+            table.select().where(table.c.id==job_id).where(
+                table.c.collection_id==collection.id).where(
+                    table.c.integration_client_id==client.id)
+        ).first()
+        if not row:
+            return None
+        return cls._from_row(_db, row)
+
+    @classmethod
+    def next_unfinished(cls, _db):
+        """Find the oldest job that's not finished yet."""
+        table = catalog_job_table
+        row = _db.execute(
+            table.select().where(table.c.finished==None).order_by(
+                table.c.created, table.c.id).limit(1)
+        ).first()
+        if not row:
+            return None
+        return cls._from_row(_db, row)
+
+    @classmethod
+    def run_all(cls, _db, chunk_size=None):
+        """Work through every unfinished job.
+
+        If a chunk fails, its changes are rolled back and the job is
+        finished with an error, so it doesn't hold up the jobs after
+        it.
+
+        This assumes there is only one process doing this at a time.
+        """
+        log = logging.getLogger("Catalog registration jobs")
+        job = cls.next_unfinished(_db)
+        while job:
+            while not job.finished:
+                try:
+                    job.process_chunk(chunk_size)
+                    _db.commit()
+                except Exception, e:
+                    _db.rollback()
+                    log.exception(
+                        "Error in job %d after %d of %d URNs.",
+                        job.id, job.processed, job.total
+                    )
+                    job.fail(unicode(e))
+                    _db.commit()
+            log.info(
+                "%s job %d: %d of %d URNs for collection %d.",
+                "Gave up on" if job.error else "Finished",
+                job.id, job.processed, job.total, job.collection_id
+            )
+            job = cls.next_unfinished(_db)
+
+    def fail(self, error):
+        """Stop working on this job, recording why."""
+        self.error = error
+        self.finished = datetime.datetime.utcnow()
+        self._db.execute(
+            catalog_job_table.update().where(
+                catalog_job_table.c.id==self.id
+            ).values(error=self.error, finished=self.finished)
+        )
+
+    def _urns(self, offset=0, size=None):
+        table = catalog_job_urn_table
+        qu = select([table.c.urn]).where(table.c.job_id==self.id).where(
+            table.c.position >= offset).order_by(table.c.position)
+        if size:
+            qu = qu.limit(size)
+        return [urn for (urn,) in self._db.execute(qu)]
+
+    @property
+    def urns(self):
+        return self._urns()
+
+    def process_chunk(self, chunk_size=None):
+        """Add the next chunk of URNs to the catalog and record the
+        results.
+        """
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        start = self.processed
+        urns = self._urns(start, chunk_size)
+        collection = self._db.query(Collection).get(self.collection_id)
+        messages = CatalogUpdater(self._db).add(collection, urns)
+        if messages:
+            self._db.execute(catalog_job_result_table.insert(), [
+                dict(job_id=self.id, position=start+i, urn=message.urn,
+                     status_code=message.status_code,
+                     message=message.message)
+                for i, message in enumerate(messages)
+            ])
+
+        processed = start + len(urns)
+        if not urns:
+            # There's nothing left, whatever the count says.
+            processed = self.total
+        values = dict(processed=processed)
+        finished = None
+        if processed >= self.total:
+            finished = datetime.datetime.utcnow()
+            values['finished'] = finished
+        self._db.execute(
+            catalog_job_table.update().where(
+                catalog_job_table.c.id==self.id
+            ).values(**values)
+        )
+        # Only update this object once the database has been, so a
+        # failed chunk can be tried again or recorded accurately.
+        self.processed = processed
+        self.finished = finished
+
+    def results(self, offset=0, size=None):
+        """The OPDSMessages for the URNs processed so far."""
+        table = catalog_job_result_table
+        qu = select([table]).where(table.c.job_id==self.id).where(
+            table.c.position >= offset).order_by(table.c.position)
+        if size:
+            qu = qu.limit(size)
+        return [
+            OPDSMessage(row.urn, row.status_code, row.message)
+            for row in self._db.execute(qu)
+        ]
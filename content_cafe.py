@@ -1,9 +1,18 @@
 from collections import Counter
 import datetime
+import re
 import requests
 import logging
+import threading
+from multiprocessing.pool import ThreadPool
 from nose.tools import set_trace
-from bs4 import BeautifulSoup
+import numpy
+from lxml import (
+    etree,
+    html,
+)
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from suds.client import Client as SudsClient
 
 # Tone down the verbose Suds logging.
@@ -77,6 +86,23 @@ class ContentCafeAPI(object):
 
     log = logging.getLogger("Content Cafe API")
 
+    # The number of requests about a single ISBN that may be made at
+    # once.
+    CONCURRENCY = 5
+
+    # Configuration of the HTTP connection pool, which can be
+    # overridden by settings on the Content Cafe ExternalIntegration.
+    POOL_SIZE = "http_pool_size"
+    MAX_RETRIES = "http_max_retries"
+    BACKOFF_FACTOR = "http_backoff_factor"
+
+    DEFAULT_POOL_SIZE = CONCURRENCY
+    DEFAULT_MAX_RETRIES = 3
+    DEFAULT_BACKOFF_FACTOR = 0.5
+
+    # Retry a request that gets one of these status codes.
+    RETRY_STATUS_CODES = [500, 502, 503, 504]
+
     @classmethod
     def from_config(cls, _db, mirror, **kwargs):
         integration = ExternalIntegration.lookup(
@@ -87,13 +113,51 @@ class ContentCafeAPI(object):
         if not integration or not (integration.username and integration.password):
             raise CannotLoadConfiguration('Content Cafe not properly configured')
 
+        if not kwargs.get('http'):
+            kwargs['http'] = cls.http_session(
+                pool_size=integration.setting(cls.POOL_SIZE).int_value,
+                max_retries=integration.setting(cls.MAX_RETRIES).int_value,
+                backoff_factor=integration.setting(
+                    cls.BACKOFF_FACTOR).float_value,
+            )
+
         return cls(
             _db, mirror, integration.username, integration.password,
             **kwargs
         )
 
+    @classmethod
+    def http_session(cls, pool_size=None, max_retries=None,
+                     backoff_factor=None):
+        """Create a requests Session for talking to Content Cafe.
+
+        The Session keeps connections alive between requests, holds at
+        most `pool_size` connections to any one host, and retries
+        requests that fail with a connection error or a server error,
+        waiting longer between each try.
+        """
+        if pool_size is None:
+            pool_size = cls.DEFAULT_POOL_SIZE
+        if max_retries is None:
+            max_retries = cls.DEFAULT_MAX_RETRIES
+        if backoff_factor is None:
+            backoff_factor = cls.DEFAULT_BACKOFF_FACTOR
+
+        retry = Retry(
+            total=max_retries, backoff_factor=backoff_factor,
+            status_forcelist=cls.RETRY_STATUS_CODES
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            pool_block=True, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
     def __init__(self, _db, mirror, user_id, password, uploader=None,
-                 soap_client=None):
+                 soap_client=None, http=None):
         self._db = _db
 
         self.mirror = mirror
@@ -108,6 +172,18 @@ class ContentCafeAPI(object):
             soap_client or ContentCafeSOAPClient(user_id, password)
         )
 
+        # This Session is shared by every request this object makes, so
+        # a coverage provider reuses the same connections for its
+        # whole run.
+        self.http = http or self.http_session()
+        self._thread_pool = None
+
+    @property
+    def thread_pool(self):
+        if not self._thread_pool:
+            self._thread_pool = ThreadPool(self.CONCURRENCY)
+        return self._thread_pool
+
     @property
     def data_source(self):
         return DataSource.lookup(self._db, DataSource.CONTENT_CAFE)
@@ -129,28 +205,59 @@ class ContentCafeAPI(object):
             # requests.
             return True
 
-        self.mirror.uploader.mirror_one(representation)
+        # Content Cafe knows about this ISBN. Start asking it for
+        # everything else while we take care of the cover image.
+        pool = self.thread_pool
+        responses = dict()
+        for url in (self.summary_url, self.excerpt_url, self.review_url,
+                    self.author_notes_url):
+            responses[url] = pool.apply_async(self.fetch, (url % args,))
+        # Popularity is estimated the same way the popularity sweep
+        # does it, so the two don't keep replacing each other's
+        # measurements.
+        popularity = pool.apply_async(
+            self.soap_client.estimated_popularity, (isbn, self.ONE_YEAR_AGO)
+        )
+
+        self.mirror.mirror_batch([representation])
         self.scaler.scale_edition(isbn_identifier)
-        self.get_descriptions(isbn_identifier, args)
-        self.get_excerpt(isbn_identifier, args)
-        self.get_reviews(isbn_identifier, args)
-        self.get_author_notes(isbn_identifier, args)
-        self.measure_popularity(isbn_identifier, self.soap_client.ONE_YEAR_AGO)
+
+        # The database work has to happen in this thread, so wait for
+        # the responses to come in.
+        self.get_descriptions(
+            isbn_identifier, args, responses[self.summary_url].get()
+        )
+        self.get_excerpt(
+            isbn_identifier, args, responses[self.excerpt_url].get()
+        )
+        self.get_reviews(
+            isbn_identifier, args, responses[self.review_url].get()
+        )
+        self.get_author_notes(
+            isbn_identifier, args, responses[self.author_notes_url].get()
+        )
+        self.record_popularity(isbn_identifier, popularity.get())
+
+    def fetch(self, url):
+        self.log.debug("Getting associated resources for %s", url)
+        return self.http.get(url)
 
     def get_associated_web_resources(
             self, identifier, args, url,
             phrase_indicating_missing_data,
-            rel, scrape_method):
-        url = url % args
-        self.log.debug("Getting associated resources for %s", url)
-        response = requests.get(url)
-        content_type = response.headers['Content-Type']
+            rel, scrape_method, response=None):
+        """Scrape resources of one kind from a Content Cafe web page.
+
+        :param response: The page, if it's already been fetched.
+        """
+        if response is None:
+            response = self.fetch(url % args)
         hyperlinks = []
         already_seen = set()
         if not phrase_indicating_missing_data in response.content:
             self.log.info("Found %s %s Content!", identifier.identifier, rel)
-            soup = BeautifulSoup(response.content, "lxml")
-            resource_contents = scrape_method(soup)
+            document = self._parse(response.content)
+            resource_contents = scrape_method(document)
             if resource_contents:
                 for content in resource_contents:
                     if content in already_seen:
@@ -165,17 +272,17 @@ class ContentCafeAPI(object):
                         hyperlink.resource.representation.content[:75])
         return hyperlinks
 
-    def get_reviews(self, identifier, args):
+    def get_reviews(self, identifier, args, response=None):
         return self.get_associated_web_resources(
             identifier, args, self.review_url,
             'No review info exists for this item',
-            Hyperlink.REVIEW, self._scrape_list)
+            Hyperlink.REVIEW, self._scrape_list, response)
 
-    def get_descriptions(self, identifier, args):
+    def get_descriptions(self, identifier, args, response=None):
         hyperlinks = list(self.get_associated_web_resources(
             identifier, args, self.summary_url,
             'No annotation info exists for this item',
-            Hyperlink.DESCRIPTION, self._scrape_list))
+            Hyperlink.DESCRIPTION, self._scrape_list, response))
         if not hyperlinks:
             return hyperlinks
 
@@ -197,22 +304,92 @@ class ContentCafeAPI(object):
             resource.update_quality()
         return hyperlinks
 
-    def get_author_notes(self, identifier, args):
+    def get_author_notes(self, identifier, args, response=None):
         return self.get_associated_web_resources(
             identifier, args, self.author_notes_url,
             'No author notes info exists for this item',
-            Hyperlink.AUTHOR, self._scrape_one)
+            Hyperlink.AUTHOR, self._scrape_one, response)
 
-    def get_excerpt(self, identifier, args):
+    def get_excerpt(self, identifier, args, response=None):
         return self.get_associated_web_resources(
             identifier, args, self.excerpt_url,
             'No excerpt info exists for this item', Hyperlink.SAMPLE,
-            self._scrape_one)
+            self._scrape_one, response)
 
     def measure_popularity(self, identifier, cutoff=None):
         if identifier.type != Identifier.ISBN:
             raise Error("I can only measure the popularity of ISBNs.")
-        value = self.soap_client.estimated_popularity(identifier.identifier)
+        value = self.soap_client.estimated_popularity(
+            identifier.identifier, cutoff
+        )
+        return self.record_popularity(identifier, value)
+
+    def measure_popularities(self, identifiers, cutoff=None):
+        """Measure the popularity of a number of ISBNs, asking Content
+        Cafe about several of them at once.
+        """
+        for identifier in identifiers:
+            if identifier.type != Identifier.ISBN:
+                raise ValueError("I can only measure the popularity of ISBNs.")
+        popularities = self.soap_client.estimated_popularities(
+            [x.identifier for x in identifiers], cutoff
+        )
+        return self.record_popularities(
+            identifiers, [popularities[x.identifier] for x in identifiers]
+        )
+
+    def record_popularities(self, identifiers, values):
+        """Record popularity estimates for a number of identifiers at once.
+
+        The identifiers' current measurements are loaded with a single
+        query. If an estimate hasn't changed, the current measurement
+        is marked as taken now instead of being replaced, so measuring
+        the same books over and over doesn't grow the measurements
+        table. Otherwise a new measurement becomes the most recent one.
+
+        :return: The normalized values, in the same order as `identifiers`.
+        """
+        if not identifiers:
+            return []
+        data_source = self.data_source
+        current = dict()
+        qu = self._db.query(Measurement).filter(
+            Measurement.identifier_id.in_([x.id for x in identifiers])
+        ).filter(
+            Measurement.data_source_id==data_source.id
+        ).filter(
+            Measurement.quantity_measured==Measurement.POPULARITY
+        ).filter(
+            Measurement.is_most_recent==True
+        )
+        for measurement in qu:
+            current.setdefault(measurement.identifier_id, []).append(
+                measurement
+            )
+
+        now = datetime.datetime.utcnow()
+        normalized_values = []
+        for identifier, value in zip(identifiers, values):
+            previous = current.get(identifier.id, [])
+            unchanged = [x for x in previous if x.value == value]
+            if unchanged:
+                measurement = unchanged[0]
+                measurement.taken_at = now
+            else:
+                measurement = Measurement(
+                    identifier=identifier, data_source=data_source,
+                    quantity_measured=Measurement.POPULARITY, value=value,
+                    weight=1, taken_at=now, is_most_recent=True
+                )
+                self._db.add(measurement)
+            for old in previous:
+                if old is not measurement:
+                    old.is_most_recent = False
+            normalized_values.append(measurement.normalized_value)
+        return normalized_values
+
+    def record_popularity(self, identifier, value):
+        """Record a popularity estimate obtained from Content Cafe."""
         # Even a complete lack of popularity data is useful--it tells
         # us there's no need to check again anytime soon.
         measurement = identifier.add_measurement(
@@ -222,28 +399,154 @@ class ContentCafeAPI(object):
         # normalize the value.
         return measurement.normalized_value
 
+    # Content Cafe pages are UTF-8, but if a page turns out not to be,
+    # we fall back to Windows-1252.
+    UTF8_PARSER = html.HTMLParser(encoding="utf-8")
+    WINDOWS_1252_PARSER = html.HTMLParser(encoding="windows-1252")
+
+    MAIN_TABLE = etree.XPath("//table[@id='Table_Main']")
+    SECTION_HEADERS = etree.XPath(
+        ".//td[contains(concat(' ', normalize-space(@class), ' '), ' SectionHeader ')]"
+    )
+    FIRST_ROW = etree.XPath("(.//tr)[1]")
+    FIRST_CELL = etree.XPath("(.//td)[1]")
+
     @classmethod
-    def _scrape_list(cls, soup):
-        table = soup.find('table', id='Table_Main')
-        if table:
-            for header in table.find_all('td', class_='SectionHeader'):
-                content = header.parent.next_sibling
-                if content.name != 'tr':
+    def _parse(cls, content):
+        parser = cls.UTF8_PARSER
+        try:
+            content.decode("utf8")
+        except UnicodeDecodeError:
+            parser = cls.WINDOWS_1252_PARSER
+        return html.fromstring(content, parser=parser)
+
+    @classmethod
+    def _scrape_list(cls, document):
+        for table in cls.MAIN_TABLE(document)[:1]:
+            for header in cls.SECTION_HEADERS(table):
+                row = header.getparent()
+                if row.tail:
+                    # The next thing after this row is text, not
+                    # the row with the content in it.
                     continue
-                if not content.td:
+                content = row.getnext()
+                if content is None or content.tag != 'tr':
                     continue
-                yield content.td.encode_contents()
+                cells = cls.FIRST_CELL(content)
+                if not cells:
+                    continue
+                yield cls._inner_html(cells[0])
 
     @classmethod
-    def _scrape_one(cls, soup):
-        table = soup.find('table', id='Table_Main')
-        if not table:
+    def _scrape_one(cls, document):
+        tables = cls.MAIN_TABLE(document)
+        if not tables:
             return []
-        if table.tr and table.tr.td:
-            return [table.tr.td.encode_contents()]
+        rows = cls.FIRST_ROW(tables[0])
+        cells = rows and cls.FIRST_CELL(rows[0])
+        if cells:
+            return [cls._inner_html(cells[0])]
         else:
             return []
 
+    # We used to scrape Content Cafe with BeautifulSoup. _inner_html
+    # serializes HTML the same way BeautifulSoup did, so that newly
+    # scraped resources match the ones we already have.
+    VOID_ELEMENTS = set([
+        'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command',
+        'embed', 'frame', 'hr', 'image', 'img', 'input', 'isindex',
+        'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param',
+        'source', 'spacer', 'track', 'wbr',
+    ])
+    PRESERVE_WHITESPACE_ELEMENTS = set(['pre', 'textarea'])
+    ALL_WHITESPACE = re.compile(u"^[ \n\t\f\r]+$")
+    MULTI_VALUED_ATTRIBUTES = {
+        '*' : ['class', 'accesskey', 'dropzone'],
+        'a' : ['rel', 'rev'],
+        'link' : ['rel', 'rev'],
+        'area' : ['rel'],
+        'td' : ['headers'],
+        'th' : ['headers'],
+    }
+
+    @classmethod
+    def _inner_html(cls, element):
+        """Serialize everything inside an lxml element as UTF-8 HTML."""
+        preserve_whitespace = any(
+            x.tag in cls.PRESERVE_WHITESPACE_ELEMENTS
+            for x in element.iterancestors()
+        )
+        parts = []
+        cls._serialize_contents(element, parts, preserve_whitespace)
+        return u"".join(parts).encode("utf8")
+
+    @classmethod
+    def _serialize_contents(cls, element, parts, preserve_whitespace):
+        preserve_whitespace = (
+            preserve_whitespace
+            or element.tag in cls.PRESERVE_WHITESPACE_ELEMENTS
+        )
+        cls._serialize_text(element.text, parts, preserve_whitespace)
+        for child in element:
+            cls._serialize_element(child, parts, preserve_whitespace)
+            cls._serialize_text(child.tail, parts, preserve_whitespace)
+
+    @classmethod
+    def _serialize_text(cls, text, parts, preserve_whitespace):
+        if not text:
+            return
+        if not preserve_whitespace and cls.ALL_WHITESPACE.match(text):
+            if u"\n" in text:
+                text = u"\n"
+            else:
+                text = u" "
+        parts.append(cls._escape(text))
+
+    @classmethod
+    def _serialize_element(cls, element, parts, preserve_whitespace):
+        if element.tag is etree.Comment:
+            parts.append(u"<!--%s-->" % element.text)
+            return
+        if not isinstance(element.tag, basestring):
+            parts.append(
+                etree.tostring(element, encoding=unicode, with_tail=False)
+            )
+            return
+
+        tag = element.tag
+        multi_valued = (
+            cls.MULTI_VALUED_ATTRIBUTES['*']
+            + cls.MULTI_VALUED_ATTRIBUTES.get(tag, [])
+        )
+        attributes = []
+        for name, value in sorted(element.items()):
+            if name in multi_valued:
+                value = u" ".join(value.split())
+            attributes.append(u" %s=%s" % (name, cls._quote(value)))
+        start = u"<%s%s" % (tag, u"".join(attributes))
+
+        if (tag in cls.VOID_ELEMENTS and not element.text
+            and not len(element)):
+            parts.append(start + u"/>")
+            return
+        parts.append(start + u">")
+        cls._serialize_contents(element, parts, preserve_whitespace)
+        parts.append(u"</%s>" % tag)
+
+    @classmethod
+    def _escape(cls, text):
+        return text.replace(u"&", u"&amp;").replace(
+            u"<", u"&lt;").replace(u">", u"&gt;")
+
+    @classmethod
+    def _quote(cls, value):
+        value = cls._escape(value)
+        if u'"' not in value:
+            return u'"%s"' % value
+        if u"'" not in value:
+            return u"'%s'" % value
+        return u'"%s"' % value.replace(u'"', u"&quot;")
+
 class ContentCafeSOAPError(IOError):
     pass
 
@@ -255,11 +558,31 @@ class ContentCafeSOAPClient(object):
 
     ONE_YEAR_AGO = datetime.timedelta(days=365)
 
+    # The most keys we'll ask about in a single request.
+    MAX_KEYS_PER_REQUEST = 25
+
+    # Parsed WSDL documents, shared by every client in this process.
+    _suds_clients = dict()
+    _suds_clients_lock = threading.Lock()
+
     def __init__(self, user_id, password, wsdl_url=None):
         wsdl_url = wsdl_url or self.WSDL_URL
         self.user_id=user_id
         self.password = password
-        self.soap = SudsClient(wsdl_url)
+        self.soap = self.suds_client(wsdl_url)
+
+    @classmethod
+    def suds_client(cls, wsdl_url):
+        """Get a SOAP client for the service described by `wsdl_url`.
+
+        Downloading and parsing the WSDL is slow, so it only happens
+        once per process. Each caller gets a clone of the original
+        client, which shares its parsed WSDL but nothing else.
+        """
+        with cls._suds_clients_lock:
+            if wsdl_url not in cls._suds_clients:
+                cls._suds_clients[wsdl_url] = SudsClient(wsdl_url)
+            return cls._suds_clients[wsdl_url].clone()
 
     def get_content(self, key, content):
         data = self.soap.service.Single(
@@ -270,14 +593,67 @@ class ContentCafeSOAPClient(object):
         else:
             return data
 
+    def get_content_for_keys(self, keys, content):
+        """Ask for the same kind of content about several keys in one
+        XmlClass request.
+
+        :return: The response, whose RequestItems correspond, in order,
+            to `keys`.
+        """
+        factory = self.soap.factory
+        request = factory.create('ContentCafe')
+        request.RequestItems = factory.create('RequestItems')
+        request.RequestItems.UserID = self.user_id
+        request.RequestItems.Password = self.password
+        request.RequestItems.RequestItem = []
+        for key in keys:
+            item = factory.create('RequestItem')
+            item.Key = key
+            item.Content = [content]
+            request.RequestItems.RequestItem.append(item)
+        data = self.soap.service.XmlClass(request)
+        if hasattr(data, 'Error'):
+            raise ContentCafeSOAPError(data.Error)
+        else:
+            return data
+
     def estimated_popularity(self, key, cutoff=None):
         data = self.get_content(key, self.DEMAND_HISTORY)
         gathered = self.gather_popularity(data)
         return self.estimate_popularity(gathered, cutoff)
 
+    def estimated_popularities(self, keys, cutoff=None):
+        """Estimate the popularity of a number of ISBNs, asking about
+        several of them in each request.
+
+        :return: A dictionary mapping each key to its estimated popularity.
+        """
+        gathered = []
+        for i in range(0, len(keys), self.MAX_KEYS_PER_REQUEST):
+            batch = keys[i:i+self.MAX_KEYS_PER_REQUEST]
+            data = self.get_content_for_keys(batch, self.DEMAND_HISTORY)
+            request_items = data.RequestItems.RequestItem
+            if len(request_items) != len(batch):
+                raise ContentCafeSOAPError(
+                    "Asked about %d keys, got answers about %d." % (
+                        len(batch), len(request_items)
+                    )
+                )
+            gathered.extend(
+                self.gather_item_popularity(x) for x in request_items
+            )
+        return dict(zip(keys, self.estimate_popularities(gathered, cutoff)))
+
     def gather_popularity(self, detail):
-        by_year_and_month = Counter()
         [request_item] = detail.RequestItems.RequestItem
+        return self.gather_item_popularity(request_item)
+
+    def gather_item_popularity(self, request_item):
+        """Total up the demand for one key, by month."""
+        by_year_and_month = Counter()
+        if hasattr(request_item, 'Error'):
+            # Content Cafe couldn't tell us about this key.
+            return None
         items = request_item.DemandHistoryItems
         if items == '':
             # This ISBN is completely unknown.
@@ -313,3 +689,73 @@ class ContentCafeSOAPClient(object):
             return max(lifetime) * 0.5
         else:
             return None
+
+    def estimate_popularities(self, histories, cutoff=None):
+        """Estimate the popularity of many books at once.
+
+        This gives the same answers as calling estimate_popularity on
+        each item of `histories`, but does the arithmetic on arrays.
+
+        :param histories: A list of Counters (or Nones), as returned by
+            gather_item_popularity.
+        :return: A list of popularity estimates, in the same order.
+        """
+        estimates = [None] * len(histories)
+        if isinstance(cutoff, datetime.timedelta):
+            cutoff = datetime.date.today() - cutoff
+
+        # Flatten all the histories into parallel arrays.
+        books = []
+        months = []
+        demands = []
+        for i, by_year_and_month in enumerate(histories):
+            if not by_year_and_month:
+                continue
+            for month, demand in by_year_and_month.items():
+                books.append(i)
+                months.append(month.toordinal())
+                demands.append(demand)
+        if not demands:
+            return estimates
+        books = numpy.array(books)
+        demands = numpy.array(demands, dtype=float)
+
+        lifetime = numpy.full(len(histories), -numpy.inf)
+        numpy.maximum.at(lifetime, books, demands)
+        if cutoff:
+            is_recent = numpy.array(months) >= cutoff.toordinal()
+            recent = numpy.full(len(histories), -numpy.inf)
+            numpy.maximum.at(recent, books[is_recent], demands[is_recent])
+        else:
+            recent = lifetime
+        popularity = numpy.maximum(recent, lifetime * 0.5)
+
+        for i in numpy.flatnonzero(numpy.isfinite(lifetime)):
+            estimates[i] = float(popularity[i])
+        return estimates
+
+
+def percentiles_from_histogram(histogram, n=100):
+    """Find the values that divide a set of measurements into `n`
+    equal-sized groups.
+
+    :param histogram: A list of (value, count) 2-tuples.
+
+    :return: A list of `n` values. The ith value is the one found at
+        position len(measurements) * i/n in the sorted list of
+        measurements--but that list is never actually built.
+    """
+    if not histogram:
+        return []
+    values, counts = zip(*histogram)
+    values = numpy.array(values)
+    counts = numpy.array(counts)
+    order = numpy.argsort(values, kind='mergesort')
+    values = values[order]
+    cumulative = numpy.cumsum(counts[order])
+
+    size = cumulative[-1]
+    positions = (size * (numpy.arange(n) / float(n))).astype(int)
+    return values[
+        numpy.searchsorted(cumulative, positions, side='right')
+    ].tolist()
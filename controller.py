@@ -1,11 +1,38 @@
 from nose.tools import set_trace
+from collections import (
+    defaultdict,
+    OrderedDict,
+)
 from datetime import datetime
-from flask import request, make_response
+from flask import g, request, make_response
 from lxml import etree
 import base64
+import hashlib
 import json
 import logging
+import threading
+import time
 import urllib
+from sqlalchemy import (
+    and_,
+    case,
+    cast,
+    distinct,
+    event,
+    exists,
+    func,
+    literal,
+    or_,
+    select,
+    tuple_,
+    Unicode,
+)
+from sqlalchemy.dialects.postgresql import (
+    aggregate_order_by,
+    insert,
+)
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 
 from core.app_server import (
     cdn_url_for,
@@ -15,10 +42,16 @@ from core.app_server import (
 )
 from core.model import (
     Collection,
+    ConfigurationSetting,
     CoverageRecord,
     DataSource,
+    Hyperlink,
     Identifier,
     IntegrationClient,
+    LicensePool,
+    Work,
+    WorkCoverageRecord,
+    collections_identifiers,
     create,
     get_one,
 )
@@ -35,21 +68,136 @@ from core.problem_details import (
     INVALID_URN,
 )
 
-from canonicalize import AuthorNameCanonicalizer
+from catalog import (
+    CatalogRegistrationJob,
+    CatalogUpdater,
+    catalog_version_table,
+    work_update_time_table,
+)
+from canonicalize import (
+    AuthorNameCanonicalizer,
+    CanonicalizationCache,
+    ContributorNameIndex,
+)
 
 HTTP_OK = 200
 HTTP_CREATED = 201
 HTTP_ACCEPTED = 202
+HTTP_NOT_MODIFIED = 304
 HTTP_UNAUTHORIZED = 401
 HTTP_NOT_FOUND = 404
 HTTP_INTERNAL_SERVER_ERROR = 500
 
 
+class AuthenticationCache(object):
+
+    """Remembers which IntegrationClient key/secret pairs were recently
+    verified, so that IntegrationClient.authenticate(), which checks a
+    bcrypt hash, doesn't have to run on every request.
+
+    Only SHA-256 digests of the secrets are kept. A verified pair
+    expires `ttl` seconds after it was stored, or as soon as its
+    IntegrationClient is changed in this process.
+    """
+
+    DEFAULT_TTL = 300
+
+    def __init__(self, ttl=None, clock=time.time):
+        if ttl is None:
+            ttl = self.DEFAULT_TTL
+        self.ttl = ttl
+        self.clock = clock
+        self._clients = dict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def digest(cls, secret):
+        secret = secret or u''
+        if isinstance(secret, unicode):
+            secret = secret.encode("utf8")
+        return hashlib.sha256(secret).hexdigest()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def get(self, key, secret):
+        """Find the ID of the IntegrationClient with this key and
+        secret, if the pair was verified recently.
+        """
+        now = self.clock()
+        with self._lock:
+            item = self._clients.get(key)
+            if not item:
+                return None
+            stored_at, digest, client_id = item
+            if now - stored_at >= self.ttl:
+                del self._clients[key]
+                return None
+        if digest != self.digest(secret):
+            return None
+        return client_id
+
+    def set(self, key, secret, client_id):
+        """Remember that a key and secret belong to an
+        IntegrationClient.
+        """
+        with self._lock:
+            self._clients[key] = (
+                self.clock(), self.digest(secret), client_id
+            )
+
+    def invalidate(self, client_id):
+        """Forget every verified pair for an IntegrationClient."""
+        with self._lock:
+            for key, item in self._clients.items():
+                if item[2] == client_id:
+                    del self._clients[key]
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+
+# Verified credentials are shared across the whole process.
+authentication_cache = AuthenticationCache()
+
+@event.listens_for(IntegrationClient, 'after_update')
+@event.listens_for(IntegrationClient, 'after_delete')
+def _forget_integration_client(mapper, connection, target):
+    authentication_cache.invalidate(target.id)
+
+
+def authenticate_client(_db, key, secret):
+    """Find the IntegrationClient with the given key and secret.
+
+    The secret is checked at most once per request, and once per
+    AuthenticationCache.ttl.
+    """
+    digest = AuthenticationCache.digest(secret)
+    clients = getattr(g, 'integration_clients', None)
+    if clients is None:
+        clients = g.integration_clients = dict()
+    client = clients.get((key, digest))
+    if client:
+        return client
+
+    client_id = authentication_cache.get(key, secret)
+    if client_id is not None:
+        client = _db.query(IntegrationClient).get(client_id)
+    if not client:
+        client = IntegrationClient.authenticate(_db, key, secret)
+        if client:
+            authentication_cache.set(key, secret, client.id)
+    if client:
+        clients[(key, digest)] = client
+    return client
+
+
 def authenticated_client_from_request(_db, required=True):
     header = request.authorization
     if header:
         key, secret = header.username, header.password
-        client = IntegrationClient.authenticate(_db, key, secret)
+        client = authenticate_client(_db, key, secret)
         if client:
             return client
     if not required and not header:
@@ -59,20 +207,77 @@ def authenticated_client_from_request(_db, required=True):
     return INVALID_CREDENTIALS
 
 
+def document_etag(*version):
+    """Turn everything that determines the content of a document into
+    an ETag.
+    """
+    return hashlib.sha1(repr(version)).hexdigest()
+
+
+def not_modified(etag, last_modified=None):
+    """If the client already has the current version of a document,
+    return a 304 response telling it so. Otherwise return None.
+
+    Only If-None-Match is honored. The timestamps that go into
+    Last-Modified don't capture every change to a feed (such as an
+    identifier being added to a catalog), so If-Modified-Since alone
+    can't safely be answered with a 304.
+    """
+    if etag not in request.if_none_match:
+        return None
+    response = make_response("", HTTP_NOT_MODIFIED)
+    return with_validators(response, etag, last_modified)
+
+
+def with_validators(response, etag, last_modified=None):
+    """Set the ETag and Last-Modified headers on a response."""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
 class CanonicalizationController(object):
 
     log = logging.getLogger("Canonicalization Controller")
 
-    def __init__(self, _db):
+    # A controller is created for every request, but the cache of
+    # canonicalization results and the index of known contributors
+    # are shared across the whole process.
+    cache = CanonicalizationCache()
+    contributor_index = ContributorNameIndex()
+
+    # The sitewide setting for the longest we'll wait for OCLC Linked
+    # Data and VIAF to canonicalize a single name, or a batch of
+    # names, in seconds.
+    DEADLINE_KEY = u"canonicalization_deadline"
+    DEFAULT_DEADLINE = 10
+
+    def __init__(self, _db, deadline=None):
         self._db = _db
-        self.canonicalizer = AuthorNameCanonicalizer(self._db)
+        if deadline is None:
+            deadline = ConfigurationSetting.sitewide(
+                self._db, self.DEADLINE_KEY
+            ).float_value or self.DEFAULT_DEADLINE
+        self.canonicalizer = AuthorNameCanonicalizer(
+            self._db, cache=self.cache,
+            contributor_index=self.contributor_index,
+            deadline=deadline
+        )
+
+    # The most (urn, display_name) pairs accepted in one batch request.
+    MAX_BATCH_SIZE = 1000
+
+    # The number of names in a batch to look up at once in external
+    # services.
+    BATCH_CONCURRENCY = 10
 
     def canonicalize_author_name(self):
         urn = request.args.get('urn')
         display_name = request.args.get('display_name')
         if urn:
-            identifier, is_new = Identifier.parse_urn(self._db, urn, False)
-            if not isinstance(identifier, Identifier):
+            identifier = self.identifier_from_urn(urn)
+            if not identifier:
                 return INVALID_URN
         else:
             identifier = None
@@ -89,10 +294,89 @@ class CanonicalizationController(object):
             return make_response("", HTTP_NOT_FOUND)
         return make_response(author_name, HTTP_OK, {"Content-Type": "text/plain"})
 
+    def canonicalize_author_names(self):
+        """Canonicalize a batch of author names.
+
+        The request body is a JSON list of objects, each with a
+        'display_name' and (optionally) a 'urn'. The response is a
+        JSON object that maps each display name to an object mapping
+        each URN sent along with that display name ("" if none was
+        sent) to the canonicalized name, or to null if no name could
+        be found. Names that can't be looked up before the deadline
+        get a default name.
+        """
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, list):
+            return INVALID_INPUT.detailed(
+                "Expected a JSON list of objects with 'urn' and 'display_name'."
+            )
+        if len(data) > self.MAX_BATCH_SIZE:
+            return INVALID_INPUT.detailed(
+                "Cannot canonicalize more than %d names at once." % (
+                    self.MAX_BATCH_SIZE
+                )
+            )
+
+        identifiers_by_urn = dict()
+        requested = []
+        for item in data:
+            if not isinstance(item, dict):
+                return INVALID_INPUT.detailed(
+                    "Expected a JSON list of objects with 'urn' and 'display_name'."
+                )
+            urn = item.get('urn') or ''
+            display_name = item.get('display_name') or ''
+            if urn and urn not in identifiers_by_urn:
+                identifiers_by_urn[urn] = self.identifier_from_urn(urn)
+            requested.append((urn, display_name))
+
+        pairs = []
+        for urn, display_name in requested:
+            identifier = identifiers_by_urn.get(urn)
+            if urn and not identifier:
+                # We can't canonicalize based on an invalid URN.
+                continue
+            pairs.append((identifier, display_name))
+        author_names = self.canonicalizer.canonicalize_author_names(
+            pairs, concurrency=self.BATCH_CONCURRENCY
+        )
+
+        results = dict()
+        for urn, display_name in requested:
+            identifier = identifiers_by_urn.get(urn)
+            author_name = None
+            if identifier or not urn:
+                author_name = author_names.get((identifier, display_name))
+            results.setdefault(display_name, dict())[urn] = author_name
+        self.log.info(
+            "Canonicalized %d names (%d distinct) in one batch.",
+            len(requested), len(author_names)
+        )
+        return make_response(
+            json.dumps(results), HTTP_OK,
+            {"Content-Type": "application/json"}
+        )
+
+    def identifier_from_urn(self, urn):
+        """Find the Identifier for a URN, or None if it's invalid."""
+        try:
+            identifier, is_new = Identifier.parse_urn(self._db, urn, False)
+        except ValueError, e:
+            return None
+        if not isinstance(identifier, Identifier):
+            return None
+        return identifier
+
 
 class CatalogController(object):
     """A controller to manage a Collection's catalog"""
 
+    # The format of the timestamp in an updates feed cursor.
+    CURSOR_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+    # The format of an updates feed's last_update_time argument.
+    LAST_UPDATE_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
     def __init__(self, _db):
         self._db = _db
 
@@ -107,59 +391,203 @@ class CatalogController(object):
 
         last_update_time = request.args.get('last_update_time', None)
         if last_update_time:
-            last_update_time = datetime.strptime(last_update_time, "%Y-%m-%dT%H:%M:%SZ")
-        updated_works = collection.works_updated_since(self._db, last_update_time)
+            last_update_time = datetime.strptime(
+                last_update_time, self.LAST_UPDATE_TIME_FORMAT
+            )
 
         pagination = load_pagination_from_request()
-        works = pagination.apply(updated_works).all()
+        if isinstance(pagination, ProblemDetail):
+            return pagination
+        cursor = request.args.get('cursor', None)
+        if cursor:
+            cursor = self.parse_cursor(cursor)
+            if isinstance(cursor, ProblemDetail):
+                return cursor
+
+        # If nothing in the catalog has changed since the client last
+        # asked for this page, don't bother building it again.
+        latest_update, membership = self.catalog_version(collection)
+        etag = document_etag(
+            collection.id, client.url, sorted(request.args.items(multi=True)),
+            latest_update, membership
+        )
+        response = not_modified(etag, latest_update)
+        if response:
+            return response
+
+        page, next_cursor = self.updated_works(
+            collection, last_update_time, cursor, pagination.size
+        )
+
         title = "%s Collection Updates for %s" % (collection.protocol, client.url)
-        def update_url(time=last_update_time, page=None):
+        def update_url(time=last_update_time, cursor=None):
             kw = dict(
                 _external=True,
                 collection_metadata_identifier=collection_details
             )
             if time:
-                kw.update({'last_update_time' : last_update_time})
-            if page:
-                kw.update(page.items())
+                kw.update({'last_update_time' : time.strftime(
+                    self.LAST_UPDATE_TIME_FORMAT
+                )})
+            if cursor:
+                kw.update(cursor=cursor, size=pagination.size)
             return cdn_url_for("updates", **kw)
 
+        # Works with cached OPDS entries are spliced into the feed as
+        # they are. Only works without one are rendered here.
         entries = []
-        for work in works[:]:
+        works = []
+        for work in page:
             entry = work.verbose_opds_entry or work.simple_opds_entry
-            entry = etree.fromstring(entry)
-            if entry:
-                entries.append(entry)
-                works.remove(work)
-
-        works = [(work.identifier, work) for work in works]
+            if not entry:
+                works.append((work.identifier, work))
+            entries.append((work.identifier.urn, entry))
 
         update_feed = LookupAcquisitionFeed(
-            self._db, title, update_url(), works, VerboseAnnotator,
-            precomposed_entries=entries
+            self._db, title, update_url(), works, VerboseAnnotator
         )
 
-        if len(updated_works.all()) > pagination.size + pagination.offset:
+        if next_cursor:
             update_feed.add_link_to_feed(
-                update_feed.feed, rel="next", 
-                href=update_url(page=pagination.next_page)
+                update_feed.feed, rel="next",
+                href=update_url(cursor=next_cursor)
             )
-        if pagination.offset > 0:
+        if cursor:
             update_feed.add_link_to_feed(
-                update_feed.feed, rel="first", 
-                href=update_url(page=pagination.first_page)
+                update_feed.feed, rel="first", href=update_url()
             )
-        previous_page = pagination.previous_page
-        if previous_page:
-            update_feed.add_link_to_feed(
-                update_feed.feed, rel="previous", 
-                href=update_url(page=previous_page)
+
+        response = feed_response(self.splice_entries(update_feed, entries))
+        return with_validators(response, etag, latest_update)
+
+    def catalog_version(self, collection):
+        """Find out enough about a collection's catalog to tell whether
+        its updates feed has changed.
+
+        This is checked for every page, so it mustn't depend on the
+        size of the catalog.
+
+        :return: A 2-tuple (latest_update, membership). `latest_update`
+            is the time of the latest update to any work. `membership`
+            is the collection's catalog version, which goes up every
+            time an identifier is added to or removed from the catalog.
+        """
+        # Finding the latest update to a work in this catalog would
+        # mean reading the whole catalog. The latest update to any
+        # work is found with a single index lookup, and is never
+        # earlier.
+        latest_update = self._db.query(
+            func.max(work_update_time_table.c.last_update)
+        ).scalar()
+
+        table = catalog_version_table
+        membership = self._db.execute(
+            select([table.c.version]).where(
+                table.c.collection_id==collection.id
+            )
+        ).scalar()
+        return latest_update, membership
+
+    ATOM_ID = "{http://www.w3.org/2005/Atom}id"
+
+    @classmethod
+    def splice_entries(cls, feed, entries):
+        """Put a feed's entries, and precomposed ones, in order.
+
+        :param entries: A list of 2-tuples (urn, entry), one for each
+            entry the feed should end up with, in order. `entry` is a
+            serialized <entry> tag, which is inserted into the document
+            as a string, without being parsed. If it's None, the entry
+            with the ID `urn` that the feed already has goes there.
+
+        :return: The feed document, as a unicode string.
+        """
+        # The rendered entries are serialized while they're still in
+        # the feed, so they keep its namespace prefixes.
+        rendered = OrderedDict()
+        for entry in feed.feed.findall("{http://www.w3.org/2005/Atom}entry"):
+            rendered[entry.findtext(cls.ATOM_ID)] = etree.tostring(
+                entry, encoding=unicode, with_tail=False
+            )
+            feed.feed.remove(entry)
+
+        document = unicode(feed)
+        end = document.rindex(u"</feed>")
+        parts = [document[:end]]
+        for urn, entry in entries:
+            if entry is None:
+                entry = rendered.pop(urn, None)
+                if entry is None:
+                    continue
+            elif not isinstance(entry, unicode):
+                entry = entry.decode("utf8")
+            parts.append(entry)
+        parts.extend(rendered.values())
+        parts.append(document[end:])
+        return u"".join(parts)
+
+    def updated_works(self, collection, last_update_time, cursor, size):
+        """Find one page of the works in a collection's catalog that have
+        been updated since `last_update_time`.
+
+        Works are ordered by the time of their latest update, then by
+        ID, and each page picks up where the `cursor` of the previous
+        page leaves off. The update times come from workupdatetimes,
+        whose index is in that order, so a page is found by reading
+        the index from the cursor on, rather than by aggregating and
+        sorting the coverage records of the whole catalog.
+
+        :param cursor: A 2-tuple (update time, work ID) identifying
+            the last work on the previous page, or None for the first
+            page.
+
+        :return: A 2-tuple (works, next_cursor). `next_cursor` is None
+            if this is the last page.
+        """
+        table = work_update_time_table
+        updated = table.c.last_update
+        in_catalog = exists().where(
+            and_(LicensePool.work_id==Work.id,
+                 collections_identifiers.c.identifier_id==LicensePool.identifier_id,
+                 collections_identifiers.c.collection_id==collection.id)
+        )
+        qu = self._db.query(Work, updated).join(
+            table, table.c.work_id==Work.id
+        ).filter(in_catalog)
+        if last_update_time:
+            qu = qu.filter(updated > last_update_time)
+        if cursor:
+            qu = qu.filter(tuple_(updated, table.c.work_id) > tuple_(*cursor))
+        rows = qu.order_by(updated, table.c.work_id).limit(size + 1).all()
+
+        # One extra row was requested just to see if there's another page.
+        next_cursor = None
+        if len(rows) > size:
+            rows = rows[:size]
+            last_work, last_updated = rows[-1]
+            next_cursor = "%s,%d" % (
+                last_updated.strftime(self.CURSOR_TIME_FORMAT), last_work.id
             )
+        return [work for work, ignore in rows], next_cursor
 
-        return feed_response(update_feed)
+    def parse_cursor(self, cursor):
+        """Turn an updates feed cursor into a 2-tuple (update time, work ID)."""
+        try:
+            timestamp, work_id = cursor.split(",")
+            return (
+                datetime.strptime(timestamp, self.CURSOR_TIME_FORMAT),
+                int(work_id)
+            )
+        except ValueError, e:
+            return INVALID_INPUT.detailed("Invalid cursor: %s" % cursor)
 
     def add_items(self, collection_details):
-        """Adds identifiers to a Collection's catalog"""
+        """Adds identifiers to a Collection's catalog
+
+        URNs passed in the query string are added right away. A list of
+        URNs in the request body (as a JSON list, or one per line) is
+        added in the background by a CatalogRegistrationJob.
+        """
         client = authenticated_client_from_request(self._db)
         if isinstance(client, ProblemDetail):
             return client
@@ -169,33 +597,12 @@ class CatalogController(object):
         )
 
         urns = request.args.getlist('urn')
-        messages = []
-        for urn in urns:
-            message = None
-            identifier = None
-            try:
-                identifier, ignore = Identifier.parse_urn(
-                    self._db, urn
-                )
-            except Exception as e:
-                identifier = None
-
-            if not identifier:
-                message = OPDSMessage(
-                    urn, INVALID_URN.status_code, INVALID_URN.detail
-                )
-            else:
-                status = HTTP_OK
-                description = "Already in catalog"
+        if not urns and request.method == 'POST':
+            # The URNs are in the body. It may be sent in chunks,
+            # without a Content-Length, so its length isn't checked.
+            return self.create_registration_job(collection, client)
 
-                if identifier not in collection.catalog:
-                    collection.catalog_identifier(self._db, identifier)
-                    status = HTTP_CREATED
-                    description = "Successfully added"
-
-                message = OPDSMessage(urn, status, description)
-
-            messages.append(message)
+        messages = CatalogUpdater(self._db).add(collection, urns)
 
         title = "%s Catalog Item Additions for %s" % (collection.protocol, client.url)
         url = cdn_url_for(
@@ -208,6 +615,91 @@ class CatalogController(object):
 
         return feed_response(addition_feed)
 
+    def create_registration_job(self, collection, client):
+        """Start a job to add the URNs in the request body to a catalog.
+
+        :return: A 202 response pointing to the job's status.
+        """
+        if request.mimetype == 'application/json':
+            urns = request.get_json(silent=True)
+            if (not isinstance(urns, list)
+                or not all(isinstance(x, basestring) for x in urns)):
+                return INVALID_INPUT.detailed(
+                    "Expected a JSON list of URNs."
+                )
+        else:
+            # Read the body one line at a time rather than all at once.
+            urns = (line.decode("utf8") for line in request.stream)
+
+        job = CatalogRegistrationJob.create(
+            self._db, collection, client, urns
+        )
+        status_url = cdn_url_for(
+            "add_job", collection_metadata_identifier=collection.name,
+            job_id=job.id, _external=True
+        )
+        return make_response(
+            json.dumps(dict(id=job.id, total=job.total, status=status_url)),
+            HTTP_ACCEPTED,
+            {"Content-Type": "application/json", "Location": status_url}
+        )
+
+    def registration_job(self, collection_details, job_id):
+        """Report on the progress of a CatalogRegistrationJob.
+
+        The response is a feed of OPDSMessages for the URNs processed
+        so far. Its status code is 202 until the job is finished.
+        """
+        client = authenticated_client_from_request(self._db)
+        if isinstance(client, ProblemDetail):
+            return client
+
+        collection, ignore = Collection.from_metadata_identifier(
+            self._db, collection_details
+        )
+        job = CatalogRegistrationJob.for_client(
+            self._db, job_id, collection, client
+        )
+        if not job:
+            return INVALID_INPUT.detailed(
+                "No such job: %s" % job_id, status_code=HTTP_NOT_FOUND
+            )
+
+        pagination = load_pagination_from_request()
+        if isinstance(pagination, ProblemDetail):
+            return pagination
+        messages = job.results(pagination.offset, pagination.size)
+
+        title = "%s Catalog Item Additions for %s: %d of %d processed" % (
+            collection.protocol, client.url, job.processed, job.total
+        )
+        if job.error:
+            title += " (failed: %s)" % job.error
+        def job_url(page=None):
+            kw = dict(
+                _external=True,
+                collection_metadata_identifier=collection.name,
+                job_id=job.id
+            )
+            if page:
+                kw.update(page.items())
+            return cdn_url_for("add_job", **kw)
+
+        job_feed = AcquisitionFeed(
+            self._db, title, job_url(), [], VerboseAnnotator,
+            precomposed_entries=messages
+        )
+        if pagination.offset + len(messages) < job.processed:
+            job_feed.add_link_to_feed(
+                job_feed.feed, rel="next",
+                href=job_url(page=pagination.next_page)
+            )
+
+        response = feed_response(job_feed)
+        if not job.finished:
+            response.status_code = HTTP_ACCEPTED
+        return response
+
     def remove_items(self, collection_details):
         """Removes identifiers from a Collection's catalog"""
         client = authenticated_client_from_request(self._db)
@@ -219,31 +711,7 @@ class CatalogController(object):
         )
 
         urns = request.args.getlist('urn')
-        messages = []
-        for urn in urns:
-            message = None
-            identifier = None
-            try:
-                identifier, ignore = Identifier.parse_urn(self._db, urn)
-            except Exception as e:
-                identifier = None
-
-            if not identifier:
-                message = OPDSMessage(
-                    urn, INVALID_URN.status_code, INVALID_URN.detail
-                )
-            else:
-                if identifier in collection.catalog:
-                    collection.catalog.remove(identifier)
-                    message = OPDSMessage(
-                        urn, HTTP_OK, "Successfully removed"
-                    )
-                else:
-                    message = OPDSMessage(
-                        urn, HTTP_NOT_FOUND, "Not in catalog"
-                    )
-
-            messages.append(message)
+        messages = CatalogUpdater(self._db).remove(collection, urns)
 
         title = "%s Catalog Item Removal for %s" % (collection.protocol, client.url)
         url = cdn_url_for("remove", collection_metadata_identifier=collection.name, urn=urns)
@@ -269,6 +737,73 @@ class CatalogController(object):
         return make_response("", HTTP_OK)
 
 
+class OPDSEntryCache(object):
+
+    """Remembers the OPDS entries built from metadata lookups for
+    Identifiers that don't have a Work.
+
+    Each entry is stored along with a version of its Identifier, made
+    from the CoverageRecords and Hyperlinks associated with it. When
+    one of those is added or changed, by this process or any other,
+    the version changes and the entry has to be built again.
+    """
+
+    DEFAULT_MAX_SIZE = 10000
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = self.DEFAULT_MAX_SIZE
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def version(cls, _db, identifier):
+        """Find the current version of an Identifier, with one query."""
+        coverage = _db.query(
+            func.count(CoverageRecord.id), func.max(CoverageRecord.timestamp)
+        ).filter(CoverageRecord.identifier_id==identifier.id).subquery()
+        hyperlinks = _db.query(
+            func.count(Hyperlink.id), func.max(Hyperlink.id)
+        ).filter(Hyperlink.identifier_id==identifier.id).subquery()
+        return tuple(_db.query(coverage, hyperlinks).one())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, _db, identifier):
+        """Look up the entry for an Identifier.
+
+        :return: A 2-tuple (entry, version). `entry` is None if there's
+            no entry for the Identifier's current version. `version`
+            can be passed into set() along with a new entry.
+        """
+        version = self.version(_db, identifier)
+        with self._lock:
+            item = self._entries.pop(identifier.id, None)
+            if not item or item[0] != version:
+                return None, version
+            # Move this entry to the most-recently-used end.
+            self._entries[identifier.id] = item
+        return etree.fromstring(item[1]), version
+
+    def set(self, identifier, version, entry):
+        """Store the entry for a version of an Identifier."""
+        with self._lock:
+            self._entries.pop(identifier.id, None)
+            self._entries[identifier.id] = (version, etree.tostring(entry))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, identifier):
+        with self._lock:
+            self._entries.pop(identifier.id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
 class URNLookupController(CoreURNLookupController):
 
     UNRESOLVABLE_IDENTIFIER = "I can't gather information about an identifier of this type."
@@ -281,6 +816,18 @@ class URNLookupController(CoreURNLookupController):
 
 
     log = logging.getLogger("URN lookup controller")
+
+    # While process_urns() is running, this holds the identifiers
+    # waiting to be registered as unresolved.
+    unresolved = None
+
+    # Whether the last call to process_urns() catalogued or registered
+    # any identifiers.
+    lookup_made_changes = False
+
+    # Entries built from metadata lookups are shared across the whole
+    # process.
+    entry_cache = OPDSEntryCache()
     
     def presentation_ready_work_for(self, identifier):
         """Either return a presentation-ready work associated with the 
@@ -319,6 +866,208 @@ class URNLookupController(CoreURNLookupController):
             return False
         return True
   
+    def work_lookup(self, annotator, route_name='lookup', **process_urn_kwargs):
+        """Generate an OPDS feed describing the works identified by
+        the URNs in the request.
+        """
+        urns = request.args.getlist('urn')
+        this_url = cdn_url_for(route_name, _external=True, urn=urns)
+        collection = self.collection_for_lookup(
+            process_urn_kwargs.pop('collection_details', None)
+        )
+        identifiers_by_urn = CatalogUpdater(self._db).identifiers_for_urns(urns)
+        identifier_ids = [x.id for x in identifiers_by_urn.values()]
+
+        validators = None
+        if request.if_none_match:
+            # The client has a version of this feed. Its ETag was
+            # found after a lookup, which left these identifiers
+            # needing nothing more done. So if they haven't changed
+            # since, there's no need to look them up again.
+            validators = self.lookup_validators(
+                urns, identifier_ids, collection
+            )
+            response = not_modified(*validators)
+            if response:
+                return response
+
+        self.process_urns(
+            urns, identifiers_by_urn=identifiers_by_urn,
+            collection=collection, **process_urn_kwargs
+        )
+        self.post_lookup_hook()
+
+        if validators is None or self.lookup_made_changes:
+            # The validators describe the identifiers as the lookup
+            # left them.
+            validators = self.lookup_validators(
+                urns, identifier_ids, collection
+            )
+        etag, last_modified = validators
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+
+        opds_feed = LookupAcquisitionFeed(
+            self._db, "Lookup results", this_url, self.works, annotator,
+            precomposed_entries=self.precomposed_entries
+        )
+        return with_validators(feed_response(opds_feed), etag, last_modified)
+
+    def lookup_validators(self, urns, ids, collection=None):
+        """Find the ETag and Last-Modified time for a lookup feed.
+
+        The ETag changes whenever anything that affects a looked-up
+        identifier's entry or message changes: its CoverageRecords,
+        Hyperlinks, LicensePools or Works, or its presence in
+        `collection`'s catalog. It's all found with one query.
+
+        :param ids: The IDs of the looked-up Identifiers.
+        :return: A 2-tuple (etag, last_modified).
+        """
+        version = ()
+        last_modified = None
+        if ids:
+            coverage = self._db.query(
+                func.count(CoverageRecord.id),
+                func.max(CoverageRecord.timestamp)
+            ).filter(CoverageRecord.identifier_id.in_(ids)).subquery()
+            hyperlinks = self._db.query(
+                func.count(Hyperlink.id), func.max(Hyperlink.id)
+            ).filter(Hyperlink.identifier_id.in_(ids)).subquery()
+            works = self._db.query(
+                func.count(distinct(LicensePool.id)),
+                func.count(distinct(case(
+                    [(Work.presentation_ready==True, Work.id)]
+                ))),
+                func.max(WorkCoverageRecord.timestamp)
+            ).select_from(LicensePool).outerjoin(LicensePool.work).outerjoin(
+                Work.coverage_records
+            ).filter(LicensePool.identifier_id.in_(ids)).subquery()
+            subqueries = [coverage, hyperlinks, works]
+            if collection:
+                # Which of these identifiers are in the catalog, not
+                # just how many.
+                table = collections_identifiers
+                subqueries.append(select([
+                    func.md5(func.string_agg(
+                        cast(table.c.identifier_id, Unicode),
+                        aggregate_order_by(
+                            literal(u","), table.c.identifier_id
+                        )
+                    ))
+                ]).where(table.c.collection_id==collection.id).where(
+                    table.c.identifier_id.in_(ids)
+                ).alias())
+            version = tuple(self._db.query(*subqueries).one())
+            timestamps = [x for x in (version[1], version[6]) if x]
+            if timestamps:
+                last_modified = max(timestamps)
+
+        etag = document_etag(urns, collection and collection.id, version)
+        return etag, last_modified
+
+    def process_urns(self, urns, collection_details=None,
+                     identifiers_by_urn=None, collection=None, **kwargs):
+        """Turn a list of URNs into Works suitable for use in an OPDS
+        feed.
+
+        This does the same thing as calling process_urn() on each URN,
+        but it authenticates the client and finds the Collection once,
+        and loads everything it needs to know about the Identifiers
+        with a few queries instead of several per URN.
+
+        Afterwards, self.lookup_made_changes says whether anything
+        was catalogued or registered.
+
+        :param identifiers_by_urn: A dictionary mapping the URNs to
+            their Identifiers, if it's already been made.
+        :param collection: The Collection found by
+            collection_for_lookup(), if it's already been found.
+        """
+        if not collection:
+            collection = self.collection_for_lookup(collection_details)
+        self.lookup_made_changes = False
+
+        updater = CatalogUpdater(self._db)
+        if identifiers_by_urn is None:
+            identifiers_by_urn = updater.identifiers_for_urns(urns)
+        identifiers = identifiers_by_urn.values()
+        coverage_records = self.preload(identifiers)
+
+        if collection:
+            if updater.catalog_identifiers(collection, [
+                x for x in identifiers if self.can_resolve_identifier(x)
+            ]):
+                self.lookup_made_changes = True
+
+        # Identifiers that need to be registered as unresolved are
+        # set aside and registered all at once.
+        self.unresolved = []
+        try:
+            for urn in urns:
+                identifier = identifiers_by_urn.get(urn)
+                self.process_identifier(
+                    urn, identifier, coverage_records=coverage_records
+                )
+            self.register_identifiers_as_unresolved(
+                self.unresolved, coverage_records
+            )
+        finally:
+            self.unresolved = None
+
+    def preload(self, identifiers):
+        """Load the LicensePools and Works for a number of Identifiers,
+        and find their resolution CoverageRecords.
+
+        :return: A dictionary mapping Identifier IDs to
+            CoverageRecords.
+        """
+        ids = [x.id for x in identifiers]
+        if not ids:
+            return dict()
+
+        pools = self._db.query(LicensePool).filter(
+            LicensePool.identifier_id.in_(ids)
+        ).options(joinedload(LicensePool.work))
+        pools_by_identifier = defaultdict(list)
+        for pool in pools:
+            pools_by_identifier[pool.identifier_id].append(pool)
+        for identifier in identifiers:
+            set_committed_value(
+                identifier, 'licensed_through',
+                pools_by_identifier[identifier.id]
+            )
+
+        source = DataSource.lookup(self._db, DataSource.INTERNAL_PROCESSING)
+        records = self._db.query(CoverageRecord).filter(
+            CoverageRecord.identifier_id.in_(ids)
+        ).filter(
+            CoverageRecord.data_source==source
+        ).filter(
+            CoverageRecord.operation==self.OPERATION
+        ).filter(
+            CoverageRecord.collection_id==None
+        )
+        return dict((x.identifier_id, x) for x in records)
+
+    def collection_for_lookup(self, collection_details):
+        """Find the Collection whose catalog should include the
+        identifiers being looked up, if any.
+
+        Identifiers are only catalogued on behalf of an authenticated
+        IntegrationClient.
+        """
+        if not collection_details:
+            return None
+        client = authenticated_client_from_request(self._db, required=False)
+        if not client:
+            return None
+        collection, ignore = Collection.from_metadata_identifier(
+            self._db, collection_details
+        )
+        return collection
+
     def process_urn(self, urn, collection_details=None, **kwargs):
         """Turn a URN into a Work suitable for use in an OPDS feed.
         """
@@ -327,6 +1076,21 @@ class URNLookupController(CoreURNLookupController):
         except ValueError, e:
             identifier = None
 
+        collection = None
+        if identifier and self.can_resolve_identifier(identifier):
+            collection = self.collection_for_lookup(collection_details)
+        return self.process_identifier(urn, identifier, collection)
+
+    def process_identifier(self, urn, identifier, collection=None,
+                           coverage_records=None):
+        """Turn an Identifier into a Work suitable for use in an OPDS
+        feed.
+
+        :param collection: If provided, the Identifier will be added
+            to this Collection's catalog.
+        :param coverage_records: If provided, a dictionary mapping
+            Identifier IDs to preloaded resolution CoverageRecords.
+        """
         if not identifier:
             # Not a well-formed URN.
             return self.add_message(urn, 400, INVALID_URN.detail)
@@ -337,18 +1101,16 @@ class URNLookupController(CoreURNLookupController):
         # We are at least willing to try to resolve this Identifier.
         # If a Collection was provided by an authenticated IntegrationClient,
         # this Identifier is part of the Collection's catalog.
-        client = authenticated_client_from_request(self._db, required=False)
-        if client and collection_details:
-            collection, ignore = Collection.from_metadata_identifier(
-                self._db, collection_details
-            )
+        if collection:
             collection.catalog_identifier(self._db, identifier)
 
         if (identifier.type == Identifier.ISBN and not identifier.work):
             # There's not always enough information about an ISBN to
             # create a full Work. If not, we scrape together the cover
             # and description information and force the entry.
-            return self.make_opds_entry_from_metadata_lookups(identifier)
+            return self.make_opds_entry_from_metadata_lookups(
+                identifier, coverage_records
+            )
 
         # All other identifiers need to be associated with a
         # presentation-ready Work for the lookup to succeed. If there
@@ -359,16 +1121,31 @@ class URNLookupController(CoreURNLookupController):
             return self.add_work(identifier, work)
 
         # Work remains to be done.
-        return self.register_identifier_as_unresolved(urn, identifier)
+        return self.register_identifier_as_unresolved(
+            urn, identifier, coverage_records
+        )
 
-    def register_identifier_as_unresolved(self, urn, identifier):
+    def register_identifier_as_unresolved(self, urn, identifier,
+                                          coverage_records=None):
         # This identifier could have a presentation-ready Work
         # associated with it, but it doesn't. We need to make sure the
         # work gets done eventually by creating a CoverageRecord
         # representing the work that needs to be done.
+        if self.unresolved is not None:
+            # We're in the middle of process_urns(). Hold this
+            # identifier's place in the feed until it's registered.
+            self.unresolved.append(
+                (len(self.precomposed_entries), urn, identifier)
+            )
+            self.precomposed_entries.append(None)
+            return
+
         source = DataSource.lookup(self._db, DataSource.INTERNAL_PROCESSING)
         
-        record = CoverageRecord.lookup(identifier, source, self.OPERATION)
+        if coverage_records is not None:
+            record = coverage_records.get(identifier.id)
+        else:
+            record = CoverageRecord.lookup(identifier, source, self.OPERATION)
         is_new = False
         if not record:
             # There is no existing CoverageRecord for this Identifier.
@@ -380,35 +1157,139 @@ class URNLookupController(CoreURNLookupController):
             )
             record.exception = self.NO_WORK_DONE_EXCEPTION
 
+        status, message = self.unresolved_message(record, is_new)
+        return self.add_message(urn, status, message)
+
+    def register_identifiers_as_unresolved(self, unresolved,
+                                           coverage_records):
+        """Make sure there's a CoverageRecord for each of a number of
+        unresolved Identifiers, creating the missing ones with a
+        single statement.
+
+        :param unresolved: A list of (position, urn, identifier)
+            3-tuples. Each position is the index in
+            self.precomposed_entries where that URN's message belongs.
+        :param coverage_records: A dictionary mapping Identifier IDs
+            to existing resolution CoverageRecords.
+        """
+        if not unresolved:
+            return
+        source = DataSource.lookup(self._db, DataSource.INTERNAL_PROCESSING)
+        missing = set(
+            identifier.id for position, urn, identifier in unresolved
+            if identifier.id not in coverage_records
+        )
+
+        created = set()
+        if missing:
+            # Insert a record in a state of transient failure for
+            # every identifier that still doesn't have one. The
+            # unique index on records without a collection turns a
+            # record created by a concurrent request into a conflict,
+            # which is skipped rather than duplicated.
+            self._db.flush()
+            table = CoverageRecord.__table__
+            new_records = select([
+                Identifier.id, literal(source.id), literal(self.OPERATION),
+                literal(datetime.utcnow()),
+                cast(literal(CoverageRecord.TRANSIENT_FAILURE),
+                     table.c.status.type),
+                literal(self.NO_WORK_DONE_EXCEPTION),
+            ]).where(Identifier.id.in_(missing))
+            result = self._db.execute(
+                insert(table).from_select(
+                    ['identifier_id', 'data_source_id', 'operation',
+                     'timestamp', 'status', 'exception'],
+                    new_records
+                ).on_conflict_do_nothing(
+                    index_elements=[
+                        table.c.identifier_id, table.c.data_source_id,
+                        table.c.operation
+                    ],
+                    index_where=(table.c.collection_id==None)
+                ).returning(table.c.identifier_id)
+            )
+            created = set(identifier_id for (identifier_id,) in result)
+            if created:
+                self.lookup_made_changes = True
+
+            # Someone else may have registered the rest in the
+            # meantime.
+            coverage_records = dict(coverage_records)
+            if missing - created:
+                records = self._db.query(CoverageRecord).filter(
+                    CoverageRecord.identifier_id.in_(missing - created)
+                ).filter(
+                    CoverageRecord.data_source==source
+                ).filter(
+                    CoverageRecord.operation==self.OPERATION
+                ).filter(
+                    CoverageRecord.collection_id==None
+                )
+                for record in records:
+                    coverage_records[record.identifier_id] = record
+
+        for position, urn, identifier in unresolved:
+            if identifier.id in created:
+                # Only the first request for a new identifier is told
+                # that it was registered.
+                created.remove(identifier.id)
+                status, message = HTTP_CREATED, self.IDENTIFIER_REGISTERED
+            elif identifier.id in missing:
+                record = coverage_records.get(identifier.id)
+                if record:
+                    status, message = self.unresolved_message(record)
+                else:
+                    status = HTTP_ACCEPTED
+                    message = self.WORKING_TO_RESOLVE_IDENTIFIER
+            else:
+                status, message = self.unresolved_message(
+                    coverage_records[identifier.id]
+                )
+            self.precomposed_entries[position] = OPDSMessage(
+                urn, status, message
+            )
+
+    def unresolved_message(self, record, is_new=False):
+        """Explain the state of an unresolved Identifier.
+
+        :param record: The Identifier's resolution CoverageRecord.
+        :param is_new: Whether `record` was just created.
+        :return: A 2-tuple (status code, message).
+        """
         if is_new:
             # The CoverageRecord was just created. Tell the client to
             # come back later.
-            return self.add_message(urn, HTTP_CREATED, self.IDENTIFIER_REGISTERED)
-        else:
-            # There is a pending attempt to resolve this identifier.
-            # Tell the client we're working on it, or if the
-            # pending attempt resulted in an exception,
-            # tell the client about the exception.
-            message = record.exception
-            if not message or message == self.NO_WORK_DONE_EXCEPTION:
-                message = self.WORKING_TO_RESOLVE_IDENTIFIER
-            status = HTTP_ACCEPTED
-            if record.status == record.PERSISTENT_FAILURE:
-                # Apparently we just can't provide coverage of this
-                # identifier.
-                status = HTTP_INTERNAL_SERVER_ERROR
-            elif record.status == record.SUCCESS:
-                # This shouldn't happen, since success in providing
-                # this sort of coverage means creating a presentation
-                # ready work. Something weird is going on.
-                status = HTTP_INTERNAL_SERVER_ERROR
-                message = self.SUCCESS_DID_NOT_RESULT_IN_PRESENTATION_READY_WORK
-            return self.add_message(urn, status, message)
-
-    def make_opds_entry_from_metadata_lookups(self, identifier):
+            return HTTP_CREATED, self.IDENTIFIER_REGISTERED
+
+        # There is a pending attempt to resolve this identifier.
+        # Tell the client we're working on it, or if the
+        # pending attempt resulted in an exception,
+        # tell the client about the exception.
+        message = record.exception
+        if not message or message == self.NO_WORK_DONE_EXCEPTION:
+            message = self.WORKING_TO_RESOLVE_IDENTIFIER
+        status = HTTP_ACCEPTED
+        if record.status == record.PERSISTENT_FAILURE:
+            # Apparently we just can't provide coverage of this
+            # identifier.
+            status = HTTP_INTERNAL_SERVER_ERROR
+        elif record.status == record.SUCCESS:
+            # This shouldn't happen, since success in providing
+            # this sort of coverage means creating a presentation
+            # ready work. Something weird is going on.
+            status = HTTP_INTERNAL_SERVER_ERROR
+            message = self.SUCCESS_DID_NOT_RESULT_IN_PRESENTATION_READY_WORK
+        return status, message
+
+    def make_opds_entry_from_metadata_lookups(self, identifier,
+                                              coverage_records=None):
         """This identifier cannot be turned into a presentation-ready Work,
         but maybe we can make an OPDS entry based on metadata lookups.
         """
+        entry, version = self.entry_cache.get(self._db, identifier)
+        if entry is not None:
+            return self.add_entry(entry)
 
         # We can only create an OPDS entry if all the lookups have
         # in fact been done.
@@ -439,7 +1320,7 @@ class URNLookupController(CoreURNLookupController):
                 ", ".join(names)
             )
             return self.register_identifier_as_unresolved(
-                identifier.urn, identifier
+                identifier.urn, identifier, coverage_records
             )
         else:
             # All metadata lookups have completed. Create that OPDS
@@ -455,6 +1336,7 @@ class URNLookupController(CoreURNLookupController):
             )
 
         # We made it!
+        self.entry_cache.set(identifier, version, entry)
         return self.add_entry(entry)
 
     def post_lookup_hook(self):
@@ -0,0 +1,5 @@
+-- Lets the Content Cafe demand measurement sweep find ISBNs with a
+-- fresh popularity measurement without scanning old measurements.
+create index if not exists ix_measurements_most_recent
+    on measurements (identifier_id, data_source_id, quantity_measured, taken_at)
+    where is_most_recent = true;
@@ -0,0 +1,7 @@
+create table if not exists coverimagehashes (
+    content_hash varchar primary key,
+    representation_id integer not null references representations(id)
+);
+
+create index if not exists ix_coverimagehashes_representation_id
+    on coverimagehashes (representation_id);
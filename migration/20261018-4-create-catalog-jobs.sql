@@ -0,0 +1,32 @@
+create table if not exists catalogjobs (
+    id serial primary key,
+    collection_id integer not null references collections(id),
+    integration_client_id integer not null references integrationclients(id),
+    total integer not null,
+    processed integer not null,
+    created timestamp without time zone not null,
+    finished timestamp without time zone,
+    error varchar
+);
+
+create index if not exists ix_catalogjobs_collection_id
+    on catalogjobs (collection_id);
+create index if not exists ix_catalogjobs_finished
+    on catalogjobs (finished);
+
+create table if not exists catalogjoburns (
+    job_id integer not null references catalogjobs(id),
+    position integer not null,
+    urn varchar not null,
+    primary key (job_id, position)
+);
+
+create table if not exists catalogjobresults (
+    id serial primary key,
+    job_id integer not null references catalogjobs(id),
+    position integer not null,
+    urn varchar not null,
+    status_code integer not null,
+    message varchar,
+    unique (job_id, position)
+);
@@ -0,0 +1,41 @@
+create table if not exists workupdatetimes (
+    work_id integer primary key references works(id) on delete cascade,
+    last_update timestamp without time zone not null
+);
+
+create index if not exists ix_workupdatetimes_last_update_work_id
+    on workupdatetimes (last_update, work_id);
+
+create or replace function record_work_update_time() returns trigger as $$
+declare
+    changed_work_id integer;
+begin
+    if tg_op = 'DELETE' then
+        changed_work_id := old.work_id;
+    else
+        changed_work_id := new.work_id;
+    end if;
+    insert into workupdatetimes (work_id, last_update)
+        select changed_work_id, max(timestamp) from workcoveragerecords
+        where work_id = changed_work_id
+        having max(timestamp) is not null
+        on conflict (work_id) do update
+        set last_update = excluded.last_update;
+    if not found then
+        delete from workupdatetimes where work_id = changed_work_id;
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists record_work_update_time on workcoveragerecords;
+create trigger record_work_update_time
+    after insert or update or delete on workcoveragerecords
+    for each row execute procedure record_work_update_time();
+
+insert into workupdatetimes (work_id, last_update)
+    select work_id, max(timestamp) from workcoveragerecords
+    where timestamp is not null
+    group by work_id
+    on conflict (work_id) do update
+    set last_update = excluded.last_update;
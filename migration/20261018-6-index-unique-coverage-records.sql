@@ -0,0 +1,14 @@
+-- The unique constraint on coveragerecords doesn't apply to records
+-- without a collection, since no two NULLs are equal. Remove any
+-- duplicates that have crept in, keeping the oldest record, then make
+-- sure there can't be any more.
+delete from coveragerecords d using coveragerecords c
+    where d.collection_id is null and c.collection_id is null
+    and d.identifier_id = c.identifier_id
+    and d.data_source_id = c.data_source_id
+    and d.operation = c.operation
+    and d.id > c.id;
+
+create unique index if not exists ix_coveragerecords_identifier_data_source_operation_no_collection
+    on coveragerecords (identifier_id, data_source_id, operation)
+    where collection_id is null;
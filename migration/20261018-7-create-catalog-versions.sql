@@ -0,0 +1,29 @@
+-- Counts changes to each collection's catalog, so the updates feed
+-- can tell whether a catalog has changed without reading it.
+create table if not exists catalogversions (
+    collection_id integer primary key references collections(id) on delete cascade,
+    version bigint not null
+);
+
+create or replace function record_catalog_change() returns trigger as $$
+begin
+    if tg_op <> 'INSERT' then
+        insert into catalogversions (collection_id, version)
+            values (old.collection_id, 1)
+            on conflict (collection_id) do update
+            set version = catalogversions.version + 1;
+    end if;
+    if tg_op <> 'DELETE' then
+        insert into catalogversions (collection_id, version)
+            values (new.collection_id, 1)
+            on conflict (collection_id) do update
+            set version = catalogversions.version + 1;
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+drop trigger if exists record_catalog_change on collectionsidentifiers;
+create trigger record_catalog_change
+    after insert or update or delete on collectionsidentifiers
+    for each row execute procedure record_catalog_change();
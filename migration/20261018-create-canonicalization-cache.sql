@@ -0,0 +1,11 @@
+create table if not exists canonicalizationcache (
+    id serial primary key,
+    display_name varchar not null,
+    identifier_urn varchar not null,
+    sort_name varchar,
+    created timestamp without time zone not null,
+    unique (display_name, identifier_urn)
+);
+
+create index if not exists ix_canonicalizationcache_created
+    on canonicalizationcache (created);
@@ -1,23 +1,71 @@
 from nose.tools import set_trace
 import datetime
+import hashlib
 import logging
+import multiprocessing
 import time
+import traceback
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
 
-from sqlalchemy import or_
+from PIL import Image
+
+from sqlalchemy import (
+    and_,
+    Column,
+    exists,
+    ForeignKey,
+    Integer,
+    or_,
+    Table,
+    Unicode,
+)
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import (
     aliased,
 )
 
 from core.model import (
+    Base,
+    ConfigurationSetting,
     DataSource,
     Identifier,
     Hyperlink,
     Resource,
     Representation,
+    get_one_or_create,
 )
 from core.s3 import S3Uploader
 
 
+# Maps the SHA-256 hash of an image to the mirrored Representation
+# that holds those bytes. See
+# migration/20261018-3-create-cover-image-hashes.sql.
+cover_image_hash_table = Table(
+    'coverimagehashes', Base.metadata,
+    Column('content_hash', Unicode, primary_key=True),
+    Column('representation_id', Integer,
+           ForeignKey('representations.id'), nullable=False, index=True),
+)
+
+
+def image_content(representation):
+    """The bytes of an image, whether they're stored in the database
+    or on disk.
+    """
+    fh = representation.content_fh()
+    if not fh:
+        return ""
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+
+def content_hash(content):
+    return unicode(hashlib.sha256(content).hexdigest())
+
+
 class CoverImageMirror(object):
     """Downloads images via HTTP, saves them to the database,
     then uploads them to S3.
@@ -26,11 +74,47 @@ class CoverImageMirror(object):
     DATA_SOURCE = None
     ONE_YEAR = datetime.timedelta(days=365)
 
-    def __init__(self, db, uploader=None):
+    # How many images to download at once.
+    CONCURRENCY = 5
+
+    # SHA-256 hashes of the placeholder images this source serves
+    # when it doesn't really have a cover. These are never mirrored
+    # or scaled. More can be added, for every source at once, with
+    # the sitewide setting named by PLACEHOLDER_HASHES_KEY, a JSON
+    # list of hashes.
+    PLACEHOLDER_HASHES = set()
+    PLACEHOLDER_HASHES_KEY = u"cover_image_placeholder_hashes"
+
+    PLACEHOLDER_EXCEPTION = 'Representation is a placeholder image.'
+
+    def __init__(self, db, uploader=None, placeholder_hashes=None):
         self._db = db
         self.data_source = DataSource.lookup(self._db, self.DATA_SOURCE)
         self.uploader = uploader or S3Uploader.from_config(self._db)
         self.log = logging.getLogger("Cover Image Mirror")
+        self._thread_pool = None
+        if placeholder_hashes is None:
+            placeholder_hashes = self.configured_placeholder_hashes(self._db)
+        self.placeholder_hashes = set(placeholder_hashes)
+
+    @classmethod
+    def configured_placeholder_hashes(cls, _db):
+        """The hashes of this source's placeholder images, and any
+        others named in the sitewide setting.
+        """
+        hashes = set(cls.PLACEHOLDER_HASHES)
+        configured = ConfigurationSetting.sitewide(
+            _db, cls.PLACEHOLDER_HASHES_KEY
+        ).json_value
+        if configured:
+            hashes.update(unicode(x) for x in configured)
+        return hashes
+
+    @property
+    def thread_pool(self):
+        if not self._thread_pool:
+            self._thread_pool = ThreadPool(self.CONCURRENCY)
+        return self._thread_pool
 
     def run(self):
         """Mirror all image resources associated with this data source."""
@@ -38,10 +122,9 @@ class CoverImageMirror(object):
                 Hyperlink.data_source==self.data_source)
         self.mirror_all_resources(q)
 
-    def mirror_all_resources(self, q, force=False):
+    def mirror_all_resources(self, q, force=False, batch_size=100):
         """Mirror all resources that match a query."""
         # Only mirror images.
-        batch_size=100
         now = datetime.datetime.utcnow()
         q = q.filter(Hyperlink.rel==Hyperlink.IMAGE)
         q = q.join(Hyperlink.resource).outerjoin(Resource.representation)
@@ -54,29 +137,159 @@ class CoverImageMirror(object):
             q = q.filter(Representation.fetch_exception==None)
             q = q.filter(Representation.mirror_exception==None)
 
+        # Page through the hyperlinks in ID order. Each batch picks up
+        # after the last hyperlink of the previous batch, so a
+        # hyperlink is only tried once per run even if it fails.
+        q = q.order_by(Hyperlink.id)
         resultset = q.limit(batch_size).all()
-        blacklist = set()
         #print "About to mirror %d images." % q.count()
         while resultset:
             #print "Mirroring %d images." % len(resultset)
             to_upload = []
+            do_get = self.prefetch(resultset)
             for hyperlink in resultset:
-                blacklist.add(hyperlink.id)
-                representation = self.mirror_hyperlink(hyperlink)
+                representation = self.mirror_hyperlink(
+                    hyperlink, do_get=do_get, commit=False
+                )
                 if not representation.fetch_exception:
                     to_upload.append(representation)
-            self.uploader.mirror_batch(to_upload)
+            self._db.commit()
+            to_upload = self.mirror_batch(to_upload)
             for rep in to_upload:
                 self.log.info("%s => %s %s" % (rep.url, rep.mirror_url, rep.mirrored_at))
-            resultset = q.filter(~Hyperlink.id.in_(blacklist)).limit(batch_size).all()
-            #print "Blacklist size now %d" % len(blacklist)
+            last_id = resultset[-1].id
+            resultset = q.filter(Hyperlink.id > last_id).limit(batch_size).all()
         self._db.commit()
 
-    def mirror_hyperlink(self, hyperlink):
+    def mirror_batch(self, representations):
+        """Upload a batch of images, uploading each distinct image only
+        once.
+
+        Placeholder images are marked as fetch failures and not
+        uploaded. An image whose bytes have already been mirrored, in
+        this batch or an earlier one, is pointed at the existing copy
+        instead of being uploaded again.
+
+        :return: The Representations that were mirrored, one way or
+            another.
+        """
+        hashes = dict()
+        for representation in representations:
+            content = image_content(representation)
+            if content:
+                hashes[representation] = content_hash(content)
+
+        originals = self.mirrored_representations(set(hashes.values()))
+        to_upload = []
+        duplicates = []
+        mirrored = []
+        for representation in representations:
+            digest = hashes.get(representation)
+            if not digest:
+                to_upload.append(representation)
+            elif digest in self.placeholder_hashes:
+                representation.fetch_exception = self.PLACEHOLDER_EXCEPTION
+            elif digest in originals and originals[digest] is not representation:
+                duplicates.append((representation, originals[digest]))
+            else:
+                originals[digest] = representation
+                to_upload.append(representation)
+
+        self.uploader.mirror_batch(to_upload)
+        table = cover_image_hash_table
+        for representation in to_upload:
+            if not representation.mirrored_at:
+                continue
+            mirrored.append(representation)
+            digest = hashes.get(representation)
+            if digest:
+                statement = insert(table).values(
+                    content_hash=digest, representation_id=representation.id
+                )
+                self._db.execute(statement.on_conflict_do_update(
+                    index_elements=[table.c.content_hash],
+                    set_=dict(
+                        representation_id=statement.excluded.representation_id
+                    )
+                ))
+
+        for representation, original in duplicates:
+            if original.mirrored_at and not original.mirror_exception:
+                representation.mirror_url = original.mirror_url
+                representation.mirrored_at = original.mirrored_at
+                mirrored.append(representation)
+        return mirrored
+
+    def mirrored_representations(self, hashes):
+        """Find the Representations that have already been mirrored for
+        a number of image hashes.
+
+        :return: A dictionary mapping hash to Representation.
+        """
+        if not hashes:
+            return dict()
+        table = cover_image_hash_table
+        qu = self._db.query(Representation, table.c.content_hash).join(
+            table, table.c.representation_id==Representation.id
+        ).filter(
+            table.c.content_hash.in_(hashes)
+        ).filter(
+            Representation.mirrored_at != None
+        ).filter(
+            Representation.mirror_exception == None
+        )
+        return dict((digest, representation) for representation, digest in qu)
+
+    def prefetch(self, hyperlinks):
+        """Download the images for a batch of hyperlinks concurrently.
+
+        Nothing here touches the database except for one query up
+        front, so the downloads can happen in the thread pool.
+
+        :return: A function to pass into Representation.get as
+            `do_get`. It hands over the images that were already
+            downloaded, and makes a normal HTTP request for anything
+            else.
+        """
+        urls = set(
+            x.resource.url for x in hyperlinks
+            if not x.resource.representation
+        )
+        if urls:
+            # Representation.get won't make a request for an image
+            # that's already in the database and fresh, so don't
+            # download those.
+            known = self._db.query(Representation.url).filter(
+                Representation.url.in_(urls)
+            )
+            urls -= set(url for (url,) in known)
+        urls = list(urls)
+        downloads = dict(zip(urls, self.thread_pool.map(self.download, urls)))
+
+        def do_get(url, headers, **kwargs):
+            if url not in downloads:
+                return Representation.simple_http_get(url, headers, **kwargs)
+            response, exception = downloads.pop(url)
+            if exception:
+                raise exception
+            return response
+        return do_get
+
+    @classmethod
+    def download(cls, url):
+        """Download an image, capturing any exception so it can be
+        raised again, and recorded, by Representation.get.
+        """
+        try:
+            return Representation.simple_http_get(url, {}), None
+        except Exception, e:
+            return None, e
+
+    def mirror_hyperlink(self, hyperlink, do_get=None, commit=True):
         resource = hyperlink.resource
         if not resource.representation:
             resource.representation, cached = Representation.get(
-                self._db, resource.url, max_age=self.ONE_YEAR)
+                self._db, resource.url, do_get=do_get, max_age=self.ONE_YEAR)
             representation = resource.representation
             if not representation.media_type or not representation.media_type.startswith('image/'):
                 representation.fetch_exception = (
@@ -89,7 +302,8 @@ class CoverImageMirror(object):
             representation.mirror_url = self.uploader.cover_image_url(
                 hyperlink.data_source, hyperlink.identifier,
                 filename)
-        self._db.commit()
+        if commit:
+            self._db.commit()
         return resource.representation
 
     types_for_image_extensions = { ".jpg" : "image/jpeg",
@@ -113,32 +327,108 @@ class CoverImageMirror(object):
         self.mirror_all_resources(q)
 
 
+def scale_image(job):
+    """Scale an image down to fit within one or more bounding boxes.
+
+    The image is decoded only once, however many sizes are asked
+    for. This runs in an ImageScaler worker process, so it deals only
+    in bytes and never touches the database.
+
+    :param job: A 3-tuple (content, sizes, format). `sizes` is a list
+        of (max_height, max_width) 2-tuples.
+
+    :return: A 3-tuple (size, thumbnails, exception). `size` is the
+        size of the original image, or None if it couldn't be read.
+        `thumbnails` has an item for each of `sizes`: a 2-tuple
+        (content, thumbnail_size), or None if the image already fits
+        in that box.
+    """
+    content, sizes, format = job
+    try:
+        image = Image.open(StringIO(content))
+        size = image.size
+        # A JPEG can be decoded at a fraction of its full size, which
+        # is a lot faster than decoding the whole thing. Ask for the
+        # smallest scale that's still big enough for every thumbnail.
+        image.draft(image.mode, (
+            max(width for height, width in sizes),
+            max(height for height, width in sizes)
+        ))
+        image.load()
+    except Exception, e:
+        return None, None, traceback.format_exc()
+
+    width, height = size
+    thumbnails = []
+    for max_height, max_width in sizes:
+        if height <= max_height and width <= max_width:
+            thumbnails.append(None)
+            continue
+
+        thumbnail = image.copy()
+        args = [(max_width, max_height), Image.ANTIALIAS]
+        try:
+            thumbnail.thumbnail(*args)
+        except IOError, e:
+            # Sometimes trying it a second time works.
+            thumbnail.thumbnail(*args)
+        if thumbnail.mode != 'RGB':
+            thumbnail = thumbnail.convert('RGB')
+
+        output = StringIO()
+        try:
+            thumbnail.save(output, format)
+        except IOError, e:
+            return size, None, "Could not save thumbnail: %s" % e
+        thumbnails.append((output.getvalue(), thumbnail.size))
+    return size, thumbnails, None
+
+
 class ImageScaler(object):
 
     DEFAULT_WIDTH = 200
     DEFAULT_HEIGHT = 300
 
-    def __init__(self, db, mirrors, uploader=None):
+    def __init__(self, db, mirrors, uploader=None, processes=None):
+        """Constructor.
+
+        :param processes: If this is more than 1, images will be
+            decoded, scaled and encoded in this many worker processes.
+            Otherwise they're scaled one at a time in this process.
+        """
         self._db = db
         self.data_source_ids = []
         self.uploader = uploader or S3Uploader.from_config(self._db)
         self.log = logging.getLogger("Cover Image Scaler")
+        self.processes = processes
+
+        # Images with these hashes are never scaled.
+        self.placeholder_hashes = set()
+
+        # Maps the hash of each image scaled during this run to the
+        # results, so an identical image can reuse them.
+        self.scaled_images = dict()
 
         for mirror in mirrors:
             data_source_name = mirror.DATA_SOURCE
             data_source = DataSource.lookup(self._db, data_source_name)
             self.data_source_ids.append(data_source.id)
+            hashes = getattr(mirror, 'placeholder_hashes', None)
+            if hashes is None:
+                hashes = mirror.configured_placeholder_hashes(self._db)
+            self.placeholder_hashes.update(hashes)
 
 
     def run(self, destination_height=None, destination_width=None,
-            batch_size=100, upload=True, force=False):
+            batch_size=100, upload=True, force=False, sizes=None):
         q = self._db.query(Hyperlink).filter(
             Hyperlink.data_source_id.in_(self.data_source_ids))
         self.scale_all_resources(q, destination_height, destination_width,
-                                 batch_size, upload, force=force)
+                                 batch_size, upload, force=force,
+                                 sizes=sizes)
 
     def scale_edition(self, edition, destination_height=None,
-                      destination_width=None, upload=True):
+                      destination_width=None, upload=True, sizes=None):
         """Make sure that one specific edition has its cover(s) scaled."""
         # Find all resources for this edition's primary identifier.
         if isinstance(edition, Identifier):
@@ -150,66 +440,323 @@ class ImageScaler(object):
                 Hyperlink.rel==Hyperlink.IMAGE)
         self.scale_all_resources(
             q, destination_height, destination_width,
-            upload=upload)
+            upload=upload, sizes=sizes)
 
     def scale_all_resources(
             self, q, destination_height=None, destination_width=None,
-            batch_size=100, upload=True, force=False):
+            batch_size=100, upload=True, force=False, sizes=None):
+        """Scale all the images that match a query.
 
-        destination_width = destination_width or self.DEFAULT_WIDTH
-        destination_height = destination_height or self.DEFAULT_HEIGHT
+        :param sizes: A list of (height, width) 2-tuples. Each image
+            is decoded once and scaled to every one of these sizes. If
+            this is not provided, the images are scaled to
+            `destination_height` and `destination_width`.
+        """
+        if not sizes:
+            sizes = [(destination_height or self.DEFAULT_HEIGHT,
+                      destination_width or self.DEFAULT_WIDTH)]
 
-        # Find all resources that either don't have a thumbnail, or
-        # whose thumbnail was not mirrored.
         q = q.filter(Hyperlink.rel==Hyperlink.IMAGE)
         q = q.join(Hyperlink.resource).join(Resource.representation).filter(
             Representation.fetched_at != None).filter(
             Representation.fetch_exception == None)
+
+        if not force:
+            # Find all resources that are missing a thumbnail for at
+            # least one of the sizes.
+            q = q.filter(or_(*[
+                self._missing_thumbnail(height, width)
+                for height, width in sizes
+            ]))
+
+        # Page through the images in Resource ID order. Each batch
+        # picks up after the last resource of the previous batch, so
+        # an image is scaled at most once per run, even if scaling
+        # fails or it's linked from more than one identifier.
+        q = q.order_by(Resource.id)
+        self.scaled_images = dict()
+        pool = None
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes)
+        try:
+            self._scale_all_resources(q, sizes, batch_size, upload, pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    @classmethod
+    def _missing_thumbnail(cls, height, width):
+        """A clause that's true for Representations that don't have a
+        mirrored thumbnail that fits in the given box.
+
+        Scaling keeps an image's aspect ratio and makes it as big as
+        will fit, so a thumbnail for this box is no bigger than the box
+        and touches at least one of its edges. An image that already
+        fits in the box doesn't need a thumbnail at all.
+        """
         thumbnail = aliased(Representation)
-        q = q.outerjoin(thumbnail, Representation.thumbnails)
+        has_thumbnail = exists().where(
+            and_(thumbnail.thumbnail_of_id==Representation.id,
+                 thumbnail.mirrored_at != None,
+                 thumbnail.image_height <= height,
+                 thumbnail.image_width <= width,
+                 or_(thumbnail.image_height == height,
+                     thumbnail.image_width == width))
+        )
+        fits = and_(Representation.image_height != None,
+                    Representation.image_width != None,
+                    Representation.image_height <= height,
+                    Representation.image_width <= width)
+        return ~or_(fits, has_thumbnail)
 
-        if force:
-            now = datetime.datetime.utcnow()
-            q = q.filter(or_(
-                    thumbnail.id==None, thumbnail.mirrored_at==None,
-                    thumbnail.mirrored_at<now))
+    def destination_url(self, hyperlink, height, width):
+        """The URL to mirror a thumbnail of a hyperlink's image to.
+
+        Both dimensions of the box go into the URL, so sizes that share
+        a height don't overwrite each other. Thumbnails of the default
+        size keep the URL they've always had.
+        """
+        if (height, width) == (self.DEFAULT_HEIGHT, self.DEFAULT_WIDTH):
+            filename = "cover.jpg"
         else:
-            q = q.filter(or_(
-                    thumbnail.id==None,
-                    thumbnail.mirrored_at==None))
-        blacklist = set()
+            filename = "cover-%dx%d.jpg" % (width, height)
+        return self.uploader.cover_image_url(
+            hyperlink.data_source, hyperlink.identifier, filename, height
+        )
+
+    def _scale_all_resources(self, q, sizes, batch_size, upload, pool):
         resultset = q.limit(batch_size).all()
         while len(resultset):
             self.log.debug("About to scale %d", len(resultset))
             total = 0
             a = time.time()
             to_upload = []
-            for hyperlink in resultset:
-                destination_url = self.uploader.cover_image_url(
-                    hyperlink.data_source, hyperlink.identifier,
-                    "cover.jpg", destination_height)
-                thumbnail, is_new = hyperlink.resource.representation.scale(
-                    destination_height, destination_width,
-                    destination_url, "image/jpeg", force=True)
-                if thumbnail.scale_exception:
-                    self.log.error("Could not scale %s: %s" % (
-                        hyperlink.resource.url, thumbnail.scale_exception))
-                else:
-                    # Most likely this resource doesn't need to be
-                    # thumbnailed. Add it to the blacklist so we don't
-                    # pick it up again.
-                    blacklist.add(hyperlink.resource.id)
-                    if thumbnail.resource:
-                        blacklist.add(thumbnail.resource.id)
-                    to_upload.append(thumbnail)
-                    total += 1
+            scaled, duplicates = self.scale_batch(resultset, sizes, pool)
+            for hyperlink, thumbnails in scaled:
+                for thumbnail in thumbnails:
+                    if thumbnail.scale_exception:
+                        self.log.error("Could not scale %s: %s" % (
+                            hyperlink.resource.url, thumbnail.scale_exception))
+                    elif thumbnail not in to_upload:
+                        to_upload.append(thumbnail)
+                        total += 1
             self.log.debug("%.2f sec to scale %d", (time.time()-a), total)
             a = time.time()
             if upload:
                 self.uploader.mirror_batch(to_upload)
+                for thumbnail, original in duplicates:
+                    if original.mirrored_at and not original.mirror_exception:
+                        thumbnail.mirror_url = original.mirror_url
+                        thumbnail.mirrored_at = original.mirrored_at
             self._db.commit()
             self.log.debug("%.2f sec to upload %d", (time.time()-a), total)
             a = time.time()
-            resultset = q.filter(~Resource.id.in_(blacklist)).limit(batch_size).all()
+            last_id = resultset[-1].resource.id
+            resultset = q.filter(Resource.id > last_id).limit(batch_size).all()
 
         self._db.commit()
+
+    def scale_batch(self, hyperlinks, sizes, pool=None):
+        """Scale the images behind a batch of hyperlinks.
+
+        Placeholder images are marked as fetch failures and not
+        scaled. An image with the same bytes as one already scaled
+        during this run gets thumbnails that share that image's.
+
+        :param sizes: A list of (height, width) 2-tuples.
+
+        :param pool: A multiprocessing.Pool. If this is provided,
+            bitmap images are scaled in its worker processes, and
+            this process only keeps the database up to date.
+
+        :return: A 2-tuple (scaled, duplicates). `scaled` is a list of
+            (hyperlink, thumbnails) 2-tuples, one per distinct image.
+            `thumbnails` holds the Representations to be mirrored. If
+            an image couldn't be scaled, that's the original
+            Representation, with its scale_exception set.
+            `duplicates` is a list of (thumbnail, original) 2-tuples.
+            Each `thumbnail` stands in for `original`, without its own
+            copy of the bytes, and shares its mirror instead of being
+            uploaded.
+        """
+        scaled = []
+        duplicates = []
+        jobs = []
+        copies = []
+        seen = set()
+        digests = set()
+        for hyperlink in hyperlinks:
+            if hyperlink.resource.id in seen:
+                continue
+            seen.add(hyperlink.resource.id)
+            representation = hyperlink.resource.representation
+            destination_urls = [
+                self.destination_url(hyperlink, height, width)
+                for height, width in sizes
+            ]
+            if representation.clean_media_type != Representation.SVG_MEDIA_TYPE:
+                content = image_content(representation)
+                digest = content_hash(content)
+                if digest in self.placeholder_hashes:
+                    representation.fetch_exception = (
+                        CoverImageMirror.PLACEHOLDER_EXCEPTION
+                    )
+                elif digest in digests or digest in self.scaled_images:
+                    copies.append((hyperlink, destination_urls, digest))
+                else:
+                    digests.add(digest)
+                    jobs.append((hyperlink, destination_urls, content, digest))
+                continue
+
+            # An SVG image has to be rasterized by
+            # Representation.as_image before it can be scaled.
+            thumbnails = []
+            for (height, width), destination_url in zip(
+                    sizes, destination_urls):
+                thumbnail, is_new = representation.scale(
+                    height, width, destination_url, "image/jpeg", force=True)
+                thumbnails.append(thumbnail)
+            scaled.append((hyperlink, thumbnails))
+
+        if jobs:
+            if pool:
+                map_ = pool.map
+            else:
+                map_ = map
+            results = map_(scale_image, [
+                (content, sizes, "jpeg")
+                for hyperlink, destination_urls, content, digest in jobs
+            ])
+            for job, result in zip(jobs, results):
+                hyperlink, destination_urls, content, digest = job
+                representation = hyperlink.resource.representation
+                thumbnails = self.record_scaled_images(
+                    representation, destination_urls, "image/jpeg", *result
+                )
+                scaled.append((hyperlink, thumbnails))
+                size, ignore, exception = result
+                if size and not exception:
+                    self._db.flush()
+                    self.scaled_images[digest] = (size, [
+                        None if x is representation else x.id
+                        for x in thumbnails
+                    ])
+
+        for hyperlink, destination_urls, digest in copies:
+            if digest not in self.scaled_images:
+                # The image this one duplicates couldn't be
+                # scaled. Leave it for the next run.
+                continue
+            size, original_ids = self.scaled_images[digest]
+            thumbnails, copied = self.record_duplicate_images(
+                hyperlink.resource.representation, destination_urls,
+                size, original_ids
+            )
+            scaled.append((hyperlink, thumbnails))
+            duplicates.extend(copied)
+        return scaled, duplicates
+
+    def record_scaled_images(self, representation, destination_urls,
+                             destination_media_type, size, thumbnails,
+                             exception):
+        """Update the database with the outcome of scale_image.
+
+        This does the bookkeeping that Representation.scale does after
+        it has scaled an image, so the results are the same whichever
+        way an image was scaled. TestImageScaler checks that they are.
+
+        :param destination_urls: The URL of each thumbnail, in the
+            same order as `thumbnails`.
+
+        :return: A list of the Representations that should be mirrored.
+        """
+        if not size:
+            # The original couldn't be read as an image at all. This
+            # most likely indicates an error during the fetch phase.
+            representation.scale_exception = exception
+            representation.scaled_at = None
+            representation.fetch_exception = (
+                "Error found while scaling: %s" % exception
+            )
+            return [representation]
+
+        representation.image_width, representation.image_height = size
+        if exception:
+            representation.scale_exception = exception
+            representation.scaled_at = None
+            return [representation]
+
+        results = []
+        for destination_url, scaled in zip(destination_urls, thumbnails):
+            if not scaled:
+                results.append(self._unscaled(representation, destination_url))
+                continue
+            content, thumbnail_size = scaled
+            results.append(self._thumbnail(
+                representation, destination_url, destination_media_type,
+                content, thumbnail_size
+            ))
+        return results
+
+    def record_duplicate_images(self, representation, destination_urls,
+                                size, original_ids):
+        """Give an image thumbnails that share the bytes and mirror of
+        the thumbnails made earlier for an image with the same bytes.
+
+        The new thumbnails don't store the bytes again; their
+        mirror_url points at the earlier thumbnail's.
+
+        :param original_ids: The ID of each earlier thumbnail, in the
+            same order as `destination_urls`, or None where the
+            earlier image was its own thumbnail.
+
+        :return: A 2-tuple (thumbnails, duplicates), as for the items
+            of scale_batch's return value.
+        """
+        representation.image_width, representation.image_height = size
+        thumbnails = []
+        duplicates = []
+        for destination_url, original_id in zip(destination_urls, original_ids):
+            if original_id is None:
+                thumbnails.append(
+                    self._unscaled(representation, destination_url)
+                )
+                continue
+            original = self._db.query(Representation).get(original_id)
+            thumbnail = self._thumbnail(
+                representation, destination_url, original.media_type,
+                None, (original.image_width, original.image_height)
+            )
+            thumbnail.mirror_url = original.mirror_url
+            duplicates.append((thumbnail, original))
+        return thumbnails, duplicates
+
+    def _unscaled(self, representation, destination_url):
+        """The image already fits in this size, so it's its own
+        thumbnail.
+        """
+        for thumbnail in list(representation.thumbnails):
+            if thumbnail.url == destination_url:
+                representation.thumbnails.remove(thumbnail)
+        return representation
+
+    def _thumbnail(self, representation, destination_url, media_type,
+                   content, size):
+        thumbnail, is_new = get_one_or_create(
+            self._db, Representation, url=destination_url,
+            media_type=media_type
+        )
+        if thumbnail not in representation.thumbnails:
+            thumbnail.thumbnail_of = representation
+
+        # The thumbnail is new or has changed, so it needs to be
+        # mirrored (again) to its own URL.
+        thumbnail.mirror_url = thumbnail.url
+        thumbnail.mirrored_at = None
+        thumbnail.mirror_exception = None
+        thumbnail.content = content
+        thumbnail.image_width, thumbnail.image_height = size
+        thumbnail.scale_exception = None
+        thumbnail.scaled_at = datetime.datetime.utcnow()
+        return thumbnail
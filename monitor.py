@@ -1,10 +1,15 @@
+import datetime
 import isbnlib
 import csv
 import sys
 
 from nose.tools import set_trace
 from psycopg2.extras import NumericRange
-from sqlalchemy import or_
+from sqlalchemy import (
+    and_,
+    exists,
+    or_,
+)
 from sqlalchemy.orm import (
     aliased,
 )
@@ -30,6 +35,7 @@ from core.model import (
     Equivalency,
     Identifier,
     LicensePool,
+    Measurement,
     Subject,
     Work,
 )
@@ -59,42 +65,84 @@ class ContentCafeDemandMeasurementSweep(IdentifierSweepMonitor):
     """Ensure that every ISBN directly associated with a commercial
     identifier has a recent demand measurement.
 
+    ISBNs whose most recent Content Cafe popularity measurement is
+    younger than `max_age` are skipped, so a sweep only does work for
+    the measurements that have gone stale.
+
     :TODO: This misses a lot of ISBNs, since 3M and Axis ISBNs aren't
     directly associated with a commercial identifier.
     """
 
-    def __init__(self, _db, batch_size=100, interval_seconds=3600*48):
+    DEFAULT_MAX_AGE = datetime.timedelta(days=30)
+
+    def __init__(self, _db, batch_size=100, interval_seconds=3600*48,
+                 max_age=None):
         super(ContentCafeDemandMeasurementSweep, self).__init__(
             _db,
             "Content Cafe demand measurement sweep",
             interval_seconds)
-        self.client = ContentCafeAPI(_db, mirror=None)
+        self.client = ContentCafeAPI.from_config(_db, mirror=None)
         self.batch_size = batch_size
+        if max_age is None:
+            max_age = self.DEFAULT_MAX_AGE
+        elif not isinstance(max_age, datetime.timedelta):
+            max_age = datetime.timedelta(days=max_age)
+        self.max_age = max_age
 
     def identifier_query(self):
-        # TODO: Outer join to Measurement. If measurement value is
-        # None or less than a year old, skip it.
+        # Both conditions are written as EXISTS subqueries rather than
+        # joins, so that each ISBN shows up once and the batches can
+        # be paged through by Identifier.id.
         input_identifier = aliased(Identifier)
-
-        output_join_clause = Identifier.id==Equivalency.output_id
-        input_join_clause = input_identifier.id==Equivalency.input_id
-
-        qu = self._db.query(Identifier).join(
-            Equivalency, output_join_clause).join(
-                input_identifier, input_join_clause
-            ).filter(Identifier.type==Identifier.ISBN).filter(
+        is_commercial = exists().where(
+            and_(
+                Equivalency.output_id==Identifier.id,
+                Equivalency.input_id==input_identifier.id,
                 input_identifier.type.in_(
                     [Identifier.OVERDRIVE_ID, Identifier.THREEM_ID,
-                     Identifier.AXIS_360_ID])
-            ).order_by(Identifier.id)
+                     Identifier.AXIS_360_ID]
+                )
+            )
+        )
+
+        cutoff = datetime.datetime.utcnow() - self.max_age
+        is_fresh = exists().where(
+            and_(
+                Measurement.identifier_id==Identifier.id,
+                Measurement.data_source_id==self.client.data_source.id,
+                Measurement.quantity_measured==Measurement.POPULARITY,
+                Measurement.is_most_recent==True,
+                Measurement.taken_at >= cutoff,
+            )
+        )
+
+        qu = self._db.query(Identifier).filter(
+            Identifier.type==Identifier.ISBN
+        ).filter(is_commercial).filter(~is_fresh).order_by(Identifier.id)
         return qu
 
+    def process_batch(self, identifiers):
+        """Measure the popularity of a whole batch of ISBNs at once,
+        instead of calling process_identifier on each one.
+        """
+        isbns = [x for x in identifiers if self.is_isbn(x)]
+        if isbns:
+            self.client.measure_popularities(
+                isbns, self.client.ONE_YEAR_AGO
+            )
+
     def process_identifier(self, identifier):
-        isbn = identifier.identifier
-        if isbn and (isbnlib.is_isbn10(isbn) or isbnlib.is_isbn13(isbn)):
+        if self.is_isbn(identifier):
             self.client.measure_popularity(identifier, self.client.ONE_YEAR_AGO)
         return True
 
+    @classmethod
+    def is_isbn(cls, identifier):
+        isbn = identifier.identifier
+        return bool(
+            isbn and (isbnlib.is_isbn10(isbn) or isbnlib.is_isbn13(isbn))
+        )
+
 
 class ChildrensBooksWithNoAgeRangeMonitor(WorkSweepMonitor):
 
@@ -36,6 +36,7 @@ from core.scripts import (
 from core.util.permanent_work_id import WorkIDCalculator
 from core.util.personal_names import contributor_name_match_ratio
 
+from catalog import CatalogRegistrationJob
 from mirror import ImageScaler
 from oclc import LinkedDataCoverageProvider
 from overdrive import OverdriveCoverImageMirror
@@ -385,13 +386,25 @@ class CoverImageScaleScript(Script):
     bootstrapping of a large dataset.
     """
 
-    def __init__(self, force=False):
+    def __init__(self, force=False, processes=None):
         self.force = force
+        self.processes = processes
         super(CoverImageScaleScript, self).__init__()
 
     def run(self):
         mirrors = [OverdriveCoverImageMirror]
-        ImageScaler(self._db, mirrors).run(force=self.force)
+        ImageScaler(self._db, mirrors, processes=self.processes).run(
+            force=self.force
+        )
+
+
+class CatalogRegistrationJobScript(Script):
+    """Add the URNs from any unfinished CatalogRegistrationJobs to
+    their catalogs.
+    """
+
+    def run(self):
+        CatalogRegistrationJob.run_all(self._db)
 
 
 class PermanentWorkIDStressTestGenerationScript(Script):
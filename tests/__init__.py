@@ -7,6 +7,12 @@ from core.testing import (
     package_setup,
 )
 
+# These modules define tables of their own, which have to be part of
+# the schema before package_setup creates it.
+import canonicalize
+import catalog
+import mirror
+
 package_setup()
 
 def sample_data(filename, sample_data_dir):
@@ -0,0 +1,101 @@
+import json
+from nose.tools import set_trace, eq_
+from sqlalchemy import create_engine
+from sqlalchemy.orm import (
+    Session,
+    scoped_session,
+    sessionmaker,
+)
+from sqlalchemy.pool import QueuePool
+
+from .test_controller import ControllerTest
+
+from app import (
+    Conf,
+    shutdown_session,
+)
+
+
+class RecordingSession(Session):
+    """A Session that keeps track of how each request ended."""
+
+    endings = []
+
+    def commit(self):
+        self.endings.append("commit")
+        return super(RecordingSession, self).commit()
+
+    def rollback(self):
+        self.endings.append("rollback")
+        return super(RecordingSession, self).rollback()
+
+
+class TestConf(object):
+
+    def setup(self):
+        self.old = (Conf.db, Conf.engine)
+        Conf.engine = create_engine(
+            "sqlite://", poolclass=QueuePool, pool_size=2, max_overflow=1
+        )
+        Conf.db = scoped_session(
+            sessionmaker(bind=Conf.engine, class_=RecordingSession)
+        )
+        RecordingSession.endings = []
+
+    def teardown(self):
+        Conf.db.remove()
+        Conf.db, Conf.engine = self.old
+
+    def test_pool_status(self):
+        eq_(dict(size=2, checked_in=0, checked_out=0, overflow=-2),
+            Conf.pool_status())
+
+        Conf.db.execute("select 1")
+        eq_(1, Conf.pool_status()['checked_out'])
+
+        # Without an engine there's nothing to report.
+        Conf.engine = None
+        eq_(dict(), Conf.pool_status())
+
+    def test_session_removed_after_commit(self):
+        first = Conf.db()
+        first.execute("select 1")
+        shutdown_session(None)
+
+        # The request was committed, and its connection went back to
+        # the pool.
+        eq_(["commit"], RecordingSession.endings)
+        eq_(False, Conf.db.registry.has())
+        eq_(0, Conf.pool_status()['checked_out'])
+
+        # The next request gets a new session.
+        assert Conf.db() is not first
+
+    def test_session_removed_after_rollback(self):
+        Conf.db.execute("select 1")
+        shutdown_session(Exception("Request failed"))
+
+        eq_(["rollback"], RecordingSession.endings)
+        eq_(False, Conf.db.registry.has())
+        eq_(0, Conf.pool_status()['checked_out'])
+
+
+class TestDatabasePool(ControllerTest):
+
+    def setup(self):
+        super(TestDatabasePool, self).setup()
+        self.old_db = Conf.db
+        Conf.db = self._db
+
+    def teardown(self):
+        Conf.db = self.old_db
+        super(TestDatabasePool, self).teardown()
+
+    def test_requires_auth(self):
+        client = self.app.test_client()
+        response = client.get('/database-pool')
+        eq_(401, response.status_code)
+
+        response = client.get('/database-pool', headers=self.valid_auth)
+        eq_(200, response.status_code)
+        eq_(Conf.pool_status(), json.loads(response.data))
@@ -1,6 +1,8 @@
 import logging
+import threading
+import time
 
-from nose.tools import set_trace, eq_
+from nose.tools import set_trace, eq_, assert_raises
 
 from . import (
     DatabaseTest,
@@ -14,6 +16,10 @@ from test_viaf import MockVIAFClientLookup
 
 from canonicalize import (
     AuthorNameCanonicalizer, 
+    CanonicalizationCache,
+    CanonicalizationTimeout,
+    ContributorNameIndex,
+    canonicalization_cache_table,
 )
 
 
@@ -70,6 +76,62 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
         eq_(canonicalized_author, contributor_1.sort_name)
 
 
+    def test_canonicalize_author_names(self):
+        contributor, ignore = self._contributor(sort_name="Zebra, Ant")
+        contributor.display_name = "Ant Zebra"
+        other, ignore = self._contributor(sort_name="Yarrow, Bloom")
+        other.display_name = "Bloom Yarrow"
+        identifier = self._identifier()
+
+        # The shortened name is found in the database, as is the
+        # full name. Duplicate requests are answered once.
+        pairs = [
+            (None, "Ant Zebra with Someone Else"),
+            (identifier, "Bloom Yarrow"),
+            (identifier, "Bloom Yarrow"),
+            (None, None),
+        ]
+        results = self.canonicalizer.canonicalize_author_names(pairs)
+        eq_(3, len(results))
+        eq_("Zebra, Ant", results[(None, "Ant Zebra with Someone Else")])
+        eq_("Yarrow, Bloom", results[(identifier, "Bloom Yarrow")])
+        eq_(None, results[(None, None)])
+
+    def test_canonicalize_author_names_falls_back_to_default_name(self):
+        # Neither the database nor VIAF knows about this author.
+        self.canonicalizer.viaf.queue_lookup([], [])
+        results = self.canonicalizer.canonicalize_author_names(
+            [(None, "Nobody Known")]
+        )
+        eq_("Known, Nobody", results[(None, "Nobody Known")])
+
+
+    def test_canonicalize_author_names_error(self):
+        class BrokenVIAF(object):
+            def lookup_by_name(self, *args, **kwargs):
+                raise IOError("VIAF is down")
+
+        # An error means there's no answer for a name, not even a
+        # default name.
+        canonicalizer = AuthorNameCanonicalizer(self._db, viaf=BrokenVIAF())
+        results = canonicalizer.canonicalize_author_names(
+            [(None, "Nobody Known")]
+        )
+        eq_({(None, "Nobody Known") : None}, results)
+
+    def test_run_in_own_session_uses_injected_clients(self):
+        class BrokenVIAF(object):
+            def lookup_by_name(self, *args, **kwargs):
+                raise IOError("VIAF is down")
+
+        # The canonicalizer created for the worker uses the VIAF
+        # client that was passed in, and its error is raised again.
+        canonicalizer = AuthorNameCanonicalizer(self._db, viaf=BrokenVIAF())
+        assert_raises(
+            IOError, canonicalizer._run_in_own_session,
+            '_sort_name_from_viaf_search', None, "Nobody Known", []
+        )
+
     def test_oclc_contributor(self):
         # TODO: make sure isbn ids get directed to OCLC
         pass
@@ -80,7 +142,340 @@ class TestAuthorNameCanonicalizer(DatabaseTest):
         pass
 
 
+class TestCanonicalizationCache(DatabaseTest):
+
+    def setup(self):
+        super(TestCanonicalizationCache, self).setup()
+        self.now = 1000
+        self.cache = CanonicalizationCache(
+            ttl=60, max_size=2, clock=lambda: self.now
+        )
+
+    def test_key(self):
+        # Unicode composition and whitespace are normalized away.
+        eq_((u"Jos\xe9 Saramago", u""),
+            self.cache.key(None, u" Jose\u0301  Saramago "))
+
+        identifier = self._identifier()
+        eq_((u"Ant Zebra", identifier.urn),
+            self.cache.key(identifier, "Ant Zebra"))
+
+    def test_get_and_set(self):
+        key = self.cache.key(None, "Ant Zebra")
+        eq_(CanonicalizationCache.MISSING, self.cache.get(key))
+
+        self.cache.set(key, "Zebra, Ant")
+        eq_("Zebra, Ant", self.cache.get(key))
+
+        # None is a result like any other.
+        other_key = self.cache.key(None, "Nobody")
+        self.cache.set(other_key, None)
+        eq_(None, self.cache.get(other_key))
+
+    def test_ttl(self):
+        key = self.cache.key(None, "Ant Zebra")
+        self.cache.set(key, "Zebra, Ant")
+        self.now += 59
+        eq_("Zebra, Ant", self.cache.get(key))
+        self.now += 1
+        eq_(CanonicalizationCache.MISSING, self.cache.get(key))
+        eq_(0, len(self.cache))
+
+    def test_lru_bound(self):
+        k1, k2, k3 = [self.cache.key(None, x) for x in ("A", "B", "C")]
+        self.cache.set(k1, "1")
+        self.cache.set(k2, "2")
+
+        # Using k1 makes k2 the least recently used result.
+        self.cache.get(k1)
+        self.cache.set(k3, "3")
+        eq_(2, len(self.cache))
+        eq_("1", self.cache.get(k1))
+        eq_(CanonicalizationCache.MISSING, self.cache.get(k2))
+        eq_("3", self.cache.get(k3))
+
+    def test_canonicalize_author_name_uses_cache(self):
+        contributor, ignore = self._contributor(sort_name="Zebra, Ant")
+        contributor.display_name = "Ant Zebra"
+        canonicalizer = AuthorNameCanonicalizer(self._db, cache=self.cache)
+        eq_("Zebra, Ant",
+            canonicalizer.canonicalize_author_name(None, "Ant Zebra"))
+
+        # Once the answer is cached, the database isn't consulted.
+        contributor.sort_name = "Changed, Ant"
+        eq_("Zebra, Ant",
+            canonicalizer.canonicalize_author_name(None, "Ant Zebra"))
+
+
+    def test_default_name_is_not_cached(self):
+        # Neither the database nor VIAF knows about this author, so
+        # the canonicalizer guesses. The guess isn't cached.
+        canonicalizer = AuthorNameCanonicalizer(self._db, cache=self.cache)
+        canonicalizer.viaf = MockVIAFClientLookup(
+            self._db, logging.getLogger("VIAF Client Test")
+        )
+        canonicalizer.viaf.queue_lookup([], [])
+        eq_("Known, Nobody",
+            canonicalizer.canonicalize_author_name(None, "Nobody Known"))
+        eq_(0, len(self.cache))
+
+        # The same goes for canonicalize_author_names.
+        canonicalizer.viaf.queue_lookup([], [])
+        eq_({(None, "Nobody Known") : "Known, Nobody"},
+            canonicalizer.canonicalize_author_names([(None, "Nobody Known")]))
+        eq_(0, len(self.cache))
+
+    def test_persistent_set_replaces_result(self):
+        cache = CanonicalizationCache(persistent=True)
+        key = cache.key(None, "Ant Zebra")
+        cache.set(key, "Zebra, A.", self._db)
+        cache.set(key, "Zebra, Ant", self._db)
+
+        # There's one row for the key, with the latest result.
+        cache.clear()
+        eq_("Zebra, Ant", cache.get(key, self._db))
+        eq_(1, self._db.execute(
+            canonicalization_cache_table.count()
+        ).scalar())
+
+
+class TestContributorNameIndex(DatabaseTest):
+
+    def setup(self):
+        super(TestContributorNameIndex, self).setup()
+        self.index = ContributorNameIndex()
+
+    def test_normalize_title(self):
+        eq_(u"the hobbit or there and back again",
+            self.index.normalize_title("The Hobbit; or, There and Back Again"))
+
+    def test_load(self):
+        edition = self._edition(title="The Color Purple", authors=[])
+        contributor, ignore = self._contributor(sort_name="Walker, Alice")
+        contributor.display_name = "Alice Walker"
+        edition.add_contributor(contributor, "Author")
+
+        entries = self.index.load(self._db, ["Alice Walker", "Nobody"])
+        eq_({u"Walker, Alice" : set([u"the color purple"])},
+            dict(entries["Alice Walker"]))
+        eq_({}, dict(entries["Nobody"]))
+
+        # Once an entry is loaded, it's not loaded again...
+        other = self._edition(title="Meridian", authors=[])
+        other.add_contributor(contributor, "Author")
+        self._db.flush()
+        eq_(set([u"the color purple"]),
+            self.index.load(self._db, ["Alice Walker"])["Alice Walker"]["Walker, Alice"])
+
+        # ...until it's invalidated.
+        self.index.invalidate("Alice Walker")
+        eq_(set([u"the color purple", u"meridian"]),
+            self.index.load(self._db, ["Alice Walker"])["Alice Walker"]["Walker, Alice"])
+
+    def test_sort_name_for(self):
+        eq_(None, self.index.sort_name_for(self._db, "Bloom Yarrow"))
+
+        c1, ignore = self._contributor(sort_name="Yarrow, B.")
+        c1.display_name = "Bloom Yarrow"
+        c2, ignore = self._contributor(sort_name="Yarrow, Bloom")
+        c2.display_name = "Bloom Yarrow"
+        edition = self._edition(title="A Book About Flowers", authors=[])
+        edition.add_contributor(c2, "Author")
+
+        # The contributor who wrote a matching title is chosen.
+        eq_("Yarrow, Bloom", self.index.sort_name_for(
+            self._db, "Bloom Yarrow", ["A Book About Flowers"]))
+        eq_("Yarrow, Bloom", self.index.sort_name_for(
+            self._db, "Bloom Yarrow", ["A Book About Flowers!"]))
+
+        # Otherwise the first contributor is chosen.
+        eq_("Yarrow, B.", self.index.sort_name_for(
+            self._db, "Bloom Yarrow", ["Something Else Entirely"]))
+        eq_("Yarrow, B.", self.index.sort_name_for(self._db, "Bloom Yarrow"))
+
+    def test_keys_are_normalized(self):
+        contributor, ignore = self._contributor(sort_name="Walker, Alice")
+        contributor.display_name = "Alice Walker"
+        self.index.load(self._db, ["Alice Walker"])
+        self.index.invalidate(u"Alice  Walker ")
+        eq_(CanonicalizationCache.MISSING,
+            self.index.entries.get(u"Alice Walker"))
+
+    def test_kept_up_to_date_by_events(self):
+        contributor, ignore = self._contributor(sort_name="Walker, Alice")
+        contributor.display_name = "Alice Walker"
+        self._db.commit()
+
+        def load():
+            self.index.load(self._db, ["Alice Walker"])
+            assert self.index.entries.get(u"Alice Walker") is not (
+                CanonicalizationCache.MISSING
+            )
+
+        # A new contribution doesn't change the index until it's
+        # committed, since until then it may be rolled back.
+        load()
+        edition = self._edition(title="Meridian", authors=[])
+        edition.add_contributor(contributor, "Author")
+        self._db.flush()
+        eq_({u"Walker, Alice" : set()},
+            dict(self.index.entries.get(u"Alice Walker")))
+
+        # Once it's committed, the entry is dropped, and reloaded
+        # with the change.
+        self._db.commit()
+        eq_(CanonicalizationCache.MISSING,
+            self.index.entries.get(u"Alice Walker"))
+        load()
+        eq_({u"Walker, Alice" : set([u"meridian"])},
+            dict(self.index.entries.get(u"Alice Walker")))
+
+        # The same happens for a new contributor with the same
+        # display name...
+        other, ignore = self._contributor(
+            sort_name="Walker, A.", display_name="Alice Walker"
+        )
+        self._db.commit()
+        eq_(CanonicalizationCache.MISSING,
+            self.index.entries.get(u"Alice Walker"))
+
+        # ...and for a contributor whose name changes.
+        load()
+        other.display_name = "A. Walker"
+        self._db.commit()
+        eq_(CanonicalizationCache.MISSING,
+            self.index.entries.get(u"Alice Walker"))
+
+    def test_canonicalizer_uses_index(self):
+        contributor, ignore = self._contributor(sort_name="Zebra, Ant")
+        contributor.display_name = "Ant Zebra"
+        canonicalizer = AuthorNameCanonicalizer(
+            self._db, contributor_index=self.index
+        )
+        eq_("Zebra, Ant", canonicalizer._canonicalize(None, "Ant Zebra"))
+        eq_({"Ant Zebra" : ("Zebra, Ant",)},
+            dict((k, tuple(v)) for k, v in
+                 self.index.load(self._db, ["Ant Zebra"]).items()))
+
+
+class TestCanonicalizationDeadline(DatabaseTest):
+
+    class CannedCanonicalizer(AuthorNameCanonicalizer):
+        """Gives each external strategy a canned answer after a delay,
+        instead of running it against a new database session.
+        """
+        def __init__(self, _db, answers, deadline):
+            super(TestCanonicalizationDeadline.CannedCanonicalizer, self).__init__(
+                _db, deadline=deadline
+            )
+            self.answers = answers
+
+        def _run_in_own_session(self, method_name, identifier_id, *args):
+            delay, answer = self.answers[method_name]
+            time.sleep(delay)
+            return answer
+
+    def canonicalizer(self, oclc, viaf, deadline=0.5):
+        answers = dict(
+            _sort_name_from_oclc=oclc, _sort_name_from_viaf_search=viaf
+        )
+        return self.CannedCanonicalizer(self._db, answers, deadline)
+
+    def canonicalize(self, canonicalizer):
+        return canonicalizer._canonicalize_externally_before(
+            self._identifier(), "Ant Zebra", [],
+            time.time() + canonicalizer.deadline
+        )
+
+    def test_oclc_answer_preferred(self):
+        canonicalizer = self.canonicalizer(
+            oclc=(0.1, "Zebra, Ant (OCLC)"), viaf=(0, "Zebra, Ant (VIAF)")
+        )
+        eq_("Zebra, Ant (OCLC)", self.canonicalize(canonicalizer))
+
+        # If OCLC has no answer, VIAF's is used.
+        canonicalizer = self.canonicalizer(
+            oclc=(0, None), viaf=(0.1, "Zebra, Ant (VIAF)")
+        )
+        eq_("Zebra, Ant (VIAF)", self.canonicalize(canonicalizer))
+
+    def test_slow_oclc_answer_ignored(self):
+        canonicalizer = self.canonicalizer(
+            oclc=(2, "Zebra, Ant (OCLC)"), viaf=(0, "Zebra, Ant (VIAF)")
+        )
+        start = time.time()
+        eq_("Zebra, Ant (VIAF)", self.canonicalize(canonicalizer))
+        assert time.time() - start < 1
+
+    def test_no_answer_before_deadline(self):
+        canonicalizer = self.canonicalizer(
+            oclc=(2, "Zebra, Ant (OCLC)"), viaf=(2, "Zebra, Ant (VIAF)"),
+            deadline=0.2
+        )
+        start = time.time()
+        assert_raises(
+            CanonicalizationTimeout, self.canonicalize, canonicalizer
+        )
+
+        # canonicalize_author_name falls back to a guess, and doesn't
+        # spend more than its deadline on both the shortened and the
+        # full name.
+        canonicalizer.cache = CanonicalizationCache()
+        identifier = self._identifier()
+        name = "Ant Zebra and Bloom Yarrow"
+        eq_(canonicalizer.default_name(name),
+            canonicalizer.canonicalize_author_name(identifier, name))
+        assert time.time() - start < 1
+
+        # The guess isn't cached, so the next request tries again.
+        key = canonicalizer.cache.key(identifier, name)
+        eq_(CanonicalizationCache.MISSING,
+            canonicalizer.cache.get(key, self._db))
+
+    def test_batch_deadline(self):
+        pairs = [(None, "Ant Zebra"), (None, "Bloom Yarrow")]
+        canonicalizer = self.canonicalizer(oclc=None, viaf=None, deadline=0.2)
+        canonicalizer.answers['_canonicalize_remotely'] = (0, "Known, Name")
+        eq_(dict((pair, "Known, Name") for pair in pairs),
+            canonicalizer.canonicalize_author_names(pairs, concurrency=2))
+
+        # Names that OCLC and VIAF can't be asked about in time get a
+        # default name.
+        canonicalizer.answers['_canonicalize_remotely'] = (2, "Known, Name")
+        start = time.time()
+        eq_({(None, "Ant Zebra") : "Zebra, Ant",
+             (None, "Bloom Yarrow") : "Yarrow, Bloom"},
+            canonicalizer.canonicalize_author_names(pairs, concurrency=2))
+        assert time.time() - start < 1
+
+    def test_no_answer_from_anyone(self):
+        canonicalizer = self.canonicalizer(oclc=(0, None), viaf=(0, None))
+        eq_(None, self.canonicalize(canonicalizer))
 
+    def test_lookups_shed_when_busy(self):
+        canonicalizer = self.canonicalizer(
+            oclc=(0, "Zebra, Ant (OCLC)"), viaf=(0, "Zebra, Ant (VIAF)")
+        )
+        canonicalizer._pending_lookups = threading.BoundedSemaphore(1)
 
+        # With one slot, only OCLC is asked.
+        eq_("Zebra, Ant (OCLC)", self.canonicalize(canonicalizer))
 
+        # With none, nobody is.
+        canonicalizer._pending_lookups.acquire()
+        assert_raises(
+            CanonicalizationTimeout, self.canonicalize, canonicalizer
+        )
 
+    def test_lookup_skipped_after_deadline(self):
+        canonicalizer = self.canonicalizer(
+            oclc=(0, "Zebra, Ant (OCLC)"), viaf=(0, "Zebra, Ant (VIAF)")
+        )
+        canonicalizer._pending_lookups = threading.BoundedSemaphore(1)
+        canonicalizer._pending_lookups.acquire()
+        assert_raises(
+            CanonicalizationTimeout, canonicalizer._run_before,
+            time.time() - 1, '_sort_name_from_oclc', None, "Ant Zebra", []
+        )
+        # The lookup's slot was given back.
+        eq_(True, canonicalizer._pending_lookups.acquire(False))
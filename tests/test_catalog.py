@@ -0,0 +1,204 @@
+from nose.tools import set_trace, eq_
+
+from core.model import (
+    Identifier,
+    IntegrationClient,
+    create,
+)
+
+from . import DatabaseTest
+from catalog import (
+    CatalogRegistrationJob,
+    CatalogUpdater,
+)
+
+
+class TestCatalogUpdater(DatabaseTest):
+
+    def setup(self):
+        super(TestCatalogUpdater, self).setup()
+        self.updater = CatalogUpdater(self._db)
+        self.collection = self._collection()
+
+    def test_add_and_remove(self):
+        identifier = self._identifier()
+        invalid_urn = "FAKE AS I WANNA BE"
+
+        added, repeated, invalid = self.updater.add(
+            self.collection, [identifier.urn, identifier.urn, invalid_urn]
+        )
+        eq_((201, 200, 400),
+            (added.status_code, repeated.status_code, invalid.status_code))
+        eq_([identifier], self.collection.catalog)
+
+        removed, missing = self.updater.remove(
+            self.collection, [identifier.urn, identifier.urn]
+        )
+        eq_((200, 404), (removed.status_code, missing.status_code))
+        eq_([], self.collection.catalog)
+
+    def test_insert_skips_catalogued_identifiers(self):
+        # Another request catalogued this identifier after we checked.
+        identifier = self._identifier()
+        self.updater._insert(self.collection, [identifier.id])
+        self.updater._insert(self.collection, [identifier.id])
+        eq_([identifier], self.collection.catalog)
+
+    def test_identifiers_for_urns(self):
+        existing = self._identifier(Identifier.GUTENBERG_ID)
+        new_urn = Identifier.URN_SCHEME_PREFIX + "Gutenberg%20ID/not-yet"
+        invalid_urn = "FAKE AS I WANNA BE"
+
+        result = self.updater.identifiers_for_urns(
+            [existing.urn, new_urn, invalid_urn, existing.urn]
+        )
+        eq_(set([existing.urn, new_urn]), set(result.keys()))
+        eq_(existing, result[existing.urn])
+
+        # A new identifier was created for the URN that didn't have one.
+        new = result[new_urn]
+        eq_((Identifier.GUTENBERG_ID, "not-yet"), (new.type, new.identifier))
+
+    def test_identifiers_for_urns_creates_in_bulk(self):
+        prefix = Identifier.URN_SCHEME_PREFIX + "Gutenberg%20ID/"
+        urns = [prefix + "new-%d" % i for i in range(3)]
+        result = self.updater.identifiers_for_urns(urns)
+        eq_(["new-0", "new-1", "new-2"],
+            [result[x].identifier for x in urns])
+        assert all(result[x].id for x in urns)
+
+        # Identifiers that for_foreign_id normalizes are found in
+        # their normalized form.
+        overdrive = self._identifier(
+            Identifier.OVERDRIVE_ID, foreign_id=u"abcd-efgh"
+        )
+        urn = Identifier.URN_SCHEME_PREFIX + "Overdrive%20ID/ABCD-EFGH"
+        eq_({urn : overdrive}, self.updater.identifiers_for_urns([urn]))
+
+    def test_create_identifiers(self):
+        # An identifier someone else created in the meantime is
+        # loaded instead of causing an error.
+        existing = self._identifier(
+            Identifier.GUTENBERG_ID, foreign_id=u"exists"
+        )
+        created = self.updater._create_identifiers(
+            Identifier.GUTENBERG_ID, set([u"exists", u"new"])
+        )
+        eq_(existing, created[(Identifier.GUTENBERG_ID, u"exists")])
+        new = created[(Identifier.GUTENBERG_ID, u"new")]
+        assert new.id != existing.id
+
+        eq_({}, self.updater._create_identifiers(Identifier.GUTENBERG_ID, set()))
+
+    def test_catalogued_identifier_ids(self):
+        catalogued = self._identifier()
+        uncatalogued = self._identifier()
+        self.collection.catalog_identifier(self._db, catalogued)
+        eq_(set([catalogued.id]), self.updater.catalogued_identifier_ids(
+            self.collection, [catalogued, uncatalogued]
+        ))
+        eq_(set(), self.updater.catalogued_identifier_ids(
+            self.collection, []
+        ))
+
+
+class TestCatalogRegistrationJob(DatabaseTest):
+
+    def setup(self):
+        super(TestCatalogRegistrationJob, self).setup()
+        self.collection = self._collection()
+        self.client = self._integration_client()
+
+    def test_process_chunk(self):
+        identifiers = [self._identifier() for i in range(3)]
+        urns = [x.urn + "\n" for x in identifiers] + ["\n"]
+        job = CatalogRegistrationJob.create(
+            self._db, self.collection, self.client, urns
+        )
+
+        # Blank lines are ignored.
+        eq_(3, job.total)
+        eq_([x.urn for x in identifiers], job.urns)
+        eq_(job.id, CatalogRegistrationJob.next_unfinished(self._db).id)
+
+        job.process_chunk(chunk_size=2)
+        eq_(2, job.processed)
+        eq_(None, job.finished)
+        eq_(set(identifiers[:2]), set(self.collection.catalog))
+        eq_([x.urn for x in identifiers[:2]],
+            [x.urn for x in job.results()])
+
+        job.process_chunk(chunk_size=2)
+        eq_(3, job.processed)
+        assert job.finished
+        eq_(set(identifiers), set(self.collection.catalog))
+        eq_(None, CatalogRegistrationJob.next_unfinished(self._db))
+
+        # Results can be fetched a page at a time.
+        [result] = job.results(offset=1, size=1)
+        eq_(identifiers[1].urn, result.urn)
+        eq_(201, result.status_code)
+
+    def test_run_all_moves_past_failed_job(self):
+        class FailingJob(CatalogRegistrationJob):
+            def process_chunk(self, chunk_size=None):
+                if self.id == failing.id:
+                    raise Exception("Database on fire")
+                return super(FailingJob, self).process_chunk(chunk_size)
+
+        identifier = self._identifier()
+        failing = CatalogRegistrationJob.create(
+            self._db, self.collection, self.client, [self._identifier().urn]
+        )
+        working = CatalogRegistrationJob.create(
+            self._db, self.collection, self.client, [identifier.urn]
+        )
+        # Rolling back would undo this test's setup too.
+        self._db.rollback = lambda: None
+        FailingJob.run_all(self._db)
+
+        # The failed job is finished, with the error recorded, and the
+        # job after it ran anyway.
+        failing = CatalogRegistrationJob.for_client(
+            self._db, failing.id, self.collection, self.client
+        )
+        assert failing.finished
+        eq_((0, u"Database on fire"), (failing.processed, failing.error))
+        working = CatalogRegistrationJob.for_client(
+            self._db, working.id, self.collection, self.client
+        )
+        eq_((1, None), (working.processed, working.error))
+        eq_([identifier], self.collection.catalog)
+        eq_(None, CatalogRegistrationJob.next_unfinished(self._db))
+
+    def test_empty_job_is_finished(self):
+        job = CatalogRegistrationJob.create(
+            self._db, self.collection, self.client, []
+        )
+        eq_(0, job.total)
+        assert job.finished
+        eq_(None, CatalogRegistrationJob.next_unfinished(self._db))
+
+    def test_for_client(self):
+        job = CatalogRegistrationJob.create(
+            self._db, self.collection, self.client, [self._identifier().urn]
+        )
+        found = CatalogRegistrationJob.for_client(
+            self._db, job.id, self.collection, self.client
+        )
+        eq_((job.id, 1, 0), (found.id, found.total, found.processed))
+
+        # Another client can't see the job. The fixture's clients all
+        # share a key, so this one gets its own.
+        other_client, ignore = create(
+            self._db, IntegrationClient, url=self._url, key=self._str
+        )
+        eq_(None, CatalogRegistrationJob.for_client(
+            self._db, job.id, self.collection, other_client
+        ))
+
+        # Nor can it be found through another collection.
+        other = self._collection()
+        eq_(None, CatalogRegistrationJob.for_client(
+            self._db, job.id, other, self.client
+        ))
@@ -3,25 +3,78 @@ from nose.tools import (
     eq_,
     assert_raises,
 )
+from collections import Counter
+import datetime
+import os
+
+from lxml import etree
+from suds.transport import (
+    Reply,
+    Transport,
+)
 
 from core.config import CannotLoadConfiguration
 from core.coverage import CoverageFailure
-from core.model import ExternalIntegration
+from core.model import (
+    ExternalIntegration,
+    Hyperlink,
+    Identifier,
+    Measurement,
+)
 from core.s3 import DummyS3Uploader
 
 from . import (
     DatabaseTest,
+    sample_data,
 )
+import content_cafe
 from content_cafe import (
     ContentCafeAPI,
     ContentCafeCoverageProvider,
+    ContentCafeSOAPClient,
+    ContentCafeSOAPError,
+    percentiles_from_histogram,
 )
 
 class DummyContentCafeAPI(object):
     pass
 
 class DummyContentCafeSOAPClient(object):
-    pass
+
+    def __init__(self, popularity=None):
+        self.popularity = popularity
+        self.cutoffs = []
+
+    def estimated_popularity(self, key, cutoff=None):
+        self.cutoffs.append(cutoff)
+        return self.popularity
+
+    def estimated_popularities(self, keys, cutoff=None):
+        self.cutoffs.append(cutoff)
+        return dict((key, self.popularity) for key in keys)
+
+class DummyResponse(object):
+    def __init__(self, content):
+        self.content = content
+
+class DummyHTTP(object):
+    """Serves Content Cafe pages from the sample files."""
+
+    PAGES = {
+        'Summary.aspx' : 'summaries.html',
+        'Excerpt.aspx' : 'excerpt.html',
+        'ReviewsDetail.aspx' : 'reviews.html',
+        'AuthorNotes.aspx' : 'author_notes.html',
+    }
+
+    def __init__(self):
+        self.requested = []
+
+    def get(self, url):
+        self.requested.append(url)
+        for page, filename in self.PAGES.items():
+            if page in url:
+                return DummyResponse(sample_data(filename, 'content_cafe'))
 
 class TestContentCafeAPI(DatabaseTest):
 
@@ -57,6 +110,321 @@ class TestContentCafeAPI(DatabaseTest):
         )
         eq_(True, isinstance(result, ContentCafeAPI))
 
+        # The HTTP connection pool can be configured through the
+        # integration.
+        integration.setting(ContentCafeAPI.POOL_SIZE).value = u"7"
+        integration.setting(ContentCafeAPI.MAX_RETRIES).value = u"2"
+        result = ContentCafeAPI.from_config(
+            self._db, None, uploader=DummyS3Uploader(),
+            soap_client=DummyContentCafeSOAPClient()
+        )
+        adapter = result.http.get_adapter(ContentCafeAPI.BASE_URL)
+        eq_(7, adapter._pool_maxsize)
+        eq_(2, adapter.max_retries.total)
+        eq_(ContentCafeAPI.DEFAULT_BACKOFF_FACTOR,
+            adapter.max_retries.backoff_factor)
+
+    def test_http_session(self):
+        session = ContentCafeAPI.http_session()
+        adapter = session.get_adapter(ContentCafeAPI.BASE_URL)
+        eq_(ContentCafeAPI.DEFAULT_POOL_SIZE, adapter._pool_maxsize)
+        eq_(True, adapter._pool_block)
+        eq_(ContentCafeAPI.DEFAULT_MAX_RETRIES, adapter.max_retries.total)
+        eq_(ContentCafeAPI.RETRY_STATUS_CODES,
+            adapter.max_retries.status_forcelist)
+
+        session = ContentCafeAPI.http_session(
+            pool_size=1, max_retries=0, backoff_factor=2
+        )
+        adapter = session.get_adapter("https://contentcafe2.btol.com/")
+        eq_(1, adapter._pool_maxsize)
+        eq_(0, adapter.max_retries.total)
+        eq_(2, adapter.max_retries.backoff_factor)
+
+    def test_get_reviews(self):
+        api = ContentCafeAPI(
+            self._db, None, "user_id", "password", DummyS3Uploader(),
+            soap_client=DummyContentCafeSOAPClient(), http=DummyHTTP()
+        )
+        identifier = self._identifier(Identifier.ISBN)
+        args = dict(userid="user_id", password="password", isbn="1")
+
+        links = api.get_reviews(identifier, args)
+        eq_(6, len(links))
+        eq_(set([Hyperlink.REVIEW]), set([x.rel for x in links]))
+        eq_(1, len(api.http.requested))
+
+        # A page that was already fetched isn't fetched again.
+        response = DummyResponse(sample_data('reviews.html', 'content_cafe'))
+        eq_(6, len(api.get_reviews(identifier, args, response)))
+        eq_(1, len(api.http.requested))
+
+        # A page that says there's nothing to see yields no links.
+        response = DummyResponse(
+            '<html>No review info exists for this item</html>'
+        )
+        eq_([], api.get_reviews(identifier, args, response))
+
+    def test_mirror_resources(self):
+        class DummyRepresentation(object):
+            status_code = 200
+
+        class DummyMirror(object):
+            def mirror_hyperlink(self, hyperlink):
+                return DummyRepresentation()
+            def mirror_batch(self, representations):
+                self.mirrored = representations
+
+        class DummyScaler(object):
+            def scale_edition(self, identifier):
+                self.scaled = identifier
+
+        api = ContentCafeAPI(
+            self._db, None, "user_id", "password", DummyS3Uploader(),
+            soap_client=DummyContentCafeSOAPClient(popularity=40),
+            http=DummyHTTP()
+        )
+        api.mirror = DummyMirror()
+        api.scaler = DummyScaler()
+        identifier = self._identifier(Identifier.ISBN)
+        api.mirror_resources(identifier)
+
+        # Each of the four pages was requested, and the resources
+        # found on them were associated with the ISBN.
+        eq_(4, len(api.http.requested))
+        eq_(identifier, api.scaler.scaled)
+        rels = set([x.rel for x in identifier.links])
+        for rel in (Hyperlink.IMAGE, Hyperlink.DESCRIPTION, Hyperlink.REVIEW,
+                    Hyperlink.SAMPLE, Hyperlink.AUTHOR):
+            assert rel in rels
+
+        # The popularity estimate was recorded. It only counts the
+        # past year of demand, as it does in the popularity sweep.
+        [measurement] = identifier.measurements
+        eq_(Measurement.POPULARITY, measurement.quantity_measured)
+        eq_(40, measurement.value)
+        eq_([api.ONE_YEAR_AGO], api.soap_client.cutoffs)
+
+    def test_measure_popularity(self):
+        api = ContentCafeAPI(
+            self._db, None, "user_id", "password", DummyS3Uploader(),
+            soap_client=DummyContentCafeSOAPClient(popularity=40)
+        )
+        identifier = self._identifier(Identifier.ISBN)
+        api.measure_popularity(identifier, api.ONE_YEAR_AGO)
+        api.measure_popularities([identifier], api.ONE_YEAR_AGO)
+        eq_([api.ONE_YEAR_AGO] * 2, api.soap_client.cutoffs)
+
+    def test_record_popularities(self):
+        api = ContentCafeAPI(
+            self._db, None, "user_id", "password", DummyS3Uploader(),
+            soap_client=DummyContentCafeSOAPClient()
+        )
+        i1 = self._identifier(Identifier.ISBN)
+        i2 = self._identifier(Identifier.ISBN)
+        old = i1.add_measurement(api.data_source, Measurement.POPULARITY, 5)
+
+        api.record_popularities([i1, i2], [10, None])
+        self._db.commit()
+
+        # The old measurement is no longer the most recent one.
+        eq_(False, old.is_most_recent)
+        [new] = [x for x in i1.measurements if x.is_most_recent]
+        eq_(10, new.value)
+        eq_(Measurement.POPULARITY, new.quantity_measured)
+        eq_(api.data_source, new.data_source)
+
+        [measurement] = i2.measurements
+        eq_(None, measurement.value)
+        eq_(True, measurement.is_most_recent)
+
+        # Recording the same estimates again doesn't add measurements;
+        # it updates the time the current ones were taken.
+        taken_at = new.taken_at
+        api.record_popularities([i1, i2], [10, None])
+        self._db.commit()
+        eq_(2, len(i1.measurements))
+        eq_(1, len(i2.measurements))
+        eq_(True, new.is_most_recent)
+        assert new.taken_at > taken_at
+
+        eq_([], api.record_popularities([], []))
+
+
+class TestContentCafeSOAPClient(object):
+
+    class DummySudsClient(object):
+        created = 0
+
+        def __init__(self, wsdl_url):
+            self.wsdl_url = wsdl_url
+            self.__class__.created += 1
+
+        def clone(self):
+            return TestContentCafeSOAPClient.DummySudsClient.__new__(
+                TestContentCafeSOAPClient.DummySudsClient
+            )
+
+    class Item(object):
+        """Stands in for a suds object."""
+        def __init__(self, **kwargs):
+            for k, v in kwargs.items():
+                setattr(self, k, v)
+
+    def setup(self):
+        self.old_suds_client = content_cafe.SudsClient
+        content_cafe.SudsClient = self.DummySudsClient
+        self.DummySudsClient.created = 0
+        ContentCafeSOAPClient._suds_clients.clear()
+
+    def teardown(self):
+        content_cafe.SudsClient = self.old_suds_client
+        ContentCafeSOAPClient._suds_clients.clear()
+
+    def test_wsdl_loaded_once(self):
+        c1 = ContentCafeSOAPClient("user", "password")
+        c2 = ContentCafeSOAPClient("user", "password")
+        eq_(1, self.DummySudsClient.created)
+
+        # Each client gets its own clone of the original.
+        assert c1.soap is not c2.soap
+
+        ContentCafeSOAPClient("user", "password", wsdl_url="http://other/")
+        eq_(2, self.DummySudsClient.created)
+
+    def request_item(self, *demands):
+        if not demands:
+            return self.Item(DemandHistoryItems='')
+        history = [
+            self.Item(Year=2016, Month=month, Demand=str(demand))
+            for month, demand in enumerate(demands, 1)
+        ]
+        return self.Item(
+            DemandHistoryItems=self.Item(DemandHistoryItem=history)
+        )
+
+    def test_estimated_popularities(self):
+        client = ContentCafeSOAPClient("user", "password")
+        client.MAX_KEYS_PER_REQUEST = 2
+        responses = [
+            [self.request_item(10, 20), self.request_item()],
+            [self.request_item(4)],
+        ]
+        requests = []
+        def get_content_for_keys(keys, content):
+            requests.append((keys, content))
+            items = responses.pop(0)
+            return self.Item(RequestItems=self.Item(RequestItem=items))
+        client.get_content_for_keys = get_content_for_keys
+
+        popularities = client.estimated_popularities(["a", "b", "c"])
+
+        # Two requests were made.
+        eq_([(["a", "b"], client.DEMAND_HISTORY),
+             (["c"], client.DEMAND_HISTORY)], requests)
+        eq_(dict(a=20, b=None, c=4), popularities)
+
+        # If the answers don't line up with the questions, that's
+        # an error.
+        responses.append([self.request_item(1)])
+        assert_raises(
+            ContentCafeSOAPError, client.estimated_popularities, ["a", "b"]
+        )
+
+    def test_estimate_popularities(self):
+        client = ContentCafeSOAPClient("user", "password")
+        def history(**demands):
+            return Counter(dict(
+                (datetime.date(int(k[1:5]), int(k[5:]), 1), v)
+                for k, v in demands.items()
+            ))
+        histories = [
+            history(m201601=10, m201701=3),
+            history(m201601=10, m201701=8),
+            history(m201601=10),
+            Counter(),
+            None,
+            history(m201702=0),
+        ]
+        cutoff = datetime.date(2017, 1, 1)
+
+        # The vectorized estimates are the same as the ones
+        # calculated one at a time.
+        for c in (cutoff, None):
+            expect = [client.estimate_popularity(x, c) for x in histories]
+            eq_(expect, client.estimate_popularities(histories, c))
+        eq_([5, 8, 5, None, None, 0],
+            client.estimate_popularities(histories, cutoff))
+
+        eq_([], client.estimate_popularities([]))
+        eq_([None], client.estimate_popularities([None]))
+
+
+class TestContentCafeSOAPRequests(object):
+    """Send requests through a real SOAP client built from the service
+    description in tests/files/content_cafe.
+    """
+
+    class RecordingTransport(Transport):
+        """Records outgoing requests and answers them from a file."""
+        def __init__(self, reply):
+            Transport.__init__(self)
+            self.reply = reply
+            self.requests = []
+
+        def send(self, request):
+            self.requests.append(request)
+            return Reply(200, {}, self.reply)
+
+    NS = "{http://ContentCafe2.btol.com}"
+
+    def setup(self):
+        ContentCafeSOAPClient._suds_clients.clear()
+        path = os.path.join(
+            os.path.split(__file__)[0], "files", "content_cafe",
+            "ContentCafe.wsdl"
+        )
+        self.client = ContentCafeSOAPClient(
+            "user", "password", wsdl_url="file://" + os.path.abspath(path)
+        )
+        self.transport = self.RecordingTransport(
+            sample_data("xml_class_demand_history.xml", "content_cafe")
+        )
+        self.client.soap.set_options(transport=self.transport)
+
+    def teardown(self):
+        ContentCafeSOAPClient._suds_clients.clear()
+
+    def test_get_content_for_keys(self):
+        keys = ["9780307278449", "9780000000000"]
+        data = self.client.get_content_for_keys(
+            keys, self.client.DEMAND_HISTORY
+        )
+
+        # The request asked about both keys at once.
+        [request] = self.transport.requests
+        body = etree.fromstring(request.message).find(
+            "{http://schemas.xmlsoap.org/soap/envelope/}Body"
+        )
+        request_items = body.find(
+            "%sXmlClass/%sContentCafe/%sRequestItems" % ((self.NS,) * 3)
+        )
+        eq_("user", request_items.findtext(self.NS + "UserID"))
+        eq_("password", request_items.findtext(self.NS + "Password"))
+        sent = request_items.findall(self.NS + "RequestItem")
+        eq_(keys, [x.findtext(self.NS + "Key") for x in sent])
+        eq_([[self.client.DEMAND_HISTORY]] * 2,
+            [[c.text for c in x.findall(self.NS + "Content")] for x in sent])
+
+        # The answers come back in the same order.
+        eq_(2, len(data.RequestItems.RequestItem))
+
+    def test_estimated_popularities(self):
+        popularities = self.client.estimated_popularities(
+            ["9780307278449", "9780000000000"]
+        )
+        eq_({"9780307278449" : 20, "9780000000000" : None}, popularities)
+
 
 class TestContentCafeCoverageProvider(DatabaseTest):
 
@@ -85,3 +453,67 @@ class TestContentCafeCoverageProvider(DatabaseTest):
         eq_(True, isinstance(result, CoverageFailure))
         eq_(identifier, result.obj)
         assert "Oh no!" in result.exception
+
+
+class TestScraping(object):
+    """Test the scraping of Content Cafe web pages."""
+
+    def scrape(self, method, filename):
+        content = sample_data(filename, 'content_cafe')
+        return list(method(ContentCafeAPI._parse(content)))
+
+    def test_scrape_list(self):
+        reviews = self.scrape(ContentCafeAPI._scrape_list, 'reviews.html')
+        eq_(6, len(reviews))
+        assert reviews[0].startswith(
+            "Gr. 5-8. Forget heaven and hell, the Greek underworld\n isn't a myth!"
+        )
+
+        summaries = self.scrape(ContentCafeAPI._scrape_list, 'summaries.html')
+        eq_(5, len(summaries))
+        assert summaries[3].startswith(
+            "<b>Kidnapping is so last season. </b><br/><br/>Couture-conscious"
+        )
+        # Content is returned as UTF-8.
+        assert "shopping rule\xe2\x80\x94never pay full price" in summaries[3]
+
+    def test_scrape_one(self):
+        [notes] = self.scrape(ContentCafeAPI._scrape_one, 'author_notes.html')
+        eq_('<i>New York Times</i> bestselling and award-winning author <b>Christie Golden</b>\n has written more than thirty novels and several short stories in the \nfields of science fiction, fantasy, and horror. Visit her website at: \nChristieGolden.com.', notes)
+
+        [excerpt] = self.scrape(ContentCafeAPI._scrape_one, 'excerpt.html')
+        # Runs of whitespace between tags become a single space.
+        assert ('<big><b>OUTBREAK</b></big> <br/> <br/> </p><p align="center">'
+                in excerpt)
+
+        eq_([], ContentCafeAPI._scrape_one(
+            ContentCafeAPI._parse("<html><body>Nothing here</body></html>")
+        ))
+
+    def test_inner_html(self):
+        document = ContentCafeAPI._parse(
+            '<html><body><table id="Table_Main"><tr><td>'
+            'a &amp; b &lt;c&gt; <pre>  x  </pre> '
+            '<span class=" q  r ">&nbsp;</span><img src="x.png">'
+            '<a title=\'say "hi"\' href="?a=1&amp;b=2">l</a><!-- c -->'
+            '</td></tr></table></body></html>'
+        )
+        [cell] = ContentCafeAPI.FIRST_CELL(document)
+        eq_('a &amp; b &lt;c&gt; <pre>  x  </pre> '
+            '<span class="q r">\xc2\xa0</span><img src="x.png"/>'
+            '<a href="?a=1&amp;b=2" title=\'say "hi"\'>l</a><!-- c -->',
+            ContentCafeAPI._inner_html(cell))
+
+
+class TestPercentiles(object):
+
+    def test_percentiles_from_histogram(self):
+        histogram = [(3, 2), (1, 5), (10, 1), (2, 2)]
+        expanded = sorted(
+            sum([[value] * count for value, count in histogram], [])
+        )
+        expect = [expanded[int(len(expanded) * (i/100.0))] for i in range(100)]
+        eq_(expect, percentiles_from_histogram(histogram))
+
+        eq_([1, 1, 2, 3], percentiles_from_histogram(histogram, 4))
+        eq_([], percentiles_from_histogram([]))
@@ -3,8 +3,10 @@ import base64
 import feedparser
 import json
 import urllib
+import urlparse
 from StringIO import StringIO
 from datetime import datetime, timedelta
+from flask import request
 from functools import wraps
 from lxml import etree
 from nose.tools import set_trace, eq_
@@ -12,9 +14,11 @@ from nose.tools import set_trace, eq_
 from . import DatabaseTest
 from core.model import (
     IntegrationClient,
+    ConfigurationSetting,
     CoverageRecord,
     DataSource,
     ExternalIntegration,
+    Hyperlink,
     Identifier,
     get_one,
 )
@@ -24,18 +28,25 @@ from core.problem_details import (
 )
 from core.util.problem_detail import ProblemDetail
 from core.util.opds_writer import OPDSMessage
+from core.opds import VerboseAnnotator
 from core.opds_import import OPDSXMLParser
 
+from catalog import CatalogRegistrationJob
 from controller import (
+    CanonicalizationController,
     CatalogController,
     URNLookupController,
     HTTP_OK,
     HTTP_CREATED,
     HTTP_ACCEPTED,
+    HTTP_NOT_MODIFIED,
     HTTP_UNAUTHORIZED,
     HTTP_NOT_FOUND,
     HTTP_INTERNAL_SERVER_ERROR,
+    AuthenticationCache,
+    OPDSEntryCache,
     authenticated_client_from_request,
+    authentication_cache,
 )
 
 
@@ -93,6 +104,117 @@ class TestIntegrationClientAuthentication(ControllerTest):
             eq_(None, result)
 
 
+    def test_authentication_is_cached(self):
+        original = IntegrationClient.__dict__['authenticate']
+        authenticate = IntegrationClient.authenticate
+        calls = []
+        def counting_authenticate(_db, key, secret):
+            calls.append(key)
+            return authenticate(_db, key, secret)
+
+        authentication_cache.clear()
+        IntegrationClient.authenticate = staticmethod(counting_authenticate)
+        try:
+            # Within a request, the secret is checked only once.
+            with self.app.test_request_context('/', headers=self.valid_auth):
+                eq_(self.client, authenticated_client_from_request(self._db))
+                eq_(self.client, authenticated_client_from_request(self._db))
+            eq_(1, len(calls))
+
+            # The next request finds the client in the cache.
+            with self.app.test_request_context('/', headers=self.valid_auth):
+                eq_(self.client, authenticated_client_from_request(self._db))
+            eq_(1, len(calls))
+
+            # A wrong secret is never taken from the cache.
+            invalid_auth = 'Basic ' + base64.b64encode('abc:defg')
+            with self.app.test_request_context('/',
+                    headers=dict(Authorization=invalid_auth)):
+                result = authenticated_client_from_request(self._db)
+                eq_(True, isinstance(result, ProblemDetail))
+            eq_(2, len(calls))
+
+            # Changing the client clears it out of the cache.
+            self.client.url = u"http://another-url.com/"
+            self._db.flush()
+            eq_(0, len(authentication_cache))
+            with self.app.test_request_context('/', headers=self.valid_auth):
+                eq_(self.client, authenticated_client_from_request(self._db))
+            eq_(3, len(calls))
+        finally:
+            IntegrationClient.authenticate = original
+            authentication_cache.clear()
+
+    def test_authentication_cache_expires(self):
+        now = [1000]
+        cache = AuthenticationCache(ttl=10, clock=lambda: now[0])
+        cache.set(u"abc", u"def", 5)
+        eq_(5, cache.get(u"abc", u"def"))
+        eq_(None, cache.get(u"abc", u"wrong"))
+        eq_(None, cache.get(u"other", u"def"))
+
+        now[0] += 10
+        eq_(None, cache.get(u"abc", u"def"))
+        eq_(0, len(cache))
+
+        cache.set(u"abc", u"def", 5)
+        cache.invalidate(5)
+        eq_(None, cache.get(u"abc", u"def"))
+
+
+class TestCanonicalizationController(ControllerTest):
+
+    def setup(self):
+        super(TestCanonicalizationController, self).setup()
+        self.controller = CanonicalizationController(self._db)
+        self.controller.cache.clear()
+        self.controller.contributor_index.entries.clear()
+
+    def test_deadline_setting(self):
+        eq_(CanonicalizationController.DEFAULT_DEADLINE,
+            self.controller.canonicalizer.deadline)
+
+        ConfigurationSetting.sitewide(
+            self._db, CanonicalizationController.DEADLINE_KEY
+        ).value = u"2.5"
+        controller = CanonicalizationController(self._db)
+        eq_(2.5, controller.canonicalizer.deadline)
+
+    def test_canonicalize_author_names(self):
+        contributor, ignore = self._contributor(sort_name="Zebra, Ant")
+        contributor.display_name = "Ant Zebra"
+        identifier = self._identifier()
+
+        data = json.dumps([
+            dict(display_name="Ant Zebra"),
+            dict(urn=identifier.urn, display_name="Ant Zebra"),
+            dict(urn="not a urn", display_name="Ant Zebra"),
+        ])
+        with self.app.test_request_context(
+                '/', method='POST', data=data,
+                content_type='application/json'):
+            response = self.controller.canonicalize_author_names()
+        eq_(HTTP_OK, response.status_code)
+        eq_({"Ant Zebra" : {"" : "Zebra, Ant",
+                            identifier.urn : "Zebra, Ant",
+                            "not a urn" : None}},
+            json.loads(response.data))
+
+    def test_canonicalize_author_names_bad_input(self):
+        with self.app.test_request_context(
+                '/', method='POST', data='{"not": "a list"}'):
+            response = self.controller.canonicalize_author_names()
+        eq_(INVALID_INPUT.uri, response.uri)
+
+        too_many = json.dumps(
+            [dict(display_name="A")] * (self.controller.MAX_BATCH_SIZE+1)
+        )
+        with self.app.test_request_context(
+                '/', method='POST', data=too_many):
+            response = self.controller.canonicalize_author_names()
+        eq_(INVALID_INPUT.uri, response.uri)
+
+
 class TestCatalogController(ControllerTest):
 
     XML_PARSE = OPDSXMLParser()._xpath
@@ -148,7 +270,7 @@ class TestCatalogController(ControllerTest):
                 u"%s Collection Updates for %s" % (self.collection.protocol, self.client.url))
 
             # The timestamp is included in the url.
-            linkified_timestamp = time.strftime("%Y-%m-%d+%H:%M:%S").replace(":", "%3A")
+            linkified_timestamp = timestamp.replace(":", "%3A")
             assert feed['feed']['id'].endswith(linkified_timestamp)
             # And only works updated since the timestamp are returned.
             eq_(0, len(feed['entries']))
@@ -164,27 +286,196 @@ class TestCatalogController(ControllerTest):
             eq_(self.work1.title, entry['title'])
             eq_(identifier.urn, entry['id'])
 
+    def test_updates_feed_conditional_request(self):
+        identifier = self.work1.license_pools[0].identifier
+        self.collection.catalog_identifier(self._db, identifier)
+
+        def get(etag=None):
+            headers = dict(self.valid_auth)
+            if etag:
+                headers['If-None-Match'] = etag
+            with self.app.test_request_context('/', headers=headers):
+                return self.controller.updates_feed(self.collection.name)
+
+        response = get()
+        eq_(HTTP_OK, response.status_code)
+        etag, is_weak = response.get_etag()
+        assert etag
+
+        # Nothing has changed, so there's no need to send the feed again.
+        response = get(etag)
+        eq_(HTTP_NOT_MODIFIED, response.status_code)
+        eq_("", response.data)
+        eq_(etag, response.get_etag()[0])
+
+        # Once the catalog changes, the whole feed is sent.
+        identifier = self.work2.license_pools[0].identifier
+        self.collection.catalog_identifier(self._db, identifier)
+        response = get(etag)
+        eq_(HTTP_OK, response.status_code)
+        assert etag != response.get_etag()[0]
+
+    def test_catalog_version(self):
+        def version():
+            latest_update, membership = self.controller.catalog_version(
+                self.collection
+            )
+            return membership
+
+        # A catalog that has never changed has no version.
+        eq_(None, version())
+
+        # Every change to the catalog gives it a new version, even
+        # when it ends up the same size with the same IDs in total.
+        a, b, c, d = sorted(
+            [self._identifier() for i in range(4)], key=lambda x: x.id
+        )
+        eq_(a.id + d.id, b.id + c.id)
+        for identifier in (a, d):
+            self.collection.catalog_identifier(self._db, identifier)
+        first = version()
+        assert first
+
+        self.collection.catalog = [b, c]
+        second = version()
+        assert second > first
+
+        # Changes to another collection's catalog don't count.
+        self._collection().catalog_identifier(self._db, a)
+        eq_(second, version())
+
     def test_updates_feed_is_paginated(self):
         for work in [self.work1, self.work2]:
             self.collection.catalog_identifier(
                 self._db, work.license_pools[0].identifier
             )
-        with self.app.test_request_context('/?size=1',
+        # Give the works distinct update times, so the order is clear.
+        now = datetime.utcnow()
+        for record in self.work1.coverage_records:
+            record.timestamp = now - timedelta(days=1)
+        for record in self.work2.coverage_records:
+            record.timestamp = now
+
+        earlier = (now - timedelta(days=2)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self.app.test_request_context(
+            '/?size=1&last_update_time=%s' % earlier,
             headers=self.valid_auth):
             response = self.controller.updates_feed(self.collection.name)
-            links = feedparser.parse(response.get_data())['feed']['links']
-            assert any([link['rel'] == 'next' for link in links])
+            feed = feedparser.parse(response.get_data())
+            [entry] = feed['entries']
+            eq_(self.work1.title, entry['title'])
+            links = feed['feed']['links']
+            [next_link] = [link for link in links if link['rel'] == 'next']
             assert not any([link['rel'] == 'previous' for link in links])
-            assert not any([link['rel'] == 'first' for l in links])
-
-        with self.app.test_request_context('/?size=1&after=1',
+            assert not any([link['rel'] == 'first' for link in links])
+
+        # The next link carries a cursor pointing at the last work
+        # on the page.
+        # It keeps last_update_time in the format it was sent in.
+        query = next_link['href'].split('?', 1)[1]
+        assert 'cursor=' in query
+        eq_([earlier], urlparse.parse_qs(query)['last_update_time'])
+        with self.app.test_request_context('/?' + query,
             headers=self.valid_auth):
             response = self.controller.updates_feed(self.collection.name)
-            links = feedparser.parse(response.get_data())['feed']['links']
-            assert any([link['rel'] == 'previous' for link in links])
+            eq_(HTTP_OK, response.status_code)
+            feed = feedparser.parse(response.get_data())
+            [entry] = feed['entries']
+            eq_(self.work2.title, entry['title'])
+            links = feed['feed']['links']
             assert any([link['rel'] == 'first' for link in links])
             assert not any([link['rel'] == 'next'for link in links])
 
+        # A bad cursor is a client error.
+        with self.app.test_request_context('/?cursor=yesterday',
+            headers=self.valid_auth):
+            response = self.controller.updates_feed(self.collection.name)
+            eq_(INVALID_INPUT.uri, response.uri)
+
+    def test_updates_feed_splices_precomposed_entries(self):
+        for work in [self.work1, self.work2]:
+            self.collection.catalog_identifier(
+                self._db, work.license_pools[0].identifier
+            )
+        # work1 has a cached OPDS entry; work2 doesn't.
+        self.work1.verbose_opds_entry = (
+            u'<entry xmlns="http://www.w3.org/2005/Atom">'
+            u'<title>Cached \u2014 title</title><id>urn:cached</id></entry>'
+        )
+        self.work2.verbose_opds_entry = None
+        self.work2.simple_opds_entry = None
+        # work2 was updated first, so it comes first.
+        now = datetime.utcnow()
+        for record in self.work2.coverage_records:
+            record.timestamp = now - timedelta(days=1)
+        for record in self.work1.coverage_records:
+            record.timestamp = now
+
+        with self.app.test_request_context('/', headers=self.valid_auth):
+            response = self.controller.updates_feed(self.collection.name)
+            eq_(HTTP_OK, response.status_code)
+            body = response.get_data()
+
+        # The cached entry was included exactly as it was.
+        assert self.work1.verbose_opds_entry.encode("utf8") in body
+
+        # The other work was rendered from scratch.
+        feed = feedparser.parse(body)
+        eq_([self.work2.title, u"Cached \u2014 title"],
+            [x['title'] for x in feed['entries']])
+
+    def test_splice_entries(self):
+        class Feed(object):
+            feed = etree.fromstring(
+                '<feed xmlns="http://www.w3.org/2005/Atom"><title>t</title>'
+                '<entry><id>urn:2</id></entry></feed>'
+            )
+            def __unicode__(self):
+                return etree.tostring(self.feed, encoding=unicode)
+
+        # Each entry ends up in its place in the page, whether it was
+        # precomposed or rendered into the feed.
+        eq_(u'<feed xmlns="http://www.w3.org/2005/Atom"><title>t</title>'
+            u'<entry>1</entry>'
+            u'<entry xmlns="http://www.w3.org/2005/Atom"><id>urn:2</id></entry>'
+            u'<entry>\u2014</entry></feed>',
+            CatalogController.splice_entries(Feed(), [
+                ("urn:1", u'<entry>1</entry>'),
+                ("urn:2", None),
+                ("urn:3", '<entry>\xe2\x80\x94</entry>'),
+            ]))
+
+    def test_updated_works(self):
+        for work in [self.work1, self.work2]:
+            self.collection.catalog_identifier(
+                self._db, work.license_pools[0].identifier
+            )
+        now = datetime.utcnow()
+        for record in self.work1.coverage_records:
+            record.timestamp = now
+        for record in self.work2.coverage_records:
+            record.timestamp = now
+
+        # Works updated at the same time are ordered by ID.
+        first, second = sorted([self.work1, self.work2], key=lambda x: x.id)
+        works, cursor = self.controller.updated_works(
+            self.collection, None, None, 1
+        )
+        eq_([first], works)
+        eq_((now, first.id), self.controller.parse_cursor(cursor))
+
+        works, cursor = self.controller.updated_works(
+            self.collection, None, self.controller.parse_cursor(cursor), 1
+        )
+        eq_([second], works)
+        eq_(None, cursor)
+
+        # Only works updated after last_update_time are found.
+        works, cursor = self.controller.updated_works(
+            self.collection, now, None, 10
+        )
+        eq_([], works)
+
     def test_add_items(self):
         invalid_urn = "FAKE AS I WANNA BE"
         catalogued_id = self._identifier()
@@ -290,6 +581,110 @@ class TestCatalogController(ControllerTest):
             # The catalogued identifier is still removed.
             assert catalogued_id not in self.collection.catalog
 
+    def test_add_items_with_repeated_urn(self):
+        identifier = self._identifier()
+        with self.app.test_request_context(
+                '/?urn=%s&urn=%s' % (identifier.urn, identifier.urn),
+                headers=self.valid_auth):
+            response = self.controller.add_items(self.collection.name)
+
+        # The identifier was added once, and the second message says
+        # it was already there.
+        root = etree.parse(StringIO(response.data))
+        first, second = self.XML_PARSE(root, '/atom:feed/simplified:message')
+        eq_('201', self.xml_value(first, 'simplified:status_code'))
+        eq_('200', self.xml_value(second, 'simplified:status_code'))
+        eq_([identifier], self.collection.catalog)
+
+    def test_add_items_in_background(self):
+        catalogued_id = self._identifier()
+        uncatalogued_id = self._identifier()
+        self.collection.catalog_identifier(self._db, catalogued_id)
+
+        # A list of URNs in the request body is added by a job, rather
+        # than right away.
+        body = "%s\n%s\n" % (catalogued_id.urn, uncatalogued_id.urn)
+        with self.app.test_request_context(
+                '/', method='POST', data=body, headers=self.valid_auth):
+            response = self.controller.add_items(self.collection.name)
+
+        eq_(HTTP_ACCEPTED, response.status_code)
+        details = json.loads(response.data)
+        eq_(2, details['total'])
+        eq_(details['status'], response.headers['Location'])
+        assert uncatalogued_id not in self.collection.catalog
+
+        def status(**kwargs):
+            with self.app.test_request_context(
+                    '/', headers=self.valid_auth, **kwargs):
+                return self.controller.registration_job(
+                    self.collection.name, details['id']
+                )
+
+        # Until the job is done, its status is 202 and there are no
+        # messages.
+        response = status()
+        eq_(HTTP_ACCEPTED, response.status_code)
+        feed = feedparser.parse(response.data)
+        assert "0 of 2 processed" in feed.feed.title
+        root = etree.parse(StringIO(response.data))
+        eq_([], self.XML_PARSE(root, '/atom:feed/simplified:message'))
+
+        CatalogRegistrationJob.run_all(self._db)
+        assert uncatalogued_id in self.collection.catalog
+
+        # Now there's a message for each URN.
+        response = status()
+        eq_(HTTP_OK, response.status_code)
+        root = etree.parse(StringIO(response.data))
+        catalogued, uncatalogued = self.XML_PARSE(
+            root, '/atom:feed/simplified:message'
+        )
+        eq_('200', self.xml_value(catalogued, 'simplified:status_code'))
+        eq_('201', self.xml_value(uncatalogued, 'simplified:status_code'))
+
+        # Another collection can't see the job.
+        other = self._collection()
+        with self.app.test_request_context('/', headers=self.valid_auth):
+            response = self.controller.registration_job(
+                other.name, details['id']
+            )
+        eq_(HTTP_NOT_FOUND, response.status_code)
+
+    def test_add_items_in_background_from_chunked_body(self):
+        identifiers = [self._identifier() for i in range(2)]
+        body = "".join(x.urn + "\n" for x in identifiers)
+
+        # A chunked upload has no Content-Length. The server marks
+        # the input as terminated so it can be read to the end.
+        with self.app.test_request_context(
+                '/', method='POST', input_stream=StringIO(body),
+                headers=dict(self.valid_auth, **{
+                    "Transfer-Encoding" : "chunked"
+                }),
+                environ_overrides={"wsgi.input_terminated" : True}):
+            eq_(None, request.content_length)
+            response = self.controller.add_items(self.collection.name)
+
+        eq_(HTTP_ACCEPTED, response.status_code)
+        eq_(2, json.loads(response.data)['total'])
+
+    def test_add_items_in_background_from_json(self):
+        identifier = self._identifier()
+        with self.app.test_request_context(
+                '/', method='POST', data=json.dumps([identifier.urn]),
+                content_type='application/json', headers=self.valid_auth):
+            response = self.controller.add_items(self.collection.name)
+        eq_(HTTP_ACCEPTED, response.status_code)
+        eq_(1, json.loads(response.data)['total'])
+
+        # Anything other than a list of URNs is rejected.
+        with self.app.test_request_context(
+                '/', method='POST', data=json.dumps({"urn": identifier.urn}),
+                content_type='application/json', headers=self.valid_auth):
+            response = self.controller.add_items(self.collection.name)
+        eq_(400, response.status_code)
+
     def test_update_client_url(self):
         url = urllib.quote('https://try-me.fake.us/')
         with self.app.test_request_context('/'):
@@ -320,6 +715,7 @@ class TestURNLookupController(ControllerTest):
     def setup(self):
         super(TestURNLookupController, self).setup()
         self.controller = URNLookupController(self._db)
+        self.controller.entry_cache.clear()
         self.source = DataSource.lookup(self._db, DataSource.INTERNAL_PROCESSING)
 
     def basic_request_context(f):
@@ -463,6 +859,146 @@ class TestURNLookupController(ControllerTest):
             self.controller.process_urn(i3.urn, collection_details=name)
             assert i3 not in collection.catalog
 
+    def test_process_urns(self):
+        name = base64.b64encode((ExternalIntegration.OPDS_IMPORT+':'+self._url), '-_')
+        collection = self._collection(name=name, url=self._url)
+
+        edition, pool = self._edition(
+            identifier_type=Identifier.THREEM_ID, with_license_pool=True
+        )
+        pool.open_access = False
+        work, is_new = pool.calculate_work()
+        work.presentation_ready = True
+        with_work = edition.primary_identifier
+
+        pending = self._identifier(Identifier.GUTENBERG_ID)
+        record, is_new = CoverageRecord.add_for(
+            pending, self.source, self.controller.OPERATION,
+            status=CoverageRecord.TRANSIENT_FAILURE
+        )
+        unresolvable = self._identifier(Identifier.THREEM_ID)
+        new_urn = Identifier.URN_SCHEME_PREFIX + "Overdrive ID/nosuchidentifier"
+        invalid_urn = "FAKE AS I WANNA BE"
+
+        with self.app.test_request_context('/', headers=self.valid_auth):
+            self.controller.process_urns(
+                [with_work.urn, pending.urn, unresolvable.urn, new_urn,
+                 invalid_urn],
+                collection_details=name
+            )
+
+        # Each URN gets the same result it would get on its own.
+        eq_([(with_work, work)], self.controller.works)
+        eq_([(pending.urn, HTTP_ACCEPTED),
+             (unresolvable.urn, HTTP_NOT_FOUND),
+             (new_urn, HTTP_CREATED),
+             (invalid_urn, 400)],
+            [(x.urn, x.status_code)
+             for x in self.controller.precomposed_entries])
+
+        # Every identifier we're willing to resolve is now in the
+        # collection's catalog.
+        [new] = self._db.query(Identifier).filter(
+            Identifier.type==Identifier.OVERDRIVE_ID
+        ).all()
+        eq_(sorted([with_work, pending, new]), sorted(collection.catalog))
+
+    def test_work_lookup_conditional_request(self):
+        identifier = self._identifier(Identifier.GUTENBERG_ID)
+
+        def lookup(etag=None):
+            headers = dict()
+            if etag:
+                headers['If-None-Match'] = etag
+            self.controller = URNLookupController(self._db)
+            with self.app.test_request_context(
+                    '/?urn=%s' % identifier.urn, headers=headers):
+                return self.controller.work_lookup(VerboseAnnotator)
+
+        # The first lookup registers the identifier.
+        response = lookup()
+        eq_(HTTP_OK, response.status_code)
+        etag = response.get_etag()[0]
+        assert etag
+        [record] = identifier.coverage_records
+        eq_(record.timestamp.replace(microsecond=0), response.last_modified)
+
+        # The ETag describes the identifier as it was after the lookup,
+        # so a second lookup finds nothing has changed. The identifier
+        # isn't looked up again, and the feed isn't sent.
+        response = lookup(etag)
+        eq_(HTTP_NOT_MODIFIED, response.status_code)
+        eq_("", response.data)
+        eq_([], self.controller.precomposed_entries)
+
+        # A lookup without an ETag changes nothing either, and gets
+        # the same ETag.
+        response = lookup()
+        eq_(HTTP_OK, response.status_code)
+        eq_(False, self.controller.lookup_made_changes)
+        eq_(etag, response.get_etag()[0])
+
+        # Once work is done on the identifier, its entry is sent again.
+        record.status = CoverageRecord.PERSISTENT_FAILURE
+        record.exception = u"foo"
+        record.timestamp = datetime.utcnow()
+        response = lookup(etag)
+        eq_(HTTP_OK, response.status_code)
+        assert etag != response.get_etag()[0]
+
+    def test_process_urns_registers_unresolved_identifiers_at_once(self):
+        new_urn = Identifier.URN_SCHEME_PREFIX + "Overdrive ID/nosuchidentifier"
+        failed = self._identifier(Identifier.GUTENBERG_ID)
+        record, is_new = CoverageRecord.add_for(
+            failed, self.source, self.controller.OPERATION,
+            status=CoverageRecord.PERSISTENT_FAILURE
+        )
+        record.exception = "foo"
+
+        with self.app.test_request_context('/'):
+            self.controller.process_urns([new_urn, failed.urn, new_urn])
+
+        # The new identifier was registered once. Asking about it
+        # again in the same request gets the "working on it" message.
+        eq_([(new_urn, HTTP_CREATED, self.controller.IDENTIFIER_REGISTERED),
+             (failed.urn, HTTP_INTERNAL_SERVER_ERROR, "foo"),
+             (new_urn, HTTP_ACCEPTED,
+              self.controller.WORKING_TO_RESOLVE_IDENTIFIER)],
+            [(x.urn, x.status_code, x.message)
+             for x in self.controller.precomposed_entries])
+        eq_(None, self.controller.unresolved)
+
+        [identifier] = self._db.query(Identifier).filter(
+            Identifier.type==Identifier.OVERDRIVE_ID
+        ).all()
+        [record] = self._db.query(CoverageRecord).filter(
+            CoverageRecord.identifier==identifier
+        ).all()
+        eq_(CoverageRecord.TRANSIENT_FAILURE, record.status)
+        eq_(self.controller.NO_WORK_DONE_EXCEPTION, record.exception)
+        eq_(self.source, record.data_source)
+
+    def test_register_identifiers_as_unresolved_skips_existing_records(self):
+        # Another request registered this identifier after this one
+        # looked for its coverage record.
+        identifier = self._identifier()
+        record, ignore = CoverageRecord.add_for(
+            identifier, self.source, self.controller.OPERATION,
+            status=CoverageRecord.TRANSIENT_FAILURE
+        )
+        self.controller.precomposed_entries = [None]
+        self.controller.register_identifiers_as_unresolved(
+            [(0, identifier.urn, identifier)], {}
+        )
+
+        # No second record was created, and the existing one was
+        # reported instead.
+        eq_([record], self._db.query(CoverageRecord).filter(
+            CoverageRecord.identifier==identifier
+        ).all())
+        [message] = self.controller.precomposed_entries
+        eq_((identifier.urn, HTTP_ACCEPTED), (message.urn, message.status_code))
+
     @basic_request_context
     def test_process_urn_isbn(self):
         # Create a new ISBN identifier.
@@ -508,3 +1044,44 @@ class TestURNLookupController(ControllerTest):
         [actual] = self.controller.precomposed_entries
         eq_(etree.tostring(expect), etree.tostring(actual))
 
+        # The entry was cached, and the next lookup gets the cached
+        # copy.
+        eq_(1, len(self.controller.entry_cache))
+        self.controller.precomposed_entries = []
+        self.controller.process_urn(isbn.urn)
+        [cached] = self.controller.precomposed_entries
+        eq_(etree.tostring(expect), etree.tostring(cached))
+
+    def test_opds_entry_cache(self):
+        cache = OPDSEntryCache(max_size=1)
+        isbn = self._identifier(Identifier.ISBN)
+
+        entry, version = cache.get(self._db, isbn)
+        eq_(None, entry)
+        cache.set(isbn, version, isbn.opds_entry())
+        entry, same_version = cache.get(self._db, isbn)
+        eq_(version, same_version)
+        eq_(etree.tostring(isbn.opds_entry()), etree.tostring(entry))
+
+        # Once a Hyperlink is added to the identifier, the entry has
+        # to be built again.
+        isbn.add_link(
+            Hyperlink.DESCRIPTION, None, self.source, content=u"A summary"
+        )
+        entry, new_version = cache.get(self._db, isbn)
+        eq_(None, entry)
+        assert new_version != version
+        cache.set(isbn, new_version, isbn.opds_entry())
+
+        # The same goes for a CoverageRecord.
+        CoverageRecord.add_for(isbn, self.source)
+        eq_(None, cache.get(self._db, isbn)[0])
+
+        # Only the most recently used entries are kept.
+        other = self._identifier(Identifier.ISBN)
+        entry, version = cache.get(self._db, other)
+        cache.set(other, version, other.opds_entry())
+        eq_(1, len(cache))
+        cache.invalidate(other)
+        eq_(0, len(cache))
+
@@ -0,0 +1,350 @@
+from nose.tools import (
+    set_trace,
+    eq_,
+    assert_raises,
+)
+from StringIO import StringIO
+import datetime
+import json
+
+from PIL import Image
+
+from core.model import (
+    ConfigurationSetting,
+    DataSource,
+    Hyperlink,
+    Identifier,
+    Representation,
+)
+from core.s3 import DummyS3Uploader
+
+from . import DatabaseTest
+from mirror import (
+    CoverImageMirror,
+    ImageScaler,
+    content_hash,
+    scale_image,
+)
+
+
+class DummyCoverImageMirror(CoverImageMirror):
+    """Serves images out of a dictionary instead of making HTTP
+    requests.
+    """
+
+    DATA_SOURCE = DataSource.OVERDRIVE
+
+    def __init__(self, _db, responses, **kwargs):
+        super(DummyCoverImageMirror, self).__init__(
+            _db, uploader=DummyS3Uploader(), **kwargs
+        )
+        self.responses = responses
+        self.requested = []
+
+    def download(self, url):
+        self.requested.append(url)
+        response = self.responses[url]
+        if isinstance(response, Exception):
+            return None, response
+        return response, None
+
+
+class TestCoverImageMirror(DatabaseTest):
+
+    def add_image(self, url):
+        identifier = self._identifier(Identifier.OVERDRIVE_ID)
+        data_source = DataSource.lookup(self._db, DataSource.OVERDRIVE)
+        hyperlink, is_new = identifier.add_link(
+            Hyperlink.IMAGE, url, data_source
+        )
+        return hyperlink
+
+    def test_prefetch(self):
+        ok = self.add_image("http://example.com/ok.png")
+        broken = self.add_image("http://example.com/broken.png")
+        already = self.add_image("http://example.com/already.png")
+        Representation.get(
+            self._db, already.resource.url,
+            do_get=lambda url, headers, **kwargs: (200, {}, "old")
+        )
+
+        image = (200, {"content-type": "image/png"}, "an image")
+        mirror = DummyCoverImageMirror(self._db, {
+            ok.resource.url : image,
+            broken.resource.url : IOError("oops"),
+        })
+        do_get = mirror.prefetch([ok, broken, already])
+
+        # The images were downloaded up front, except for the one
+        # that was already in the database.
+        eq_(set([ok.resource.url, broken.resource.url]),
+            set(mirror.requested))
+
+        # The downloaded responses are handed over by do_get.
+        eq_(image, do_get(ok.resource.url, {}))
+        assert_raises(IOError, do_get, broken.resource.url, {})
+
+    def test_mirror_all_resources(self):
+        ok = self.add_image("http://example.com/ok.png")
+        broken = self.add_image("http://example.com/broken.png")
+        mirror = DummyCoverImageMirror(self._db, {
+            ok.resource.url : (200, {"content-type": "image/png"}, "image"),
+            broken.resource.url : IOError("oops"),
+        })
+        mirror.mirror_all_resources(self._db.query(Hyperlink))
+
+        # Both images were fetched, and the one that worked was
+        # mirrored.
+        eq_(2, len(mirror.requested))
+        eq_([ok.resource.representation], mirror.uploader.uploaded)
+        eq_("image", ok.resource.representation.content)
+        assert "oops" in broken.resource.representation.fetch_exception
+
+    def test_mirror_all_resources_tries_each_hyperlink_once(self):
+        hyperlinks = [
+            self.add_image("http://example.com/%d.png" % i) for i in range(3)
+        ]
+        mirror = DummyCoverImageMirror(self._db, dict(
+            (x.resource.url, IOError("oops")) for x in hyperlinks
+        ))
+
+        # Even though every download fails, and each batch holds only
+        # one hyperlink, each hyperlink is tried once, in order.
+        mirror.mirror_all_resources(
+            self._db.query(Hyperlink), batch_size=1
+        )
+        eq_([x.resource.url for x in hyperlinks], mirror.requested)
+        eq_([], mirror.uploader.uploaded)
+
+    def image(self, content, mirror_url):
+        representation, ignore = self._representation(
+            media_type="image/png", content=content
+        )
+        representation.mirror_url = mirror_url
+        return representation
+
+    def test_configured_placeholder_hashes(self):
+        eq_(set(), DummyCoverImageMirror.configured_placeholder_hashes(self._db))
+        ConfigurationSetting.sitewide(
+            self._db, CoverImageMirror.PLACEHOLDER_HASHES_KEY
+        ).value = json.dumps([content_hash("placeholder")])
+        eq_(set([content_hash("placeholder")]),
+            DummyCoverImageMirror(self._db, {}).placeholder_hashes)
+
+    def test_mirror_batch(self):
+        mirror = DummyCoverImageMirror(
+            self._db, {}, placeholder_hashes=[content_hash("placeholder")]
+        )
+        original = self.image("cover", "http://s3/original.png")
+        copy = self.image("cover", "http://s3/copy.png")
+        other = self.image("other cover", "http://s3/other.png")
+        placeholder = self.image("placeholder", "http://s3/placeholder.png")
+        self._db.commit()
+
+        mirrored = mirror.mirror_batch([original, copy, other, placeholder])
+
+        # Each distinct image was uploaded once.
+        eq_([original, other], mirror.uploader.uploaded)
+        eq_([original, other, copy], mirrored)
+
+        # The copy points to the original's mirror.
+        eq_("http://s3/original.png", copy.mirror_url)
+        eq_(original.mirrored_at, copy.mirrored_at)
+
+        # The placeholder wasn't mirrored at all.
+        eq_(None, placeholder.mirrored_at)
+        eq_(CoverImageMirror.PLACEHOLDER_EXCEPTION,
+            placeholder.fetch_exception)
+
+        # If the same image is uploaded again anyway, its hash is
+        # pointed at the new copy.
+        again = self.image("cover", "http://s3/again.png")
+        self._db.commit()
+        mirror.mirrored_representations = lambda hashes: dict()
+        eq_([again], mirror.mirror_batch([again]))
+        del mirror.mirrored_representations
+        eq_({content_hash("cover") : again},
+            mirror.mirrored_representations([content_hash("cover")]))
+
+        # A later batch finds the image that was already mirrored.
+        later = self.image("cover", "http://s3/later.png")
+        self._db.commit()
+        eq_([later], mirror.mirror_batch([later]))
+        eq_("http://s3/again.png", later.mirror_url)
+        eq_([original, other, again], mirror.uploader.uploaded)
+
+
+def png(width, height):
+    output = StringIO()
+    Image.new("RGBA", (width, height), (255, 0, 0, 255)).save(output, "png")
+    return output.getvalue()
+
+
+class TestImageScaler(DatabaseTest):
+
+    def test_scale_image(self):
+        # A big image is scaled down to fit each box, keeping its
+        # aspect ratio, and converted to JPEG. It's left alone for
+        # a box it already fits in.
+        size, thumbnails, exception = scale_image(
+            (png(400, 300), [(300, 200), (150, 100), (300, 400)], "jpeg")
+        )
+        eq_((400, 300), size)
+        eq_(None, exception)
+        [(small, small_size), (smaller, smaller_size), unscaled] = thumbnails
+        eq_((200, 150), small_size)
+        eq_((100, 75), smaller_size)
+        eq_(None, unscaled)
+        eq_("JPEG", Image.open(StringIO(small)).format)
+
+        # A small image is left alone.
+        eq_(((100, 100), [None], None),
+            scale_image((png(100, 100), [(300, 200)], "jpeg")))
+
+        # Something that's not an image can't be scaled.
+        size, thumbnails, exception = scale_image(
+            ("not an image", [(300, 200)], "jpeg")
+        )
+        eq_(None, size)
+        assert "cannot identify image file" in exception
+
+    def test_record_scaled_images(self):
+        scaler = ImageScaler(self._db, [], uploader=DummyS3Uploader())
+        original, ignore = self._representation(media_type="image/png")
+        urls = ["http://example.com/300.jpg", "http://example.com/600.jpg"]
+
+        # The image was scaled to both sizes.
+        [small, big] = scaler.record_scaled_images(
+            original, urls, "image/jpeg", (800, 600),
+            [("small jpeg", (200, 150)), ("big jpeg", (400, 300))], None
+        )
+        eq_(urls, [small.url, big.url])
+        eq_(set([small, big]), set(original.thumbnails))
+        eq_("small jpeg", small.content)
+        eq_((200, 150), (small.image_width, small.image_height))
+        eq_((800, 600), (original.image_width, original.image_height))
+        assert small.scaled_at
+
+        # The image already fits the bigger size, so it's its own
+        # thumbnail for that size.
+        eq_([small, original], scaler.record_scaled_images(
+            original, urls, "image/jpeg", (400, 300),
+            [("small jpeg", (200, 150)), None], None
+        ))
+        eq_([small], original.thumbnails)
+
+        # The image couldn't be read.
+        eq_([original], scaler.record_scaled_images(
+            original, urls, "image/jpeg", None, None, "Traceback"
+        ))
+        eq_("Traceback", original.scale_exception)
+        assert original.fetch_exception.startswith(
+            "Error found while scaling"
+        )
+
+    def test_scale_batch_matches_representation_scale(self):
+        # An image scaled by scale_batch ends up in the same state as
+        # one scaled by Representation.scale.
+        scaler = ImageScaler(self._db, [], uploader=DummyS3Uploader())
+        data_source = DataSource.lookup(self._db, DataSource.OVERDRIVE)
+        identifier = self._identifier(Identifier.OVERDRIVE_ID)
+        hyperlink, ignore = identifier.add_link(
+            Hyperlink.IMAGE, self._url, data_source
+        )
+        original, ignore = self._representation(
+            url=hyperlink.resource.url, media_type="image/png",
+            content=png(400, 300)
+        )
+        hyperlink.resource.representation = original
+        [(ignore, [batched])], duplicates = scaler.scale_batch(
+            [hyperlink], [(150, 200)]
+        )
+
+        reference, ignore = self._representation(
+            media_type="image/png", content=png(400, 300)
+        )
+        expected, is_new = reference.scale(
+            150, 200, self._url, "image/jpeg", force=True
+        )
+
+        eq_([batched], original.thumbnails)
+        eq_([expected], reference.thumbnails)
+        eq_((original.image_width, original.image_height),
+            (reference.image_width, reference.image_height))
+        for attr in ('media_type', 'image_width', 'image_height',
+                     'scale_exception', 'mirrored_at', 'mirror_exception'):
+            eq_(getattr(expected, attr), getattr(batched, attr))
+        eq_(expected.url, expected.mirror_url)
+        eq_(batched.url, batched.mirror_url)
+        assert expected.scaled_at
+        assert batched.scaled_at
+        eq_([], duplicates)
+
+    def test_missing_thumbnail(self):
+        original, ignore = self._representation(media_type="image/png")
+        original.image_width, original.image_height = (800, 600)
+        mirrored, ignore = self._representation(media_type="image/jpeg")
+        mirrored.image_width, mirrored.image_height = (400, 300)
+        mirrored.mirrored_at = datetime.datetime.utcnow()
+        mirrored.thumbnail_of = original
+        unmirrored, ignore = self._representation(media_type="image/jpeg")
+        unmirrored.image_width, unmirrored.image_height = (200, 150)
+        unmirrored.thumbnail_of = original
+
+        def missing(height, width):
+            return original in self._db.query(Representation).filter(
+                ImageScaler._missing_thumbnail(height, width)
+            ).all()
+
+        # There's a mirrored thumbnail for this box.
+        eq_(False, missing(300, 400))
+
+        # But not for this one, though it's the same height.
+        eq_(True, missing(300, 200))
+
+        # The thumbnail for this box hasn't been mirrored.
+        eq_(True, missing(150, 200))
+
+        # The original fits in this box, so it needs no thumbnail.
+        eq_(False, missing(600, 800))
+
+    def test_destination_url(self):
+        scaler = ImageScaler(self._db, [], uploader=DummyS3Uploader())
+        data_source = DataSource.lookup(self._db, DataSource.OVERDRIVE)
+        identifier = self._identifier(Identifier.OVERDRIVE_ID)
+        hyperlink, ignore = identifier.add_link(
+            Hyperlink.IMAGE, self._url, data_source
+        )
+        urls = [scaler.destination_url(hyperlink, height, width)
+                for height, width in [(300, 200), (300, 400), (150, 100)]]
+        eq_(3, len(set(urls)))
+        assert urls[0].endswith("/cover.jpg")
+        assert urls[1].endswith("/cover-400x300.jpg")
+
+    def test_record_duplicate_images(self):
+        scaler = ImageScaler(self._db, [], uploader=DummyS3Uploader())
+        original, ignore = self._representation(media_type="image/png")
+        urls = ["http://example.com/1/300.jpg", "http://example.com/1/600.jpg"]
+        [small, unscaled] = scaler.record_scaled_images(
+            original, urls, "image/jpeg", (400, 300),
+            [("small jpeg", (200, 150)), None], None
+        )
+        self._db.flush()
+
+        # Another image with the same bytes gets a thumbnail that
+        # shares the first one's mirror, instead of being scaled again
+        # or storing the bytes again.
+        copy, ignore = self._representation(media_type="image/png")
+        urls = ["http://example.com/2/300.jpg", "http://example.com/2/600.jpg"]
+        thumbnails, duplicates = scaler.record_duplicate_images(
+            copy, urls, (400, 300), [small.id, None]
+        )
+        eq_([copy], thumbnails)
+        [(thumbnail, source)] = duplicates
+        eq_(small, source)
+        eq_(urls[0], thumbnail.url)
+        eq_(copy, thumbnail.thumbnail_of)
+        eq_(None, thumbnail.content)
+        eq_(small.mirror_url, thumbnail.mirror_url)
+        eq_((200, 150), (thumbnail.image_width, thumbnail.image_height))
+        eq_((400, 300), (copy.image_width, copy.image_height))
@@ -0,0 +1,102 @@
+import datetime
+from nose.tools import set_trace, eq_
+
+from core.model import (
+    DataSource,
+    ExternalIntegration,
+    Identifier,
+    Measurement,
+)
+
+from . import DatabaseTest
+import content_cafe
+from monitor import ContentCafeDemandMeasurementSweep
+
+
+class DummySudsClient(object):
+    def __init__(self, wsdl_url):
+        pass
+
+    def clone(self):
+        return self
+
+
+class TestContentCafeDemandMeasurementSweep(DatabaseTest):
+
+    def setup(self):
+        super(TestContentCafeDemandMeasurementSweep, self).setup()
+        self.old_suds_client = content_cafe.SudsClient
+        content_cafe.SudsClient = DummySudsClient
+        content_cafe.ContentCafeSOAPClient._suds_clients.clear()
+        self._external_integration(
+            ExternalIntegration.CONTENT_CAFE,
+            goal=ExternalIntegration.METADATA_GOAL,
+            username=u'user', password=u'password'
+        )
+
+    def teardown(self):
+        content_cafe.SudsClient = self.old_suds_client
+        content_cafe.ContentCafeSOAPClient._suds_clients.clear()
+        super(TestContentCafeDemandMeasurementSweep, self).teardown()
+
+    def test_identifier_query(self):
+        sweep = ContentCafeDemandMeasurementSweep(self._db)
+        eq_(ContentCafeDemandMeasurementSweep.DEFAULT_MAX_AGE, sweep.max_age)
+        data_source = sweep.client.data_source
+        overdrive = DataSource.lookup(self._db, DataSource.OVERDRIVE)
+
+        def isbn_for(*commercial):
+            isbn = self._identifier(Identifier.ISBN)
+            for identifier in commercial:
+                identifier.equivalent_to(overdrive, isbn, 1)
+            return isbn
+
+        # An ISBN that's never been measured.
+        never = isbn_for(
+            self._identifier(Identifier.OVERDRIVE_ID),
+            self._identifier(Identifier.AXIS_360_ID),
+        )
+
+        # An ISBN that was measured a long time ago.
+        stale = isbn_for(self._identifier(Identifier.THREEM_ID))
+        stale.add_measurement(
+            data_source, Measurement.POPULARITY, 10,
+            taken_at=datetime.datetime.utcnow() - datetime.timedelta(days=60)
+        )
+
+        # An ISBN that was measured recently.
+        fresh = isbn_for(self._identifier(Identifier.OVERDRIVE_ID))
+        fresh.add_measurement(data_source, Measurement.POPULARITY, 10)
+
+        # An ISBN that isn't associated with a commercial identifier.
+        isbn_for(self._identifier(Identifier.GUTENBERG_ID))
+
+        # Each stale ISBN shows up once, even if it's equivalent to
+        # more than one commercial identifier.
+        eq_([never, stale], sweep.identifier_query().all())
+
+        # With a longer maximum age, the older measurement is still
+        # good enough.
+        sweep = ContentCafeDemandMeasurementSweep(self._db, max_age=90)
+        eq_(datetime.timedelta(days=90), sweep.max_age)
+        eq_([never], sweep.identifier_query().all())
+
+    def test_process_batch(self):
+        sweep = ContentCafeDemandMeasurementSweep(self._db)
+        asked = []
+        def estimated_popularities(keys, cutoff=None):
+            asked.append((keys, cutoff))
+            return dict((key, 7) for key in keys)
+        sweep.client.soap_client.estimated_popularities = estimated_popularities
+
+        isbn = self._identifier(Identifier.ISBN, foreign_id=u"9780307278449")
+        not_an_isbn = self._identifier(Identifier.ISBN, foreign_id=u"123")
+        overdrive = self._identifier(Identifier.OVERDRIVE_ID)
+        sweep.process_batch([isbn, not_an_isbn, overdrive])
+
+        # Only the real ISBN was asked about, in one request.
+        eq_([([u"9780307278449"], sweep.client.ONE_YEAR_AGO)], asked)
+        [measurement] = isbn.measurements
+        eq_(7, measurement.value)
+        eq_(sweep.client.data_source, measurement.data_source)
+        eq_([], not_an_isbn.measurements)